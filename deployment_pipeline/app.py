@@ -17,6 +17,8 @@ logging.basicConfig(level="INFO")
 project_name = os.environ["SAGEMAKER_PROJECT_NAME"]
 project_id = os.environ["SAGEMAKER_PROJECT_ID"]
 stage_name = os.environ["STAGE_NAME"]
+# Optionally cache the model registry lookups across synth runs
+registry_cache_path = os.getenv("MODEL_REGISTRY_CACHE")
 
 # Create App and stacks
 app = core.App()
@@ -48,6 +50,12 @@ with open(f"{stage_name}-config.json", "r") as f:
         core.CfnTag(key="ab-testing:strategy", value=deployment_config.strategy),
         core.CfnTag(key="ab-testing:epsilon", value=str(deployment_config.epsilon)),
         core.CfnTag(key="ab-testing:warmup", value=str(deployment_config.warmup)),
+        core.CfnTag(
+            key="ab-testing:auto-stop", value=str(deployment_config.auto_stop).lower()
+        ),
+        core.CfnTag(
+            key="ab-testing:reward-range", value=str(deployment_config.reward_range)
+        ),
     ]
 
 sagemaker = SageMakerStack(
@@ -58,6 +66,7 @@ sagemaker = SageMakerStack(
     project_id=project_id,
     endpoint_name=endpoint_name,
     tags=tags,
+    registry_cache_path=registry_cache_path,
 )
 
 app.synth()
@@ -7,6 +7,84 @@ class InstanceConfig:
         self.instance_type = instance_type
 
 
+class AutoScalingConfig:
+    def __init__(
+        self,
+        min_instance_count: int = 1,
+        max_instance_count: int = 1,
+        target_invocations: int = 1000,
+        scale_in_cooldown: int = 300,
+        scale_out_cooldown: int = 60,
+    ):
+        if min_instance_count < 1 or max_instance_count < min_instance_count:
+            raise Exception(
+                "Require max_instance_count >= min_instance_count >= 1 for autoscaling"
+            )
+        self.min_instance_count = min_instance_count
+        self.max_instance_count = max_instance_count
+        # The target number of invocations per instance per minute
+        self.target_invocations = target_invocations
+        self.scale_in_cooldown = scale_in_cooldown
+        self.scale_out_cooldown = scale_out_cooldown
+
+
+def get_autoscaling_config(autoscaling_config):
+    # Turn dict into typed object
+    if type(autoscaling_config) is dict:
+        return AutoScalingConfig(**autoscaling_config)
+    return autoscaling_config
+
+
+class ServerlessConfig:
+    def __init__(self, memory_size_in_mb: int = 2048, max_concurrency: int = 5):
+        # see: https://docs.aws.amazon.com/sagemaker/latest/dg/serverless-endpoints.html
+        if memory_size_in_mb not in [1024, 2048, 3072, 4096, 5120, 6144]:
+            raise Exception(
+                "Require memory_size_in_mb in 1024 MB increments between 1024 and 6144"
+            )
+        if max_concurrency < 1 or max_concurrency > 200:
+            raise Exception("Require max_concurrency between 1 and 200")
+        self.memory_size_in_mb = memory_size_in_mb
+        self.max_concurrency = max_concurrency
+
+
+def get_serverless_config(serverless_config):
+    # Turn dict into typed object
+    if type(serverless_config) is dict:
+        return ServerlessConfig(**serverless_config)
+    return serverless_config
+
+
+class AsyncInferenceConfig:
+    def __init__(
+        self,
+        output_path: str,
+        notification_topic: str = None,
+        max_concurrent_invocations_per_instance: int = None,
+    ):
+        # see: https://docs.aws.amazon.com/sagemaker/latest/dg/async-inference-create-endpoint.html
+        if not output_path.startswith("s3://"):
+            raise Exception("Require output_path to be an S3 uri")
+        if (
+            max_concurrent_invocations_per_instance is not None
+            and max_concurrent_invocations_per_instance < 1
+        ):
+            raise Exception("Require max_concurrent_invocations_per_instance >= 1")
+        self.output_path = output_path
+        # The topic for success and error notifications, which the api logs the completed invocations from
+        self.notification_topic = notification_topic
+        self.max_concurrent_invocations_per_instance = (
+            max_concurrent_invocations_per_instance
+        )
+
+
+def get_async_inference_config(async_inference_config):
+    # Turn dict into typed object
+    if type(async_inference_config) is dict:
+        return AsyncInferenceConfig(**async_inference_config)
+    return async_inference_config
+
+
 class VariantConfig(InstanceConfig):
     def __init__(
         self,
@@ -16,11 +94,40 @@ class VariantConfig(InstanceConfig):
         instance_count: int = 1,
         instance_type: str = "ml.t2.medium",
         model_package_arn: str = None,
+        autoscaling_config: dict = None,
+        serverless_config: dict = None,
+        multi_model: bool = False,
+        model_data_url: str = None,
     ):
         self.model_package_version = model_package_version
         self.initial_variant_weight = initial_variant_weight
         self.variant_name = variant_name
         self.model_package_arn = model_package_arn
+        # Serverless variants are billed per request, so don't have instances to autoscale
+        self.serverless_config = get_serverless_config(serverless_config)
+        if self.serverless_config is not None:
+            autoscaling_config = None
+        self.autoscaling_config = get_autoscaling_config(autoscaling_config)
+        # The initial instances must be within the autoscaling capacity, which would otherwise scale them on deployment
+        if self.autoscaling_config is not None and not (
+            self.autoscaling_config.min_instance_count
+            <= instance_count
+            <= self.autoscaling_config.max_instance_count
+        ):
+            raise Exception(
+                "Require instance_count between min_instance_count and max_instance_count for autoscaling"
+            )
+        # Multi-model variants host the models under the S3 model data url prefix in one container
+        if multi_model and self.serverless_config is not None:
+            raise Exception("Multi-model variants are not supported for serverless")
+        if multi_model and not (
+            isinstance(model_data_url, str)
+            and model_data_url.startswith("s3://")
+            and model_data_url.endswith("/")
+        ):
+            raise Exception("Require model_data_url S3 prefix for multi-model variants")
+        self.multi_model = multi_model
+        self.model_data_url = model_data_url
         super().__init__(instance_count, instance_type)
 
 
@@ -29,6 +136,11 @@ class AlgorithmStrategy(Enum):
     EPSILOM_GREEDY = 1
     UCB1 = 2
     THOMPSON_SAMPLING = 3
+    LINUCB = 4
+    UCBV = 5
+    GAUSSIAN_THOMPSON_SAMPLING = 6
+    TOP_TWO_THOMPSON_SAMPLING = 7
+    SUCCESSIVE_ELIMINATION = 8
 
 
 class DeploymentConfig(InstanceConfig):
@@ -43,8 +155,16 @@ class DeploymentConfig(InstanceConfig):
         strategy: str = "ThompsonSampling",
         warmup: int = 0,
         epsilon: float = 0.1,
+        auto_stop: bool = False,
+        reward_range: float = 1.0,
+        autoscaling_config: dict = None,
+        serverless_config: dict = None,
+        async_inference_config: dict = None,
     ):
         self.stage_name = stage_name
+        # Use the deployment autoscaling and serverless config as default for variant config
+        self.autoscaling_config = get_autoscaling_config(autoscaling_config)
+        self.serverless_config = get_serverless_config(serverless_config)
         # Provide either the challenger variant count, or specific champion/challenger config
         self.challenger_variant_count = challenger_variant_count
         # Turn dict into typed object
@@ -53,6 +173,8 @@ class DeploymentConfig(InstanceConfig):
                 **{
                     "instance_count": instance_count,
                     "instance_type": instance_type,
+                    "autoscaling_config": self.autoscaling_config,
+                    "serverless_config": self.serverless_config,
                     **champion_variant_config,
                 }
             )
@@ -66,14 +188,45 @@ class DeploymentConfig(InstanceConfig):
                     **{
                         "instance_count": instance_count,
                         "instance_type": instance_type,
+                        "autoscaling_config": self.autoscaling_config,
+                        "serverless_config": self.serverless_config,
                         **vc,
                     }
                 )
                 for vc in challenger_variant_config
             ]
+        elif challenger_variant_count == 0:
+            self.challenger_variant_config = []
         else:
             self.challenger_variant_config = None
+        # An endpoint config can't mix serverless and instance based variants
+        variant_configs = [
+            vc
+            for vc in [self.champion_variant_config]
+            + (self.challenger_variant_config or [])
+            if vc is not None
+        ]
+        serverless = set(vc.serverless_config is not None for vc in variant_configs)
+        if len(serverless) > 1:
+            raise Exception(
+                "Require all variants to be either serverless or instance based"
+            )
+        serverless = self.serverless_config is not None or True in serverless
+        # Async inference applies to the endpoint, which can't host serverless variants
+        self.async_inference_config = get_async_inference_config(async_inference_config)
+        if self.async_inference_config is not None and serverless:
+            raise Exception("Async inference is not supported for serverless")
+        # Async invocations are routed by the variant weights, so can only be attributed to a single variant
+        if self.async_inference_config is not None and (
+            self.challenger_variant_config is None
+            or len(self.challenger_variant_config) > 0
+        ):
+            raise Exception("Async inference requires a single champion variant")
         self.strategy = strategy
         self.warmup = warmup
         self.epsilon = epsilon
+        self.auto_stop = auto_stop
+        if reward_range <= 0:
+            raise Exception("Reward range must be a positive value")
+        self.reward_range = reward_range
         super().__init__(instance_count, instance_type)
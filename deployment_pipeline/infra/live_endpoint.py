@@ -0,0 +1,143 @@
+import logging
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+
+def get_container_key(container: dict) -> dict:
+    """Gets the properties that identify the model hosted by a container.
+
+    Args:
+        container: The container definition with either the ModelPackageName, or Image and ModelDataUrl.
+
+    Returns:
+        The model package name, or the image, model data url and mode
+    """
+    if container.get("ModelPackageName"):
+        return {"ModelPackageName": container["ModelPackageName"]}
+    return {
+        "Image": container.get("Image"),
+        "ModelDataUrl": container.get("ModelDataUrl"),
+        "Mode": container.get("Mode", "SingleModel"),
+    }
+
+
+def get_number(value):
+    """
+    Return integral values as an int, so the template is the same as the deployed config.
+    """
+    if value is None:
+        return None
+    return int(value) if float(value).is_integer() else float(value)
+
+
+def get_weight_changes(live_variants: list, desired_variants: list) -> list:
+    """Gets the weight and capacity changes, if the variants are otherwise the same as the live variants.
+
+    Args:
+        live_variants: The list of variants for the live endpoint config, with the current weights and instance counts.
+        desired_variants: The list of variants for the deployment config.
+
+    Returns:
+        The list of DesiredWeightsAndCapacities for variants that changed, or None if the variant names,
+        models, instance types, serverless or async inference configs are different and the endpoint config
+        must be replaced.
+    """
+    if live_variants is None or len(live_variants) != len(desired_variants):
+        return None
+    changes = []
+    for live, desired in zip(live_variants, desired_variants):
+        for key in [
+            "VariantName",
+            "Container",
+            "InstanceType",
+            "ServerlessConfig",
+            "AsyncInferenceConfig",
+        ]:
+            if live.get(key) != desired.get(key):
+                logger.info(
+                    f"Variant {desired['VariantName']} {key} changed from: {live.get(key)} to: {desired.get(key)}"
+                )
+                return None
+        # Compare with the current values, as the weights and capacities may have changed since the endpoint config
+        change = {}
+        if live["CurrentWeight"] != desired["InitialVariantWeight"]:
+            change["DesiredWeight"] = desired["InitialVariantWeight"]
+        # Serverless variants don't have instances, and autoscaling variants manage their own capacity
+        if (
+            desired.get("InitialInstanceCount") is not None
+            and not desired.get("AutoScaling")
+            and live.get("CurrentInstanceCount") != desired["InitialInstanceCount"]
+        ):
+            change["DesiredInstanceCount"] = desired["InitialInstanceCount"]
+        if len(change) > 0:
+            changes.append({"VariantName": desired["VariantName"], **change})
+    return changes
+
+
+class LiveEndpoint:
+    """
+    Class for describing the variants of a deployed endpoint.
+    """
+
+    def __init__(self):
+        config = Config(retries={"max_attempts": 10, "mode": "standard"})
+        self.sm_client = boto3.client("sagemaker", config=config)
+
+    def get_live_variants(self, endpoint_name: str) -> list:
+        """Gets the variants of the endpoint config that the endpoint is deployed with.
+
+        Args:
+            endpoint_name: The endpoint name.
+
+        Returns:
+            The list of variants with the Container for each model, and the current weight and instance count
+            of the endpoint, or None if the endpoint is not in service
+        """
+        try:
+            response = self.sm_client.describe_endpoint(EndpointName=endpoint_name)
+            if response["EndpointStatus"] != "InService":
+                logger.info(
+                    f"Endpoint {endpoint_name} status: {response['EndpointStatus']} not InService"
+                )
+                return None
+            current_variants = dict(
+                [(v["VariantName"], v) for v in response.get("ProductionVariants", [])]
+            )
+            response = self.sm_client.describe_endpoint_config(
+                EndpointConfigName=response["EndpointConfigName"]
+            )
+            live_variants = []
+            for v in response["ProductionVariants"]:
+                model = self.sm_client.describe_model(ModelName=v["ModelName"])
+                container = model.get("PrimaryContainer") or model["Containers"][0]
+                current = current_variants.get(v["VariantName"], {})
+                live_variants.append(
+                    {
+                        "VariantName": v["VariantName"],
+                        "ModelName": v["ModelName"],
+                        "Container": get_container_key(container),
+                        "InitialVariantWeight": get_number(
+                            v.get("InitialVariantWeight")
+                        ),
+                        "InitialInstanceCount": get_number(
+                            v.get("InitialInstanceCount")
+                        ),
+                        "CurrentWeight": get_number(current.get("CurrentWeight")),
+                        "CurrentInstanceCount": get_number(
+                            current.get("CurrentInstanceCount")
+                        ),
+                        "InstanceType": v.get("InstanceType"),
+                        "ServerlessConfig": v.get("ServerlessConfig"),
+                        "AsyncInferenceConfig": response.get("AsyncInferenceConfig"),
+                    }
+                )
+            return live_variants
+
+        except ClientError as e:
+            # The endpoint doesn't exist for the first deployment
+            logger.info(f"Unable to describe endpoint {endpoint_name}: {e}")
+            return None
@@ -1,4 +1,8 @@
+import json
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import boto3
@@ -13,9 +17,74 @@ class ModelRegistry:
     Class for managing models in the registry.
     """
 
-    def __init__(self):
-        config = Config(retries={"max_attempts": 10, "mode": "standard"})
+    # The summary attributes to keep for versioned packages, which don't change so are cached with the containers
+    PACKAGE_KEYS = [
+        "ModelPackageGroupName",
+        "ModelPackageVersion",
+        "ModelPackageArn",
+        "CreationTime",
+    ]
+    # The status attributes that can change after the package is created, so are never cached
+    STATUS_KEYS = [
+        "ModelPackageStatus",
+        "ModelApprovalStatus",
+    ]
+
+    def __init__(
+        self, cache_path: str = None, cache_ttl: int = 3600, max_workers: int = 8
+    ):
+        config = Config(
+            retries={"max_attempts": 10, "mode": "standard"},
+            max_pool_connections=max(10, max_workers),
+        )
         self.sm_client = boto3.client("sagemaker", config=config)
+        self.max_workers = max_workers
+        # Optionally cache the group ARNs and package containers on disk, while the approval status is always described
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self.cache = self.load_cache()
+        # The versioned packages described in this run including their status, keyed by ARN and never saved
+        self.described = {}
+
+    def load_cache(self) -> dict:
+        """
+        Load the cache entries that have not expired from the cache file if it exists.
+        """
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, "r") as f:
+                entries = json.load(f)
+            min_cached_at = time.time() - self.cache_ttl
+            return dict(
+                [(k, e) for k, e in entries.items() if e["cached_at"] >= min_cached_at]
+            )
+        except (ValueError, KeyError, OSError) as e:
+            logger.warning(f"Unable to load cache: {self.cache_path}, {e}")
+            return {}
+
+    def save_cache(self):
+        """
+        Save the cache entries to the cache file.
+        """
+        if self.cache_path is None:
+            return
+        cache_dir = os.path.dirname(self.cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        with open(self.cache_path, "w") as f:
+            json.dump(self.cache, f, default=str)
+
+    def get_cached(self, key: str, fn):
+        """
+        Return the cached value for the key, or call the function and cache the value if it is not None.
+        """
+        if key in self.cache:
+            return self.cache[key]["value"]
+        value = fn()
+        if value is not None:
+            self.cache[key] = {"cached_at": time.time(), "value": value}
+        return value
 
     def create_model_package_group(
         self,
@@ -111,6 +180,111 @@ class ModelRegistry:
             logger.error(error_message)
             raise Exception(error_message)
 
+    def get_model_package_group_arn(self, model_package_group_name: str) -> str:
+        """Gets the ARN for a model package group.
+
+        Args:
+            model_package_group_name: The model package group name.
+
+        Returns:
+            The model package group ARN
+        """
+
+        def describe_group():
+            response = self.sm_client.describe_model_package_group(
+                ModelPackageGroupName=model_package_group_name
+            )
+            return response["ModelPackageGroupArn"]
+
+        return self.get_cached(f"group/{model_package_group_name}", describe_group)
+
+    def get_model_package_arn(
+        self, model_package_group_name: str, model_package_version: int
+    ) -> str:
+        """Gets the ARN for a version of a model package group.
+
+        Args:
+            model_package_group_name: The model package group name.
+            model_package_version: The model package version.
+
+        Returns:
+            The model package ARN, which is required to describe a versioned package
+        """
+        group_arn = self.get_model_package_group_arn(model_package_group_name)
+        return (
+            group_arn.replace(":model-package-group/", ":model-package/")
+            + f"/{model_package_version}"
+        )
+
+    def describe_versioned_package(
+        self, model_package_group_name: str, model_package_version: int
+    ) -> dict:
+        """Gets the summary and inference container for a version of a model package group.
+
+        Args:
+            model_package_group_name: The model package group name.
+            model_package_version: The model package version.
+
+        Returns:
+            The model package summary including the Containers, or None if the version does not exist
+        """
+        model_package_arn = self.get_model_package_arn(
+            model_package_group_name, model_package_version
+        )
+        # Reuse a package described in this run, but never the cached status as it can change within the cache ttl
+        if model_package_arn in self.described:
+            return self.described[model_package_arn]
+        try:
+            response = self.sm_client.describe_model_package(
+                ModelPackageName=model_package_arn
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ValidationException":
+                logger.debug(e.response["Error"]["Message"])
+                return None
+            raise e
+        package = dict([(k, response.get(k)) for k in self.PACKAGE_KEYS])
+        package["Containers"] = response["InferenceSpecification"]["Containers"]
+        self.cache[model_package_arn] = {"cached_at": time.time(), "value": package}
+        described = {
+            **package,
+            **dict([(k, response.get(k)) for k in self.STATUS_KEYS]),
+        }
+        self.described[model_package_arn] = described
+        return described
+
+    def prefetch_versioned_packages(self, model_package_group_versions: dict):
+        """Describes versions of multiple model package groups concurrently, so later lookups in this run reuse them.
+
+        Args:
+            model_package_group_versions: The dictionary of group name to list of versions.
+        """
+        # Describe the groups first, so the ARNs are only fetched once for each group
+        self.map_concurrent(
+            self.get_model_package_group_arn, model_package_group_versions
+        )
+        self.map_concurrent(
+            lambda gv: self.describe_versioned_package(*gv),
+            set(
+                (g, v)
+                for g, versions in model_package_group_versions.items()
+                for v in versions
+            ),
+        )
+        self.save_cache()
+
+    def map_concurrent(self, fn, items) -> list:
+        """
+        Return the results of the function for each item using a thread pool.
+        """
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                return list(executor.map(fn, items))
+        except ClientError as e:
+            error_message = e.response["Error"]["Message"]
+            logger.error(error_message)
+            raise Exception(error_message)
+
     def get_versioned_approved_packages(
         self,
         model_package_group_name: str,
@@ -121,53 +295,50 @@ class ModelRegistry:
         Args:
             model_package_group_name: The model package group name.
             model_package_versions: The model package versions to return.
-            creation_time_after: Optional filter that returns only model
-            packages created after the specified time (timestamp).
 
         Returns:
-            The list of model packages, sorted by most recently created
+            The list of model packages in order of versions
         """
-        max_results = 100
-        unique_versions = set(model_package_versions)
+        unique_versions = sorted(set(model_package_versions))
 
-        try:
-            # Get the approved model package until
-            args = {
-                "ModelPackageGroupName": model_package_group_name,
-                "ModelApprovalStatus": "Approved",
-                "SortBy": "CreationTime",
-                "MaxResults": max_results,
-            }
-            response = self.sm_client.list_model_packages(**args)
-            model_packages = self.select_versioned_packages(
-                response["ModelPackageSummaryList"], unique_versions
+        # Describe each version by ARN, rather than listing all packages in the group
+        model_packages = [
+            p
+            for p in self.map_concurrent(
+                lambda v: self.describe_versioned_package(model_package_group_name, v),
+                unique_versions,
             )
+            if p is not None and p["ModelApprovalStatus"] == "Approved"
+        ]
+        self.save_cache()
 
-            # Fetch more packages if none returned with continuation token
-            while (
-                len(model_packages) < len(unique_versions) and "NextToken" in response
-            ):
-                logger.debug(
-                    "Getting more packages for token: {}".format(response["NextToken"])
-                )
-                args = {**args, "NextToken": response["NextToken"]}
-                response = self.sm_client.list_model_packages(**args)
-                model_packages.extend(
-                    self.select_versioned_packages(
-                        response["ModelPackageSummaryList"], unique_versions
-                    )
-                )
+        # Return error if no packages found
+        if len(model_packages) == 0:
+            error_message = f"No approved packages found for: {model_package_group_name} and versions: {model_package_versions}"
+            logger.error(error_message)
+            raise Exception(error_message)
 
-            # Return error if no packages found
-            if len(model_packages) == 0:
-                error_message = f"No approved packages found for: {model_package_group_name} and versions: {model_package_versions}"
-                logger.error(error_message)
-                raise Exception(error_message)
+        # Return as a list of model package group in order of versions
+        return self.select_versioned_packages(model_packages, model_package_versions)
+
+    def get_model_package_container(self, model_package_arn: str) -> dict:
+        """Gets the inference container for a model package.
 
-            # Return as a list of model package group in order of versions
-            return self.select_versioned_packages(
-                model_packages, model_package_versions
+        Args:
+            model_package_arn: The model package ARN.
+
+        Returns:
+            The first inference container definition including the Image and ModelDataUrl
+        """
+        # Use the containers for versioned packages that have already been described
+        cached = self.cache.get(model_package_arn)
+        if cached is not None:
+            return cached["value"]["Containers"][0]
+        try:
+            response = self.sm_client.describe_model_package(
+                ModelPackageName=model_package_arn
             )
+            return response["InferenceSpecification"]["Containers"][0]
 
         except ClientError as e:
             error_message = e.response["Error"]["Message"]
@@ -188,9 +359,11 @@ class ModelRegistry:
             Duplicate versions will be preserved.
         """
 
+        # Index the packages by version, so selecting is linear in the packages and versions
+        version_index = {}
+        for p in model_packages:
+            version_index.setdefault(p["ModelPackageVersion"], []).append(p)
         filtered_packages = []
         for version in model_package_versions:
-            filtered_packages += [
-                p for p in model_packages if p["ModelPackageVersion"] == version
-            ]
+            filtered_packages += version_index.get(version, [])
         return filtered_packages
@@ -1,12 +1,22 @@
 from aws_cdk import (
     core,
+    aws_applicationautoscaling,
     aws_iam,
     aws_sagemaker,
+    custom_resources,
 )
 
 from datetime import datetime
+import hashlib
+import json
 import logging
-from deployment_config import DeploymentConfig, VariantConfig
+from deployment_config import AsyncInferenceConfig, DeploymentConfig, VariantConfig
+from live_endpoint import (
+    LiveEndpoint,
+    get_container_key,
+    get_number,
+    get_weight_changes,
+)
 from model_registry import ModelRegistry
 
 logger = logging.getLogger(__name__)
@@ -22,6 +32,7 @@ class SageMakerStack(core.Stack):
         project_id: str,
         endpoint_name: str,
         tags: list,
+        registry_cache_path: str = None,
         **kwargs,
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
@@ -32,7 +43,7 @@ class SageMakerStack(core.Stack):
         challenger_creation_time: datetime = None
 
         # Create the model package groups if they don't exist
-        registry = ModelRegistry()
+        registry = ModelRegistry(cache_path=registry_cache_path)
         registry.create_model_package_group(
             champion_package_group,
             "Champion Models for A/B Testing",
@@ -46,6 +57,14 @@ class SageMakerStack(core.Stack):
             project_id,
         )
 
+        # Describe any specific champion and challenger versions concurrently
+        self.prefetch_versioned_packages(
+            registry,
+            deployment_config,
+            champion_package_group,
+            challenger_package_group,
+        )
+
         # If we don't have a specific champion variant defined, get the latest approved
         if deployment_config.champion_variant_config is None:
             logger.info("Selecting top champion variant")
@@ -58,6 +77,8 @@ class SageMakerStack(core.Stack):
                 initial_variant_weight=1,
                 instance_count=deployment_config.instance_count,
                 instance_type=deployment_config.instance_type,
+                autoscaling_config=deployment_config.autoscaling_config,
+                serverless_config=deployment_config.serverless_config,
             )
             challenger_creation_time = p["CreationTime"]
         else:
@@ -84,6 +105,8 @@ class SageMakerStack(core.Stack):
                     initial_variant_weight=1,
                     instance_count=deployment_config.instance_count,
                     instance_type=deployment_config.instance_type,
+                    autoscaling_config=deployment_config.autoscaling_config,
+                    serverless_config=deployment_config.serverless_config,
                 )
                 for p in registry.get_latest_approved_packages(
                     challenger_package_group,
@@ -91,7 +114,7 @@ class SageMakerStack(core.Stack):
                     creation_time_after=challenger_creation_time,
                 )
             ]
-        else:
+        elif len(deployment_config.challenger_variant_config) > 0:
             # Get the versioned packages and update ARN
             versions = [
                 c.model_package_version
@@ -117,7 +140,8 @@ class SageMakerStack(core.Stack):
             deployment_config.champion_variant_config
         ] + deployment_config.challenger_variant_config
 
-        model_variants = []
+        desired_variants = []
+        autoscaling_variants = []
         for i, variant_config in enumerate(model_configs):
             # If variant name not in config use "Champion" for the latest approved and "Challenge{N}" for next N pending
             variant_name = variant_config.variant_name or (
@@ -126,33 +150,41 @@ class SageMakerStack(core.Stack):
                 else f"Challenger{variant_config.model_package_version}"
             )
 
+            primary_container = self.get_primary_container(registry, variant_config)
+
             # Do not use a custom named resource for models as these get replaced
             model = aws_sagemaker.CfnModel(
                 self,
                 variant_name,
                 execution_role_arn=service_catalog_role.role_arn,
-                primary_container=aws_sagemaker.CfnModel.ContainerDefinitionProperty(
-                    model_package_name=variant_config.model_package_arn,
-                ),
+                primary_container=primary_container,
             )
 
-            # Create the production variant
-            model_variant = aws_sagemaker.CfnEndpointConfig.ProductionVariantProperty(
-                initial_instance_count=variant_config.instance_count,
-                initial_variant_weight=variant_config.initial_variant_weight,
-                instance_type=variant_config.instance_type,
-                model_name=model.attr_model_name,
-                variant_name=variant_name,
+            desired_variants.append(
+                self.get_desired_variant(
+                    variant_name,
+                    model,
+                    primary_container,
+                    variant_config,
+                    deployment_config.async_inference_config,
+                )
             )
-            model_variants.append(model_variant)
+            if variant_config.autoscaling_config is not None:
+                autoscaling_variants.append(
+                    (variant_name, variant_config.autoscaling_config)
+                )
 
-        if len(model_variants) == 0:
+        if len(desired_variants) == 0:
             raise Exception("No model variants matching configuration")
 
-        endpoint_config = aws_sagemaker.CfnEndpointConfig(
-            self,
-            "EndpointConfig",
-            production_variants=model_variants,
+        # If only the weights or instance counts have changed, keep the live endpoint config so the variants are
+        # not provisioned again, and update the weights and capacities in place
+        live_variants = LiveEndpoint().get_live_variants(endpoint_name)
+        weight_changes = get_weight_changes(live_variants, desired_variants)
+        endpoint_config = self.create_endpoint_config(
+            desired_variants,
+            model_configs,
+            live_variants if weight_changes is not None else None,
         )
 
         self.endpoint = aws_sagemaker.CfnEndpoint(
@@ -162,3 +194,242 @@ class SageMakerStack(core.Stack):
             endpoint_name=endpoint_name,
             tags=tags,
         )
+
+        if weight_changes:
+            self.add_weights_update(endpoint_name, weight_changes, live_variants)
+
+        # Add the autoscaling target and policy for variants, which depend on the endpoint existing
+        # see: https://docs.aws.amazon.com/sagemaker/latest/dg/endpoint-auto-scaling-add-code-register.html
+        for variant_name, autoscaling_config in autoscaling_variants:
+            scalable_target = aws_applicationautoscaling.CfnScalableTarget(
+                self,
+                f"{variant_name}ScalableTarget",
+                min_capacity=autoscaling_config.min_instance_count,
+                max_capacity=autoscaling_config.max_instance_count,
+                resource_id=f"endpoint/{endpoint_name}/variant/{variant_name}",
+                role_arn=f"arn:aws:iam::{self.account}:role/aws-service-role/"
+                "sagemaker.application-autoscaling.amazonaws.com/"
+                "AWSServiceRoleForApplicationAutoScaling_SageMakerEndpoint",
+                scalable_dimension="sagemaker:variant:DesiredInstanceCount",
+                service_namespace="sagemaker",
+            )
+            scalable_target.add_depends_on(self.endpoint)
+
+            scaling_policy = aws_applicationautoscaling.CfnScalingPolicy
+            tracking_config = scaling_policy.TargetTrackingScalingPolicyConfigurationProperty(
+                target_value=autoscaling_config.target_invocations,
+                predefined_metric_specification=scaling_policy.PredefinedMetricSpecificationProperty(
+                    predefined_metric_type="SageMakerVariantInvocationsPerInstance",
+                ),
+                scale_in_cooldown=autoscaling_config.scale_in_cooldown,
+                scale_out_cooldown=autoscaling_config.scale_out_cooldown,
+            )
+            scaling_policy(
+                self,
+                f"{variant_name}ScalingPolicy",
+                policy_name=f"{endpoint_name}-{variant_name}-invocations",
+                policy_type="TargetTrackingScaling",
+                scaling_target_id=scalable_target.ref,
+                target_tracking_scaling_policy_configuration=tracking_config,
+            )
+
+    @staticmethod
+    def get_desired_variant(
+        variant_name: str,
+        model: aws_sagemaker.CfnModel,
+        primary_container: aws_sagemaker.CfnModel.ContainerDefinitionProperty,
+        variant_config: VariantConfig,
+        async_inference_config: AsyncInferenceConfig = None,
+    ) -> dict:
+        """
+        Return the production variant properties to compare with the live endpoint config
+        """
+        serverless_config = variant_config.serverless_config
+        return {
+            "VariantName": variant_name,
+            "ModelName": model.attr_model_name,
+            "Container": get_container_key(
+                {
+                    "ModelPackageName": primary_container.model_package_name,
+                    "Image": primary_container.image,
+                    "ModelDataUrl": primary_container.model_data_url,
+                    "Mode": primary_container.mode or "SingleModel",
+                }
+            ),
+            "InitialVariantWeight": get_number(variant_config.initial_variant_weight),
+            "InitialInstanceCount": (
+                None if serverless_config else get_number(variant_config.instance_count)
+            ),
+            "InstanceType": None if serverless_config else variant_config.instance_type,
+            "ServerlessConfig": (
+                {
+                    "MemorySizeInMB": serverless_config.memory_size_in_mb,
+                    "MaxConcurrency": serverless_config.max_concurrency,
+                }
+                if serverless_config
+                else None
+            ),
+            "AutoScaling": variant_config.autoscaling_config is not None,
+            "AsyncInferenceConfig": SageMakerStack.get_async_inference_config(
+                async_inference_config
+            ),
+        }
+
+    @staticmethod
+    def get_async_inference_config(async_inference_config: AsyncInferenceConfig):
+        """
+        Return the endpoint config async inference properties, which are the same for all variants
+        see: https://docs.aws.amazon.com/sagemaker/latest/APIReference/API_AsyncInferenceConfig.html
+        """
+        if async_inference_config is None:
+            return None
+        output_config = {"S3OutputPath": async_inference_config.output_path}
+        if async_inference_config.notification_topic is not None:
+            output_config["NotificationConfig"] = {
+                "SuccessTopic": async_inference_config.notification_topic,
+                "ErrorTopic": async_inference_config.notification_topic,
+            }
+        result = {"OutputConfig": output_config}
+        if async_inference_config.max_concurrent_invocations_per_instance is not None:
+            result["ClientConfig"] = {
+                "MaxConcurrentInvocationsPerInstance": async_inference_config.max_concurrent_invocations_per_instance
+            }
+        return result
+
+    def create_endpoint_config(
+        self, desired_variants: list, model_configs: list, live_variants: list
+    ):
+        """
+        Create the endpoint config for the desired variants, with the weights and instance counts of the
+        live variants if provided
+        """
+        model_variants = []
+        for i, (d, variant_config) in enumerate(zip(desired_variants, model_configs)):
+            initial_variant_weight = d["InitialVariantWeight"]
+            initial_instance_count = variant_config.instance_count
+            if live_variants is not None:
+                initial_variant_weight = live_variants[i]["InitialVariantWeight"]
+                initial_instance_count = (
+                    live_variants[i]["InitialInstanceCount"] or initial_instance_count
+                )
+            model_variants.append(
+                aws_sagemaker.CfnEndpointConfig.ProductionVariantProperty(
+                    initial_instance_count=initial_instance_count,
+                    initial_variant_weight=initial_variant_weight,
+                    instance_type=variant_config.instance_type,
+                    model_name=d["ModelName"],
+                    variant_name=d["VariantName"],
+                )
+            )
+        endpoint_config = aws_sagemaker.CfnEndpointConfig(
+            self,
+            "EndpointConfig",
+            production_variants=model_variants,
+        )
+
+        # Override serverless variants which don't have instances, as these properties are not in this CDK version
+        # see: https://docs.aws.amazon.com/sagemaker/latest/dg/serverless-endpoints.html
+        for i, d in enumerate(desired_variants):
+            if d["ServerlessConfig"] is None:
+                continue
+            endpoint_config.add_property_deletion_override(
+                f"ProductionVariants.{i}.InitialInstanceCount"
+            )
+            endpoint_config.add_property_deletion_override(
+                f"ProductionVariants.{i}.InstanceType"
+            )
+            endpoint_config.add_property_override(
+                f"ProductionVariants.{i}.ServerlessConfig", d["ServerlessConfig"]
+            )
+
+        # Add the async inference config, as this property is not in this CDK version
+        # see: https://docs.aws.amazon.com/sagemaker/latest/dg/async-inference.html
+        async_inference_config = desired_variants[0]["AsyncInferenceConfig"]
+        if async_inference_config is not None:
+            endpoint_config.add_property_override(
+                "AsyncInferenceConfig", async_inference_config
+            )
+        return endpoint_config
+
+    def add_weights_update(
+        self, endpoint_name: str, weight_changes: list, live_variants: list
+    ):
+        """
+        Update the weights and capacities of the live endpoint variants, when the desired changes
+        see: https://docs.aws.amazon.com/sagemaker/latest/APIReference/API_UpdateEndpointWeightsAndCapacities.html
+        """
+        logger.info(f"Updating endpoint weights and capacities: {weight_changes}")
+        # Include the current values, so the same changes are applied again if the live endpoint has since changed
+        current = [
+            [v["VariantName"], v["CurrentWeight"], v["CurrentInstanceCount"]]
+            for v in live_variants
+        ]
+        changes_hash = hashlib.sha256(
+            json.dumps([weight_changes, current], sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+        update_call = custom_resources.AwsSdkCall(
+            service="SageMaker",
+            action="updateEndpointWeightsAndCapacities",
+            parameters={
+                "EndpointName": endpoint_name,
+                "DesiredWeightsAndCapacities": weight_changes,
+            },
+            physical_resource_id=custom_resources.PhysicalResourceId.of(
+                f"{endpoint_name}-{changes_hash}"
+            ),
+        )
+        # There is no on_delete, as the resource is removed once the endpoint config matches the deployment config
+        # or the endpoint is deleted, and the weights and capacities it applied should be kept in either case
+        weights_update = custom_resources.AwsCustomResource(
+            self,
+            "EndpointWeights",
+            on_create=update_call,
+            on_update=update_call,
+            policy=custom_resources.AwsCustomResourcePolicy.from_sdk_calls(
+                resources=[
+                    f"arn:aws:sagemaker:{self.region}:{self.account}:endpoint/{endpoint_name}"
+                ]
+            ),
+        )
+        weights_update.node.add_dependency(self.endpoint)
+
+    @staticmethod
+    def prefetch_versioned_packages(
+        registry: ModelRegistry,
+        deployment_config: DeploymentConfig,
+        champion_package_group: str,
+        challenger_package_group: str,
+    ):
+        """
+        Describe the configured champion and challenger versions across both groups concurrently
+        """
+        group_versions = {}
+        if deployment_config.champion_variant_config is not None:
+            group_versions[champion_package_group] = [
+                deployment_config.champion_variant_config.model_package_version
+            ]
+        if deployment_config.challenger_variant_config is not None:
+            group_versions[challenger_package_group] = [
+                c.model_package_version
+                for c in deployment_config.challenger_variant_config
+            ]
+        if len(group_versions) > 0:
+            registry.prefetch_versioned_packages(group_versions)
+
+    def get_primary_container(
+        self, registry: ModelRegistry, variant_config: VariantConfig
+    ):
+        if variant_config.multi_model:
+            # Host the package image in multi-model mode with the model data url prefix
+            # see: https://docs.aws.amazon.com/sagemaker/latest/dg/multi-model-endpoints.html
+            container = registry.get_model_package_container(
+                variant_config.model_package_arn
+            )
+            return aws_sagemaker.CfnModel.ContainerDefinitionProperty(
+                image=container["Image"],
+                mode="MultiModel",
+                model_data_url=variant_config.model_data_url,
+            )
+        return aws_sagemaker.CfnModel.ContainerDefinitionProperty(
+            model_package_name=variant_config.model_package_arn,
+        )
@@ -0,0 +1,181 @@
+import pytest
+
+from deployment_config import (
+    AsyncInferenceConfig,
+    DeploymentConfig,
+    AutoScalingConfig,
+    ServerlessConfig,
+    VariantConfig,
+)
+
+
+def test_variant_autoscaling_config():
+    config = DeploymentConfig(
+        stage_name="prod",
+        instance_count=2,
+        autoscaling_config={"min_instance_count": 1, "max_instance_count": 4},
+        champion_variant_config={"model_package_version": 1},
+        challenger_variant_config=[
+            {"model_package_version": 2},
+            {
+                "model_package_version": 3,
+                "autoscaling_config": {
+                    "min_instance_count": 1,
+                    "max_instance_count": 10,
+                    "target_invocations": 500,
+                },
+            },
+        ],
+    )
+
+    # Validate the deployment autoscaling config is the default for variants
+    assert config.champion_variant_config.instance_count == 2
+    assert config.champion_variant_config.autoscaling_config.max_instance_count == 4
+    challenger1, challenger2 = config.challenger_variant_config
+    assert challenger1.autoscaling_config.max_instance_count == 4
+    assert challenger1.autoscaling_config.target_invocations == 1000
+    assert challenger2.autoscaling_config.max_instance_count == 10
+    assert challenger2.autoscaling_config.target_invocations == 500
+
+
+def test_no_autoscaling_config():
+    config = DeploymentConfig(
+        stage_name="dev",
+        champion_variant_config={"model_package_version": 1},
+    )
+    assert config.autoscaling_config is None
+    assert config.champion_variant_config.autoscaling_config is None
+
+
+def test_invalid_autoscaling_config():
+    with pytest.raises(Exception):
+        AutoScalingConfig(min_instance_count=2, max_instance_count=1)
+
+    # Validate the variant instance count must be within the autoscaling capacity
+    with pytest.raises(Exception):
+        DeploymentConfig(
+            stage_name="prod",
+            instance_count=5,
+            autoscaling_config={"min_instance_count": 1, "max_instance_count": 4},
+            champion_variant_config={"model_package_version": 1},
+        )
+    with pytest.raises(Exception):
+        VariantConfig(
+            model_package_version=1,
+            instance_count=1,
+            autoscaling_config={"min_instance_count": 2, "max_instance_count": 4},
+        )
+
+
+def test_variant_serverless_config():
+    config = DeploymentConfig(
+        stage_name="dev",
+        autoscaling_config={"min_instance_count": 1, "max_instance_count": 4},
+        serverless_config={"memory_size_in_mb": 2048},
+        champion_variant_config={"model_package_version": 1},
+        challenger_variant_config=[
+            {
+                "model_package_version": 2,
+                "serverless_config": {"memory_size_in_mb": 4096, "max_concurrency": 10},
+            },
+        ],
+    )
+
+    # Validate the serverless variants don't autoscale instances
+    assert config.champion_variant_config.serverless_config.memory_size_in_mb == 2048
+    assert config.champion_variant_config.autoscaling_config is None
+    challenger = config.challenger_variant_config[0]
+    assert challenger.serverless_config.memory_size_in_mb == 4096
+    assert challenger.serverless_config.max_concurrency == 10
+    assert challenger.autoscaling_config is None
+
+    # Validate an endpoint can't mix serverless and instance based variants
+    with pytest.raises(Exception):
+        DeploymentConfig(
+            stage_name="dev",
+            champion_variant_config={"model_package_version": 1},
+            challenger_variant_config=[
+                {"model_package_version": 2, "serverless_config": {}},
+            ],
+        )
+
+
+def test_variant_multi_model_config():
+    config = DeploymentConfig(
+        stage_name="dev",
+        autoscaling_config={"min_instance_count": 1, "max_instance_count": 4},
+        champion_variant_config={"model_package_version": 1},
+        challenger_variant_config=[
+            {
+                "model_package_version": 2,
+                "multi_model": True,
+                "model_data_url": "s3://bucket/models/",
+            },
+        ],
+    )
+    challenger = config.challenger_variant_config[0]
+    assert challenger.multi_model
+    assert challenger.model_data_url == "s3://bucket/models/"
+    assert challenger.autoscaling_config.max_instance_count == 4
+
+    # Validate the multi-model prefix must be provided
+    for model_data_url in [None, "s3://bucket/models/model.tar.gz"]:
+        with pytest.raises(Exception):
+            VariantConfig(
+                model_package_version=1,
+                multi_model=True,
+                model_data_url=model_data_url,
+            )
+
+
+def test_invalid_serverless_config():
+    with pytest.raises(Exception):
+        ServerlessConfig(memory_size_in_mb=1000)
+    with pytest.raises(Exception):
+        VariantConfig(
+            model_package_version=1,
+            serverless_config={"memory_size_in_mb": 2048},
+            multi_model=True,
+        )
+
+
+def test_async_inference_config():
+    config = DeploymentConfig(
+        stage_name="dev",
+        challenger_variant_count=0,
+        async_inference_config={
+            "output_path": "s3://test-bucket/async/output/",
+            "notification_topic": "arn:aws:sns:REGION:ACCOUNT:test-topic",
+        },
+    )
+    assert config.async_inference_config.output_path == "s3://test-bucket/async/output/"
+    assert config.async_inference_config.max_concurrent_invocations_per_instance is None
+    assert config.challenger_variant_config == []
+
+
+def test_invalid_async_inference_config():
+    with pytest.raises(Exception):
+        AsyncInferenceConfig(output_path="test-bucket/async/output/")
+    # Validate serverless variants can't be hosted on an async endpoint
+    with pytest.raises(Exception):
+        DeploymentConfig(
+            stage_name="dev",
+            champion_variant_config={
+                "model_package_version": 1,
+                "serverless_config": {"memory_size_in_mb": 2048},
+            },
+            async_inference_config={"output_path": "s3://test-bucket/async/output/"},
+        )
+    # Validate an async endpoint can't host challengers, as invocations are routed by the variant weights
+    with pytest.raises(Exception):
+        DeploymentConfig(
+            stage_name="dev",
+            async_inference_config={"output_path": "s3://test-bucket/async/output/"},
+        )
+    with pytest.raises(Exception):
+        DeploymentConfig(
+            stage_name="dev",
+            champion_variant_config={"model_package_version": 1},
+            challenger_variant_config=[{"model_package_version": 2}],
+            async_inference_config={"output_path": "s3://test-bucket/async/output/"},
+        )
@@ -0,0 +1,145 @@
+from botocore.stub import Stubber
+
+from live_endpoint import LiveEndpoint, get_weight_changes
+
+
+def get_variant(variant_name: str, model_package_name: str, weight=1, count=1):
+    return {
+        "VariantName": variant_name,
+        "Container": {"ModelPackageName": model_package_name},
+        "InitialVariantWeight": weight,
+        "InitialInstanceCount": count,
+        "InstanceType": "ml.t2.medium",
+        "ServerlessConfig": None,
+        "AsyncInferenceConfig": None,
+    }
+
+
+def get_live_variant(variant_name: str, model_package_name: str, weight=1, count=1):
+    return {
+        **get_variant(variant_name, model_package_name),
+        "CurrentWeight": weight,
+        "CurrentInstanceCount": count,
+    }
+
+
+def test_get_live_variants():
+    live_endpoint = LiveEndpoint()
+
+    with Stubber(live_endpoint.sm_client) as stubber:
+        expected_params = {"EndpointName": "test-endpoint"}
+        expected_response = {
+            "EndpointName": "test-endpoint",
+            "EndpointArn": "arn:aws:sagemaker:REGION:ACCOUNT:endpoint/test-endpoint",
+            "EndpointConfigName": "test-config",
+            "EndpointStatus": "InService",
+            "ProductionVariants": [
+                {
+                    "VariantName": "Champion1",
+                    "CurrentWeight": 0.5,
+                    "DesiredWeight": 0.5,
+                    "CurrentInstanceCount": 3,
+                    "DesiredInstanceCount": 3,
+                }
+            ],
+            "CreationTime": 0,
+            "LastModifiedTime": 0,
+        }
+        stubber.add_response("describe_endpoint", expected_response, expected_params)
+        expected_params = {"EndpointConfigName": "test-config"}
+        expected_response = {
+            "EndpointConfigName": "test-config",
+            "EndpointConfigArn": "arn:aws:sagemaker:REGION:ACCOUNT:endpoint-config/test-config",
+            "ProductionVariants": [
+                {
+                    "VariantName": "Champion1",
+                    "ModelName": "test-model",
+                    "InitialInstanceCount": 2,
+                    "InstanceType": "ml.t2.medium",
+                    "InitialVariantWeight": 1.0,
+                }
+            ],
+            "CreationTime": 0,
+        }
+        stubber.add_response(
+            "describe_endpoint_config", expected_response, expected_params
+        )
+        expected_params = {"ModelName": "test-model"}
+        expected_response = {
+            "ModelName": "test-model",
+            "PrimaryContainer": {"ModelPackageName": "test-package/1"},
+            "ExecutionRoleArn": "arn:aws:iam::ACCOUNT:role/test-role",
+            "CreationTime": 0,
+            "ModelArn": "arn:aws:sagemaker:REGION:ACCOUNT:model/test-model",
+        }
+        stubber.add_response("describe_model", expected_response, expected_params)
+
+        live_variants = live_endpoint.get_live_variants("test-endpoint")
+        # Validate the weight is returned as an int to match the template, with the current weight and count
+        assert live_variants == [
+            {
+                **get_variant("Champion1", "test-package/1", count=2),
+                "ModelName": "test-model",
+                "CurrentWeight": 0.5,
+                "CurrentInstanceCount": 3,
+            }
+        ]
+
+        # Validate no variants are returned if the endpoint doesn't exist
+        stubber.add_client_error(
+            "describe_endpoint",
+            "ValidationException",
+            "Could not find endpoint",
+            expected_params={"EndpointName": "test-endpoint"},
+        )
+        assert live_endpoint.get_live_variants("test-endpoint") is None
+
+
+def test_get_weight_changes():
+    live_variants = [
+        get_live_variant("Champion1", "test-package/1"),
+        get_live_variant("Challenger2", "test-package/2"),
+    ]
+
+    # Validate only the changed weights and instance counts are returned
+    desired_variants = [
+        get_variant("Champion1", "test-package/1", weight=2),
+        get_variant("Challenger2", "test-package/2", count=3),
+    ]
+    assert get_weight_changes(live_variants, desired_variants) == [
+        {"VariantName": "Champion1", "DesiredWeight": 2},
+        {"VariantName": "Challenger2", "DesiredInstanceCount": 3},
+    ]
+
+    # Validate the instance count is not changed for autoscaling variants
+    desired_variants[1]["AutoScaling"] = True
+    assert get_weight_changes(live_variants, desired_variants) == [
+        {"VariantName": "Champion1", "DesiredWeight": 2},
+    ]
+
+    # Validate the configured weight is applied again if the current weight has since been updated
+    live_variants[0]["CurrentWeight"] = 0.5
+    desired_variants = [
+        get_variant("Champion1", "test-package/1"),
+        get_variant("Challenger2", "test-package/2"),
+    ]
+    assert get_weight_changes(live_variants, desired_variants) == [
+        {"VariantName": "Champion1", "DesiredWeight": 1},
+    ]
+
+    # Validate the endpoint config is replaced if a model has changed
+    desired_variants = [
+        get_variant("Champion1", "test-package/1"),
+        get_variant("Challenger2", "test-package/3"),
+    ]
+    assert get_weight_changes(live_variants, desired_variants) is None
+
+    # Validate the endpoint config is replaced if the async inference config has changed
+    desired_variants = [
+        {**v, "AsyncInferenceConfig": {"OutputConfig": {"S3OutputPath": "s3://b/"}}}
+        for v in live_variants
+    ]
+    assert get_weight_changes(live_variants, desired_variants) is None
+
+    # Validate the endpoint config is replaced for a new endpoint
+    assert get_weight_changes(None, desired_variants) is None
@@ -238,65 +238,111 @@ def test_empty_latest_approved_model_packages_after_creation():
         assert len(response) == 0
 
 
-def test_get_versioned_approved_model_packages():
-    # Create model registry
-    registry = ModelRegistry()
+def get_versioned_package(version: int):
+    keys = ModelRegistry.PACKAGE_KEYS + ModelRegistry.STATUS_KEYS
+    return {
+        **dict([(k, get_package(version)[k]) for k in keys]),
+        "Containers": [{"Image": "test-image", "ModelDataUrl": f"s3://{version}"}],
+    }
 
-    with Stubber(registry.sm_client) as stubber:
-        # Empty list with more
-        expected_params = {
-            "ModelPackageGroupName": "test-package-group",
-            "ModelApprovalStatus": "Approved",
-            "SortBy": "CreationTime",
-            "MaxResults": 100,
-        }
-        expected_response = {
-            "ModelPackageSummaryList": [],
-            "NextToken": "MORE1",
-        }
-        stubber.add_response("list_model_packages", expected_response, expected_params)
-        # Version 1 with more
-        expected_params = {
-            "ModelPackageGroupName": "test-package-group",
-            "ModelApprovalStatus": "Approved",
-            "SortBy": "CreationTime",
-            "MaxResults": 100,
-            "NextToken": "MORE1",
-        }
+
+def add_describe_responses(
+    stubber: Stubber,
+    versions: list,
+    describe_group: bool = True,
+    approval_status: str = "Approved",
+):
+    if describe_group:
+        expected_params = {"ModelPackageGroupName": "test-package-group"}
         expected_response = {
-            "ModelPackageSummaryList": [get_package(3)],
-            "NextToken": "MORE2",
-        }
-        stubber.add_response("list_model_packages", expected_response, expected_params)
-        # Version 2 with two more
-        expected_params = {
             "ModelPackageGroupName": "test-package-group",
-            "ModelApprovalStatus": "Approved",
-            "SortBy": "CreationTime",
-            "MaxResults": 100,
-            "NextToken": "MORE2",
+            "ModelPackageGroupArn": "arn:aws:sagemaker:REGION:ACCOUNT:model-package-group/test-package-group",
+            "CreationTime": datetime.fromtimestamp(0),
+            "CreatedBy": {},
+            "ModelPackageGroupStatus": "Completed",
         }
+        stubber.add_response(
+            "describe_model_package_group", expected_response, expected_params
+        )
+    for version in versions:
+        package = {**get_package(version), "ModelApprovalStatus": approval_status}
+        expected_params = {"ModelPackageName": package["ModelPackageArn"]}
         expected_response = {
-            "ModelPackageSummaryList": [
-                get_package(2),
-                get_package(1),
-            ],
+            **package,
+            "ModelPackageStatusDetails": {"ValidationStatuses": []},
+            "InferenceSpecification": {
+                "Containers": [
+                    {"Image": "test-image", "ModelDataUrl": f"s3://{version}"}
+                ],
+                "SupportedContentTypes": ["application/json"],
+                "SupportedResponseMIMETypes": ["application/json"],
+            },
         }
-        stubber.add_response("list_model_packages", expected_response, expected_params)
+        stubber.add_response(
+            "describe_model_package", expected_response, expected_params
+        )
+
+
+def test_get_versioned_approved_model_packages():
+    # Create model registry with a single worker so the stubbed responses are in order
+    registry = ModelRegistry(max_workers=1)
+
+    with Stubber(registry.sm_client) as stubber:
+        # Describe the group ARN, and then each unique version by ARN
+        add_describe_responses(stubber, [1, 2])
 
         # Get model versions
         response = registry.get_versioned_approved_packages(
             model_package_group_name="test-package-group",
-            model_package_versions=[1, 2],
+            model_package_versions=[2, 1, 2],
         )
-        # Expect to get two version
-        assert len(response) == 2
+        # Expect to get versions in order requested
         assert response == [
-            get_package(1),
-            get_package(2),
+            get_versioned_package(2),
+            get_versioned_package(1),
+            get_versioned_package(2),
         ]
 
 
+def test_get_cached_versioned_approved_model_packages(tmp_path):
+    cache_path = str(tmp_path / "cache" / "model_registry.json")
+    registry = ModelRegistry(cache_path=cache_path, max_workers=1)
+
+    with Stubber(registry.sm_client) as stubber:
+        add_describe_responses(stubber, [1])
+        registry.prefetch_versioned_packages({"test-package-group": [1]})
+        stubber.assert_no_pending_responses()
+
+        # Validate the prefetched package is reused in the same run without describing it again
+        response = registry.get_versioned_approved_packages("test-package-group", [1])
+        assert response == [get_versioned_package(1)]
+
+    # Validate a new registry gets the group ARN and container from the cache, and only describes the package status
+    registry = ModelRegistry(cache_path=cache_path, max_workers=1)
+    with Stubber(registry.sm_client) as stubber:
+        add_describe_responses(stubber, [1], describe_group=False)
+        response = registry.get_versioned_approved_packages("test-package-group", [1])
+        assert response == [get_versioned_package(1)]
+        container = registry.get_model_package_container(
+            get_package(1)["ModelPackageArn"]
+        )
+        assert container["ModelDataUrl"] == "s3://1"
+        stubber.assert_no_pending_responses()
+
+    # Validate a package rejected after it was cached is not returned
+    registry = ModelRegistry(cache_path=cache_path, max_workers=1)
+    with Stubber(registry.sm_client) as stubber:
+        add_describe_responses(
+            stubber, [1], describe_group=False, approval_status="Rejected"
+        )
+        with pytest.raises(Exception):
+            registry.get_versioned_approved_packages("test-package-group", [1])
+
+    # Validate the cache is not used after the ttl
+    registry = ModelRegistry(cache_path=cache_path, cache_ttl=-1)
+    assert registry.cache == {}
+
+
 def test_filter_package_version():
     """
     Select the sorted package versions.  Validate we return in the order we ask for.
@@ -316,3 +362,34 @@ def test_filter_package_version():
         get_package(3),
         get_package(2),
     ]
+
+
+def test_get_model_package_container():
+    # Create model registry
+    registry = ModelRegistry()
+
+    package = get_package(1)
+    container = {
+        "Image": "ACCOUNT.dkr.ecr.REGION.amazonaws.com/test-image:latest",
+        "ModelDataUrl": "s3://test-bucket/test-package-group/1/model.tar.gz",
+    }
+    with Stubber(registry.sm_client) as stubber:
+        expected_params = {"ModelPackageName": package["ModelPackageArn"]}
+        expected_response = {
+            "ModelPackageName": package["ModelPackageName"],
+            "ModelPackageArn": package["ModelPackageArn"],
+            "CreationTime": package["CreationTime"],
+            "ModelPackageStatus": package["ModelPackageStatus"],
+            "ModelPackageStatusDetails": {"ValidationStatuses": []},
+            "InferenceSpecification": {
+                "Containers": [container],
+                "SupportedContentTypes": ["application/json"],
+                "SupportedResponseMIMETypes": ["application/json"],
+            },
+        }
+        stubber.add_response(
+            "describe_model_package", expected_response, expected_params
+        )
+
+        response = registry.get_model_package_container(package["ModelPackageArn"])
+        assert response == container
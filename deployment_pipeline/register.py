@@ -40,6 +40,8 @@ with open(f"{stage_name}-config.json", "r") as f:
                     "ab-testing:strategy": j.get("strategy", "ThompsonSampling"),
                     "ab-testing:epsilon": str(j.get("epsilon", 0.1)),
                     "ab-testing:warmup": str(j.get("warmup", 0)),
+                    "ab-testing:auto-stop": str(j.get("auto_stop", False)).lower(),
+                    "ab-testing:reward-range": str(j.get("reward_range", 1.0)),
                 },
             },
         }
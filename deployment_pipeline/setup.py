@@ -17,8 +17,10 @@ setuptools.setup(
     install_requires=[
         "boto3>=1.17.54",
         "aws-cdk.core==1.94.1",
+        "aws-cdk.aws-applicationautoscaling==1.94.1",
         "aws-cdk.aws-iam==1.94.1",
         "aws-cdk.aws-sagemaker==1.94.1",
+        "aws-cdk.custom-resources==1.94.1",
     ],
     python_requires=">=3.6",
     classifiers=[
@@ -1,17 +1,47 @@
 from aws_cdk import (
     core,
     aws_apigateway,
+    aws_ec2,
     aws_iam,
     aws_events as events,
     aws_events_targets as targets,
+    aws_glue,
     aws_logs,
     aws_lambda,
     aws_dynamodb,
     aws_kinesisfirehose,
     aws_s3,
     aws_s3_notifications,
+    aws_secretsmanager,
+    aws_sns,
+    aws_sns_subscriptions,
 )
 
+# The archive columns and partition keys, which must match the schema in lambda/api/event_archive.py
+ARCHIVE_COLUMNS = [
+    ("timestamp", "bigint"),
+    ("type", "string"),
+    ("endpoint_name", "string"),
+    ("endpoint_variant", "string"),
+    ("target_variant", "string"),
+    ("assigned_variant", "string"),
+    ("strategy", "string"),
+    ("inference_id", "string"),
+    ("user_id", "string"),
+    ("reward", "double"),
+    ("attribution", "string"),
+    ("features", "array<double>"),
+    ("predictions", "string"),
+    ("source_ip", "string"),
+    ("user_agent", "string"),
+]
+ARCHIVE_PARTITION_KEYS = [
+    ("stage", "string"),
+    ("endpoint", "string"),
+    ("date", "string"),
+    ("hour", "string"),
+]
+
 
 class ApiStack(core.Stack):
     def __init__(
@@ -34,12 +64,38 @@ class ApiStack(core.Stack):
         dynamodb_read_capacity = self.node.try_get_context("dynamodb_read_capacity")
         dynamodb_write_capacity = self.node.try_get_context("dynamodb_write_capacity")
         delivery_sync = self.node.try_get_context("delivery_sync")
+        metrics_shards = self.node.try_get_context("metrics_shards") or 0
+        dedup_ttl_days = self.node.try_get_context("dedup_ttl_days")
+        attribution_window = self.node.try_get_context("attribution_window")
+        rollups_retention_days = self.node.try_get_context("rollups_retention_days")
+        assignment_ttl_days = self.node.try_get_context("assignment_ttl_days") or 90
+        assignment_cache_size = self.node.try_get_context("assignment_cache_size")
+        assignment_cache_ttl = self.node.try_get_context("assignment_cache_ttl") or 300
+        assignment_token_ttl = self.node.try_get_context("assignment_token_ttl")
+        storage_backend = self.node.try_get_context("storage_backend") or "dynamodb"
+        storage_url = self.node.try_get_context("storage_url")
+        storage_vpc_id = self.node.try_get_context("storage_vpc_id")
+        storage_subnet_ids = self.node.try_get_context("storage_subnet_ids") or []
+        storage_security_group_ids = (
+            self.node.try_get_context("storage_security_groups") or []
+        )
+        async_inference = self.node.try_get_context("async_inference")
+        async_retention_days = self.node.try_get_context("async_retention_days") or 7
+        archive_parquet = self.node.try_get_context("archive_parquet")
         firehose_interval = self.node.try_get_context("firehose_interval")
         firehose_mb_size = self.node.try_get_context("firehose_mb_size")
+        weights_interval = self.node.try_get_context("weights_interval")
+        reconcile_interval = self.node.try_get_context("reconcile_interval")
+        weights_min_weight = self.node.try_get_context("weights_min_weight")
+        weights_threshold = self.node.try_get_context("weights_threshold")
+        weights_scale_capacity = self.node.try_get_context("weights_scale_capacity")
 
         # Create dynamodb tables and kinesis stream per project
         assignment_table_name = f"{api_name}-assignment-{stage_name}"
         metrics_table_name = f"{api_name}-metrics-{stage_name}"
+        dedup_table_name = f"{api_name}-dedup-{stage_name}"
+        invocations_table_name = f"{api_name}-invocations-{stage_name}"
+        rollups_table_name = f"{api_name}-rollups-{stage_name}"
         delivery_stream_name = f"{api_name}-events-{stage_name}"
         log_stream_name = "ApiEvents"
 
@@ -73,15 +129,59 @@ class ApiStack(core.Stack):
             removal_policy=core.RemovalPolicy.DESTROY,
         )
 
+        # Create table to record processed metrics, which expire after the retry window
+        dedup_table = None
+        if dedup_ttl_days:
+            dedup_table = aws_dynamodb.Table(
+                self,
+                "DedupTable",
+                table_name=dedup_table_name,
+                partition_key=aws_dynamodb.Attribute(
+                    name="dedup_key", type=aws_dynamodb.AttributeType.STRING
+                ),
+                read_capacity=dynamodb_read_capacity,
+                write_capacity=dynamodb_write_capacity,
+                removal_policy=core.RemovalPolicy.DESTROY,
+                time_to_live_attribute="ttl",
+            )
+
+        # Create table for the variant counts in minute and hour buckets, which expire after the retention
+        rollups_table = None
+        if rollups_retention_days:
+            rollups_table = aws_dynamodb.Table(
+                self,
+                "RollupsTable",
+                table_name=rollups_table_name,
+                partition_key=aws_dynamodb.Attribute(
+                    name="endpoint_name", type=aws_dynamodb.AttributeType.STRING
+                ),
+                sort_key=aws_dynamodb.Attribute(
+                    name="rollup_key", type=aws_dynamodb.AttributeType.STRING
+                ),
+                read_capacity=dynamodb_read_capacity,
+                write_capacity=dynamodb_write_capacity,
+                removal_policy=core.RemovalPolicy.DESTROY,
+                time_to_live_attribute="ttl",
+            )
+
         # Create lambda layer for "aws-xray-sdk" and latest "boto3"
         xray_layer = aws_lambda.LayerVersion(
             self,
             "XRayLayer",
-            code=aws_lambda.AssetCode.from_asset("layers"),
+            code=aws_lambda.AssetCode.from_asset("layers", exclude=["parquet"]),
             compatible_runtimes=[aws_lambda.Runtime.PYTHON_3_7],
             description="A layer containing AWS X-Ray SDK for Python",
         )
 
+        # Store the assignments and counts in another backend, which the lambdas must have network access to
+        storage_environment, storage_network = self.get_storage_props(
+            storage_backend,
+            storage_url,
+            storage_vpc_id,
+            storage_subnet_ids,
+            storage_security_group_ids,
+        )
+
         # Create Lambda function to read from assignment and metrics table, log metrics
         # 2048MB is ~3% higher than 768 MB, it runs 2.5x faster
         # https://aws.amazon.com/blogs/aws/new-for-aws-lambda-functions-with-up-to-10-gb-of-memory-and-6-vcpus/
@@ -95,19 +195,37 @@ class ApiStack(core.Stack):
             memory_size=api_lambda_memory,
             environment={
                 "ASSIGNMENT_TABLE": assignment_table.table_name,
+                "ASSIGNMENT_TTL_DAYS": str(assignment_ttl_days),
                 "METRICS_TABLE": metrics_table.table_name,
                 "DELIVERY_STREAM_NAME": delivery_stream_name,
+                "METRICS_SHARDS": str(metrics_shards),
+                **storage_environment,
                 "DELIVERY_SYNC": "true" if delivery_sync else "false",
                 "LOG_LEVEL": log_level,
             },
             layers=[xray_layer],
             tracing=aws_lambda.Tracing.ACTIVE,
+            **storage_network,
         )
 
         # Grant read/write permissions to assignment and metrics tables
         assignment_table.grant_read_data(lambda_invoke)
         assignment_table.grant_write_data(lambda_invoke)
         metrics_table.grant_read_data(lambda_invoke)
+        if rollups_table is not None:
+            lambda_invoke.add_environment("ROLLUPS_TABLE", rollups_table.table_name)
+            lambda_invoke.add_environment(
+                "ROLLUPS_RETENTION_DAYS", str(rollups_retention_days)
+            )
+            rollups_table.grant_read_data(lambda_invoke)
+
+        # Cache assignments and return signed assignment tokens, so returning users skip the assignment table
+        self.add_assignment_options(
+            lambda_invoke,
+            assignment_cache_size,
+            assignment_cache_ttl,
+            assignment_token_ttl,
+        )
 
         # Add sagemaker invoke
         lambda_invoke.add_to_role_policy(
@@ -123,6 +241,12 @@ class ApiStack(core.Stack):
             )
         )
 
+        # Queue async invocations with inputs in S3, and log the metrics when notified of completion
+        if async_inference:
+            self.add_async_inference(
+                lambda_invoke, endpoint_prefix, async_retention_days
+            )
+
         # Create API Gateway for api lambda, which will create an output
         aws_apigateway.LambdaRestApi(
             self,
@@ -131,6 +255,8 @@ class ApiStack(core.Stack):
             deploy_options=aws_apigateway.StageOptions(stage_name=stage_name),
             proxy=True,
             handler=lambda_invoke,
+            # Allow binary passthrough responses for any content type
+            binary_media_types=["*/*"],
         )
 
         # Create lambda function for processing metrics
@@ -145,22 +271,26 @@ class ApiStack(core.Stack):
             environment={
                 "METRICS_TABLE": metrics_table.table_name,
                 "DELIVERY_STREAM_NAME": delivery_stream_name,
+                "METRICS_SHARDS": str(metrics_shards),
+                **storage_environment,
                 "STAGE_NAME": stage_name,
                 "LOG_LEVEL": log_level,
                 "ENDPOINT_PREFIX": endpoint_prefix,
             },
             layers=[xray_layer],
             tracing=aws_lambda.Tracing.ACTIVE,
+            **storage_network,
         )
 
-        # Add write metrics
-        metrics_table.grant_write_data(lambda_register)
+        # Add read metrics to check for existing registration, and write metrics
+        metrics_table.grant_read_write_data(lambda_register)
 
-        # Add sagemaker invoke
+        # Add sagemaker describe and list tags
         lambda_register.add_to_role_policy(
             aws_iam.PolicyStatement(
                 actions=[
                     "sagemaker:DescribeEndpoint",
+                    "sagemaker:ListTags",
                 ],
                 resources=[
                     "arn:aws:sagemaker:{}:{}:endpoint/{}*".format(
@@ -170,29 +300,49 @@ class ApiStack(core.Stack):
             )
         )
 
-        # Add endpoint event rule to register endpoints that are created or updated.
-        # Note CDK is unable to filter on resource prefixes, so we will need to filter on this within the RegisterLambda function.
-        # see: https://docs.aws.amazon.com/eventbridge/latest/userguide/eb-event-patterns-content-based-filtering.html#filtering-prefix-matching
-        endpoint_rule = events.Rule(
-            self,
-            "EndpointRule",
-            rule_name=f"sagemaker-{api_name}-endpoint-{stage_name}",
-            description="Rule to register an Amazon SageMaker Endpoint when it is created, updated or deleted.",
-            event_pattern=events.EventPattern(
-                source=["aws.sagemaker"],
-                detail_type=[
-                    "SageMaker Endpoint State Change",
-                ],
-                detail={
-                    "EndpointStatus": ["IN_SERVICE", "DELETING"],
-                },
-            ),
-            targets=[targets.LambdaFunction(lambda_register)],
+        # Register endpoints when their state changes, and reconcile all endpoints on a schedule
+        self.add_register_rules(
+            lambda_register, api_name, stage_name, reconcile_interval
         )
 
         # Return the register lambda function as output
         core.CfnOutput(self, "RegisterLambda", value=lambda_register.function_name)
 
+        # Create lambda function to periodically update endpoint weights from the bandit allocation
+        if weights_interval:
+            lambda_weights = aws_lambda.Function(
+                self,
+                "WeightsFunction",
+                code=aws_lambda.AssetCode.from_asset("lambda/api"),
+                handler="lambda_weights.lambda_handler",
+                runtime=aws_lambda.Runtime.PYTHON_3_7,
+                timeout=core.Duration.seconds(metrics_lambda_timeout),
+                memory_size=metrics_lambda_memory,
+                environment={
+                    "METRICS_TABLE": metrics_table.table_name,
+                    "DELIVERY_STREAM_NAME": delivery_stream_name,
+                    "METRICS_SHARDS": str(metrics_shards),
+                    **storage_environment,
+                    "LOG_LEVEL": log_level,
+                    "ENDPOINT_PREFIX": endpoint_prefix,
+                    "WEIGHTS_MIN_WEIGHT": str(weights_min_weight),
+                    "WEIGHTS_THRESHOLD": str(weights_threshold),
+                    "WEIGHTS_MIN_INTERVAL": str(weights_interval * 60),
+                    "WEIGHTS_SCALE_CAPACITY": (
+                        "true" if weights_scale_capacity else "false"
+                    ),
+                },
+                layers=[xray_layer],
+                tracing=aws_lambda.Tracing.ACTIVE,
+                **storage_network,
+            )
+
+            # Add read metrics, and write for rate limiting updates
+            metrics_table.grant_read_write_data(lambda_weights)
+            self.add_weights_update(
+                lambda_weights, api_name, stage_name, endpoint_prefix, weights_interval
+            )
+
         # Get cloudwatch put metrics policy ()
         cloudwatch_metric_policy = aws_iam.PolicyStatement(
             actions=["cloudwatch:PutMetricData"], resources=["*"]
@@ -201,6 +351,13 @@ class ApiStack(core.Stack):
         # If we are only using sync delivery, don't require firehose or s3 buckets
         if delivery_sync:
             metrics_table.grant_write_data(lambda_invoke)
+            self.add_metrics_tables(
+                lambda_invoke,
+                rollups_table,
+                rollups_retention_days,
+                dedup_table,
+                dedup_ttl_days,
+            )
             lambda_invoke.add_to_role_policy(cloudwatch_metric_policy)
             print("# No Firehose")
             return
@@ -295,14 +452,48 @@ class ApiStack(core.Stack):
             environment={
                 "METRICS_TABLE": metrics_table.table_name,
                 "DELIVERY_STREAM_NAME": delivery_stream_name,
+                "METRICS_SHARDS": str(metrics_shards),
+                **storage_environment,
                 "LOG_LEVEL": log_level,
             },
             layers=[xray_layer],
             tracing=aws_lambda.Tracing.ACTIVE,
+            **storage_network,
         )
 
-        # Add write metrics for dynamodb table
-        metrics_table.grant_write_data(lambda_metrics)
+        # Add read metrics to merge sharded counts, and write metrics for dynamodb table
+        metrics_table.grant_read_write_data(lambda_metrics)
+
+        # Add write to increment the time bucketed counts, and record processed objects and conversions
+        self.add_metrics_tables(
+            lambda_metrics,
+            rollups_table,
+            rollups_retention_days,
+            dedup_table,
+            dedup_ttl_days,
+        )
+
+        # Create table of recent invocations to attribute conversions to the invoked variant
+        if attribution_window:
+            invocations_table = aws_dynamodb.Table(
+                self,
+                "InvocationsTable",
+                table_name=invocations_table_name,
+                partition_key=aws_dynamodb.Attribute(
+                    name="inference_id", type=aws_dynamodb.AttributeType.STRING
+                ),
+                read_capacity=dynamodb_read_capacity,
+                write_capacity=dynamodb_write_capacity,
+                removal_policy=core.RemovalPolicy.DESTROY,
+                time_to_live_attribute="ttl",
+            )
+            lambda_metrics.add_environment(
+                "INVOCATIONS_TABLE", invocations_table.table_name
+            )
+            lambda_metrics.add_environment(
+                "ATTRIBUTION_WINDOW", str(attribution_window * 3600)
+            )
+            invocations_table.grant_read_write_data(lambda_metrics)
 
         # Add put metrics for cloudwatch
         lambda_metrics.add_to_role_policy(cloudwatch_metric_policy)
@@ -310,6 +501,340 @@ class ApiStack(core.Stack):
         # Allow metrics to read form S3 and write to DynamoDB
         s3_logs.grant_read(lambda_metrics)
 
-        # Create S3 logs notification for processing lambda
+        # Create S3 logs notification for processing lambda for the firehose prefix
         notification = aws_s3_notifications.LambdaDestination(lambda_metrics)
-        s3_logs.add_event_notification(aws_s3.EventType.OBJECT_CREATED, notification)
+        s3_logs.add_event_notification(
+            aws_s3.EventType.OBJECT_CREATED,
+            notification,
+            aws_s3.NotificationKeyFilter(prefix=f"{stage_name}/"),
+        )
+
+        # Archive the events as parquet files partitioned by stage, endpoint, date and hour
+        if archive_parquet:
+            self.add_parquet_archive(api_name, stage_name, s3_logs, lambda_metrics)
+
+    def get_storage_props(
+        self,
+        storage_backend: str,
+        storage_url: str,
+        vpc_id: str,
+        subnet_ids: list,
+        security_group_ids: list,
+    ):
+        """
+        Return the environment and the network properties for the lambdas to reach the storage backend.
+        The memory and sqlite backends are local to each lambda, so are only for tests and local runs.
+        """
+        if storage_backend == "dynamodb":
+            return {}, {}
+        if storage_backend != "redis":
+            raise Exception(
+                f"Storage backend {storage_backend} is only for tests and local runs, require dynamodb or redis"
+            )
+        if not storage_url or not vpc_id or len(subnet_ids) == 0:
+            raise Exception(
+                "Require storage_url, storage_vpc_id and storage_subnet_ids for the redis storage backend"
+            )
+        # The subnets require a NAT gateway or VPC endpoints for the lambdas to reach the AWS services
+        vpc = aws_ec2.Vpc.from_vpc_attributes(
+            self,
+            "StorageVpc",
+            vpc_id=vpc_id,
+            availability_zones=core.Fn.get_azs(),
+        )
+        subnets = [
+            aws_ec2.Subnet.from_subnet_id(self, f"StorageSubnet{i}", subnet_id)
+            for i, subnet_id in enumerate(subnet_ids)
+        ]
+        network = {
+            "vpc": vpc,
+            "vpc_subnets": aws_ec2.SubnetSelection(subnets=subnets),
+        }
+        if len(security_group_ids) > 0:
+            network["security_groups"] = [
+                aws_ec2.SecurityGroup.from_security_group_id(
+                    self, f"StorageSecurityGroup{i}", security_group_id
+                )
+                for i, security_group_id in enumerate(security_group_ids)
+            ]
+        environment = {"STORAGE_BACKEND": storage_backend, "STORAGE_URL": storage_url}
+        return environment, network
+
+    def add_assignment_options(
+        self,
+        lambda_invoke: aws_lambda.Function,
+        cache_size: int,
+        cache_ttl: int,
+        token_ttl: int,
+    ):
+        # Cache assignments for returning users in each warm lambda container
+        if cache_size:
+            lambda_invoke.add_environment("ASSIGNMENT_CACHE_SIZE", str(cache_size))
+            lambda_invoke.add_environment("ASSIGNMENT_CACHE_TTL", str(cache_ttl))
+
+        # Return signed assignment tokens, so clients that send them back skip the assignment table
+        if token_ttl:
+            token_secret = aws_secretsmanager.Secret(
+                self,
+                "AssignmentTokenSecret",
+                description="Secret to sign A/B testing assignment tokens.",
+                generate_secret_string=aws_secretsmanager.SecretStringGenerator(
+                    password_length=64, exclude_punctuation=True
+                ),
+            )
+            token_secret.grant_read(lambda_invoke)
+            lambda_invoke.add_environment(
+                "ASSIGNMENT_TOKEN_SECRET", token_secret.secret_arn
+            )
+            lambda_invoke.add_environment("ASSIGNMENT_TOKEN_TTL", str(token_ttl))
+
+    def add_register_rules(
+        self,
+        lambda_register: aws_lambda.Function,
+        api_name: str,
+        stage_name: str,
+        reconcile_interval: int,
+    ):
+        # Add endpoint event rule to register endpoints that are created or updated.
+        # Note CDK is unable to filter on resource prefixes, so we will need to filter on this within the
+        # RegisterLambda function.
+        # see: https://docs.aws.amazon.com/eventbridge/latest/userguide/eb-event-patterns-content-based-filtering.html
+        events.Rule(
+            self,
+            "EndpointRule",
+            rule_name=f"sagemaker-{api_name}-endpoint-{stage_name}",
+            description="Rule to register an Amazon SageMaker Endpoint when it is created, updated or deleted.",
+            event_pattern=events.EventPattern(
+                source=["aws.sagemaker"],
+                detail_type=[
+                    "SageMaker Endpoint State Change",
+                ],
+                detail={
+                    "EndpointStatus": ["IN_SERVICE", "DELETING"],
+                },
+            ),
+            targets=[targets.LambdaFunction(lambda_register)],
+        )
+
+        # Add schedule rule to reconcile all endpoints in case any state change events were missed
+        if reconcile_interval:
+            # List endpoints does not support resource level permissions
+            lambda_register.add_to_role_policy(
+                aws_iam.PolicyStatement(
+                    actions=["sagemaker:ListEndpoints"],
+                    resources=["*"],
+                )
+            )
+            events.Rule(
+                self,
+                "ReconcileRule",
+                rule_name=f"sagemaker-{api_name}-reconcile-{stage_name}",
+                description="Rule to reconcile the registered Amazon SageMaker Endpoints for A/B testing.",
+                schedule=events.Schedule.rate(
+                    core.Duration.minutes(reconcile_interval)
+                ),
+                targets=[targets.LambdaFunction(lambda_register)],
+            )
+
+    def add_weights_update(
+        self,
+        lambda_weights: aws_lambda.Function,
+        api_name: str,
+        stage_name: str,
+        endpoint_prefix: str,
+        weights_interval: int,
+    ):
+        # Add sagemaker describe and update weights
+        lambda_weights.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions=[
+                    "sagemaker:DescribeEndpoint",
+                    "sagemaker:UpdateEndpointWeightsAndCapacities",
+                ],
+                resources=[
+                    "arn:aws:sagemaker:{}:{}:endpoint/{}*".format(
+                        self.region, self.account, endpoint_prefix
+                    )
+                ],
+            )
+        )
+
+        # Add autoscaling describe to keep the instances within the variant min and max capacity
+        lambda_weights.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions=["application-autoscaling:DescribeScalableTargets"],
+                resources=["*"],
+            )
+        )
+
+        # Add schedule rule to update the weights
+        events.Rule(
+            self,
+            "WeightsRule",
+            rule_name=f"sagemaker-{api_name}-weights-{stage_name}",
+            description="Rule to update Amazon SageMaker Endpoint weights from the A/B testing allocation.",
+            schedule=events.Schedule.rate(core.Duration.minutes(weights_interval)),
+            targets=[targets.LambdaFunction(lambda_weights)],
+        )
+
+    def add_metrics_tables(
+        self,
+        function: aws_lambda.Function,
+        rollups_table: aws_dynamodb.Table,
+        rollups_retention_days: int,
+        dedup_table: aws_dynamodb.Table,
+        dedup_ttl_days: int,
+    ):
+        # Add write to increment the time bucketed counts
+        if rollups_table is not None:
+            function.add_environment("ROLLUPS_TABLE", rollups_table.table_name)
+            function.add_environment(
+                "ROLLUPS_RETENTION_DAYS", str(rollups_retention_days)
+            )
+            rollups_table.grant_write_data(function)
+
+        # Add write to record processed objects and conversions
+        if dedup_table is not None:
+            function.add_environment("DEDUP_TABLE", dedup_table.table_name)
+            function.add_environment("DEDUP_TTL_DAYS", str(dedup_ttl_days))
+            dedup_table.grant_read_write_data(function)
+
+    def add_async_inference(
+        self,
+        lambda_invoke: aws_lambda.Function,
+        endpoint_prefix: str,
+        retention_days: int,
+    ):
+        async_prefix = "async/"
+
+        # Create s3 bucket for the async inputs, requests and outputs, which expire after the retention
+        s3_async = aws_s3.Bucket(
+            self,
+            "S3Async",
+            removal_policy=core.RemovalPolicy.DESTROY,
+            lifecycle_rules=[
+                aws_s3.LifecycleRule(
+                    prefix=async_prefix,
+                    expiration=core.Duration.days(retention_days),
+                )
+            ],
+        )
+        s3_async.grant_read_write(lambda_invoke, f"{async_prefix}*")
+        lambda_invoke.add_environment("ASYNC_BUCKET", s3_async.bucket_name)
+        lambda_invoke.add_environment("ASYNC_PREFIX", async_prefix)
+
+        # Create the topic for the endpoint async inference notifications, which log the completed invocations
+        # see: https://docs.aws.amazon.com/sagemaker/latest/dg/async-inference-create-endpoint.html
+        async_topic = aws_sns.Topic(self, "AsyncInferenceTopic")
+        async_topic.add_subscription(
+            aws_sns_subscriptions.LambdaSubscription(lambda_invoke)
+        )
+
+        # Allow the endpoint execution role to read the inputs, write the outputs and publish notifications
+        sagemaker_role = aws_iam.Role.from_role_arn(
+            self,
+            "SageMakerRole",
+            f"arn:aws:iam::{self.account}:role/service-role/AmazonSageMakerServiceCatalogProductsUseRole",
+        )
+        s3_async.grant_read_write(sagemaker_role, f"{async_prefix}*")
+        async_topic.grant_publish(sagemaker_role)
+
+        # Add sagemaker invoke async
+        lambda_invoke.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions=[
+                    "sagemaker:InvokeEndpointAsync",
+                ],
+                resources=[
+                    "arn:aws:sagemaker:{}:{}:endpoint/{}*".format(
+                        self.region, self.account, endpoint_prefix
+                    )
+                ],
+            )
+        )
+
+        # Return the output path and topic for the endpoint async inference config
+        core.CfnOutput(
+            self,
+            "AsyncOutputPath",
+            value=f"s3://{s3_async.bucket_name}/{async_prefix}output/",
+        )
+        core.CfnOutput(self, "AsyncTopicArn", value=async_topic.topic_arn)
+
+    def add_parquet_archive(
+        self,
+        api_name: str,
+        stage_name: str,
+        s3_logs: aws_s3.Bucket,
+        lambda_metrics: aws_lambda.Function,
+    ):
+        archive_prefix = "archive/"
+
+        # Create lambda layer for "pyarrow" to write parquet files
+        parquet_layer = aws_lambda.LayerVersion(
+            self,
+            "ParquetLayer",
+            code=aws_lambda.AssetCode.from_asset("layers/parquet"),
+            compatible_runtimes=[aws_lambda.Runtime.PYTHON_3_7],
+            description="A layer containing Apache Arrow for Python",
+        )
+        lambda_metrics.add_layers(parquet_layer)
+        lambda_metrics.add_environment("ARCHIVE_BUCKET", s3_logs.bucket_name)
+        lambda_metrics.add_environment("ARCHIVE_PREFIX", archive_prefix)
+        lambda_metrics.add_environment("STAGE_NAME", stage_name)
+        s3_logs.grant_put(lambda_metrics, f"{archive_prefix}*")
+
+        # Create the glue table with partition projection, so new partitions can be queried without a crawler
+        # see: https://docs.aws.amazon.com/athena/latest/ug/partition-projection.html
+        database_name = f"{api_name}_{stage_name}".replace("-", "_")
+        database = aws_glue.CfnDatabase(
+            self,
+            "ArchiveDatabase",
+            catalog_id=self.account,
+            database_input=aws_glue.CfnDatabase.DatabaseInputProperty(
+                name=database_name,
+            ),
+        )
+        location = f"s3://{s3_logs.bucket_name}/{archive_prefix}"
+        table = aws_glue.CfnTable(
+            self,
+            "ArchiveTable",
+            catalog_id=self.account,
+            database_name=database_name,
+            table_input=aws_glue.CfnTable.TableInputProperty(
+                name="events",
+                table_type="EXTERNAL_TABLE",
+                parameters={
+                    "classification": "parquet",
+                    "projection.enabled": "true",
+                    "projection.stage.type": "enum",
+                    "projection.stage.values": stage_name,
+                    "projection.endpoint.type": "injected",
+                    "projection.date.type": "date",
+                    "projection.date.format": "yyyy-MM-dd",
+                    "projection.date.range": "2021-01-01,NOW",
+                    "projection.hour.type": "integer",
+                    "projection.hour.range": "0,23",
+                    "projection.hour.digits": "2",
+                    "storage.location.template": location
+                    + "stage=${stage}/endpoint=${endpoint}/date=${date}/hour=${hour}",
+                },
+                partition_keys=[
+                    aws_glue.CfnTable.ColumnProperty(name=name, type=column_type)
+                    for name, column_type in ARCHIVE_PARTITION_KEYS
+                ],
+                storage_descriptor=aws_glue.CfnTable.StorageDescriptorProperty(
+                    columns=[
+                        aws_glue.CfnTable.ColumnProperty(name=name, type=column_type)
+                        for name, column_type in ARCHIVE_COLUMNS
+                    ],
+                    location=location,
+                    input_format="org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+                    output_format="org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+                    serde_info=aws_glue.CfnTable.SerdeInfoProperty(
+                        serialization_library="org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe",
+                    ),
+                ),
+            ),
+        )
+        table.add_depends_on(database)
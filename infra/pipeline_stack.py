@@ -138,6 +138,8 @@ class PipelineStack(core.Stack):
                         "base-directory": "dist",
                         "files": ["*.template.json"],
                     },
+                    # Keep the model registry lookups for the next synth
+                    cache={"paths": [".cache/**/*"]},
                     environment=dict(
                         buildImage=codebuild.LinuxBuildImage.AMAZON_LINUX_2_3,
                     ),
@@ -153,7 +155,11 @@ class PipelineStack(core.Stack):
                 "STAGE_NAME": codebuild.BuildEnvironmentVariable(
                     value=stage_name.value_as_string
                 ),
+                "MODEL_REGISTRY_CACHE": codebuild.BuildEnvironmentVariable(
+                    value=".cache/model_registry.json"
+                ),
             },
+            cache=codebuild.Cache.local(codebuild.LocalCacheMode.CUSTOM),
         )
 
         source_output = codepipeline.Artifact()
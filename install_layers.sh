@@ -1,4 +1,9 @@
 # see: https://github.com/awsdocs/aws-lambda-developer-guide/tree/main/sample-apps/blank-python
 cd layers
 rm -rf ./python *.zip
-pip install -t ./python -r requirements.txt
\ No newline at end of file
+pip install -t ./python -r requirements.txt
+
+# Install the optional pyarrow layer for the parquet archive, with binaries for the lambda python runtime
+cd parquet
+rm -rf ./python *.zip
+pip install -t ./python -r requirements.txt --platform manylinux2014_x86_64 --python-version 3.7 --only-binary=:all:
@@ -1,9 +1,13 @@
 import random
 import math
 
-# Contains pure python class implementations for WeightedSampling, EpsilonGreedy, UCB1 and ThompsonSampling.
+# Contains pure python class implementations for WeightedSampling, EpsilonGreedy, UCB1, ThompsonSampling, LinUCB,
+# and the reward aware UCBV and GaussianThompsonSampling for continuous rewards.
+# The TopTwoThompsonSampling and SuccessiveElimination strategies are for best arm identification,
+# which minimize the samples required to identify the best variant rather than maximize the reward during the test.
 # For maths and theory behind these algorithms see the following resource:
 # https://lilianweng.github.io/lil-log/2018/01/23/the-multi-armed-bandit-problem-and-its-solutions.html#ucb1
+# For the contextual LinUCB algorithm see: https://arxiv.org/abs/1003.0146
 
 
 class AlgorithmBase:
@@ -17,6 +21,15 @@ class AlgorithmBase:
     def __init__(self, variant_metrics: list):
         pass
 
+    def get_allocation(self, samples: int = 1000):
+        """
+        Return the fraction of traffic allocated to each variant name, by sampling the variant selection
+        """
+        counts = dict([(v["variant_name"], 0) for v in self.variant_metrics])
+        for _ in range(samples):
+            counts[self.select_variant()] += 1
+        return dict([(k, 1.0 * c / samples) for k, c in counts.items()])
+
     @staticmethod
     def argmax(a):
         """
@@ -31,6 +44,55 @@ class AlgorithmBase:
         """
         return random.betavariate(alpha, beta)
 
+    @staticmethod
+    def random_normal_gamma(mu, kappa, alpha, beta):
+        """
+        Pure python sample of the mean from a Normal-Gamma distribution
+        """
+        precision = random.gammavariate(alpha, 1.0 / beta)
+        return random.gauss(mu, 1.0 / math.sqrt(kappa * precision))
+
+    @staticmethod
+    def reward_mean_variance(variant: dict):
+        """
+        Return the mean and (biased) variance of the reward per invocation from the sum and sum of squares
+        """
+        n = variant["invocation_count"]
+        mean = 1.0 * variant["reward_sum"] / n
+        variance = 1.0 * variant.get("reward_sum_squares", 0) / n - mean**2
+        return mean, max(variance, 0.0)
+
+    @staticmethod
+    def cholesky(a):
+        """
+        Pure python cholesky decomposition returning the lower triangular matrix for a positive definite matrix
+        """
+        n = len(a)
+        lower = [[0.0] * n for _ in range(n)]
+        for i in range(n):
+            for j in range(i + 1):
+                s = sum(lower[i][k] * lower[j][k] for k in range(j))
+                if i == j:
+                    lower[i][j] = math.sqrt(a[i][i] - s)
+                else:
+                    lower[i][j] = (a[i][j] - s) / lower[j][j]
+        return lower
+
+    @staticmethod
+    def cholesky_solve(lower, b):
+        """
+        Solve Ax = b given the lower triangular cholesky decomposition of A
+        """
+        n = len(b)
+        y = [0.0] * n
+        for i in range(n):
+            y[i] = (b[i] - sum(lower[i][k] * y[k] for k in range(i))) / lower[i][i]
+        x = [0.0] * n
+        for i in reversed(range(n)):
+            s = sum(lower[k][i] * x[k] for k in range(i + 1, n))
+            x[i] = (y[i] - s) / lower[i][i]
+        return x
+
 
 class WeightedSampling(AlgorithmBase):
     STRATEGY_NAME = "WeightedSampling"
@@ -119,7 +181,290 @@ class ThompsonSampling(AlgorithmBase):
         probs = []
         for v in self.variant_metrics:
             success = v["reward_sum"]
-            failure = v["invocation_count"] - success
+            # Clip the failures to zero, in case rewards are greater than 1 per invocation
+            failure = max(v["invocation_count"] - success, 0)
             probs.append(AlgorithmBase.random_beta(1 + success, 1 + failure))
         variant_index = AlgorithmBase.argmax(probs)
         return self.variant_metrics[variant_index]["variant_name"]
+
+
+class UCBV(AlgorithmBase):
+    STRATEGY_NAME = "UCBV"
+
+    def __init__(self, variant_metrics: list, reward_range: float = 1.0):
+        if len(variant_metrics) == 0:
+            raise Exception("Require at least one endpoint variant")
+        self.variant_metrics = variant_metrics
+        if reward_range <= 0:
+            raise Exception("Reward range must be a positive value")
+        self.reward_range = reward_range
+
+    def select_variant(self):
+        """
+        UCB-V extends UCB1 by using the empirical variance of the rewards in the curiosity bonus,
+        so variants with consistent rewards are explored less than variants with noisy rewards.
+        see: https://doi.org/10.1016/j.tcs.2009.01.016
+        """
+        invocation_total = sum([v["invocation_count"] for v in self.variant_metrics])
+        ucb_values = []
+        for v in self.variant_metrics:
+            n = float(v["invocation_count"])
+            mean, variance = AlgorithmBase.reward_mean_variance(v)
+            log_total = math.log(invocation_total)
+            curiosity_bonus = (
+                math.sqrt(2 * variance * log_total / n)
+                + 3 * self.reward_range * log_total / n
+            )
+            ucb_values.append(mean + curiosity_bonus)
+        variant_index = AlgorithmBase.argmax(ucb_values)
+        return self.variant_metrics[variant_index]["variant_name"]
+
+
+class GaussianThompsonSampling(AlgorithmBase):
+    STRATEGY_NAME = "GaussianThompsonSampling"
+
+    def __init__(self, variant_metrics: list):
+        if len(variant_metrics) == 0:
+            raise Exception("Require at least one endpoint variant")
+        self.variant_metrics = variant_metrics
+
+    def select_variant(self):
+        """
+        Gaussian Thompson sampling models continuous rewards (eg revenue) per invocation as a normal distribution with
+        unknown mean and precision, using the conjugate Normal-Gamma prior (mu=0, kappa=1, alpha=1, beta=1)
+        updated from the count, sum and sum of squares of rewards.
+        see: https://www.cs.ubc.ca/~murphyk/Papers/bayesGauss.pdf
+        """
+        samples = []
+        for v in self.variant_metrics:
+            n = v["invocation_count"]
+            mean, variance = AlgorithmBase.reward_mean_variance(v)
+            kappa = 1.0 + n
+            mu = n * mean / kappa
+            alpha = 1.0 + n / 2.0
+            beta = 1.0 + 0.5 * n * variance + n * mean**2 / (2.0 * kappa)
+            samples.append(AlgorithmBase.random_normal_gamma(mu, kappa, alpha, beta))
+        variant_index = AlgorithmBase.argmax(samples)
+        return self.variant_metrics[variant_index]["variant_name"]
+
+
+class BestArmIdentification(AlgorithmBase):
+    """
+    Base class for pure exploration strategies that estimate the samples required to make a decision
+    """
+
+    # Normal quantiles for a two sided 5% significance level and 80% power
+    Z_ALPHA = 1.959964
+    Z_POWER = 0.841621
+
+    def __init__(self, variant_metrics: list):
+        if len(variant_metrics) == 0:
+            raise Exception("Require at least one endpoint variant")
+        self.variant_metrics = variant_metrics
+
+    def samples_to_decision(self):
+        """
+        Estimate the additional invocations required for the best variant to be significantly better than every
+        other variant, using the normal approximation to the difference in mean rewards.
+        Returns None if there is not enough data to make an estimate or the means are equal.
+        """
+        if any(v["invocation_count"] == 0 for v in self.variant_metrics):
+            return None
+        stats = [AlgorithmBase.reward_mean_variance(v) for v in self.variant_metrics]
+        for i, v in enumerate(self.variant_metrics):
+            # Use the bernoulli variance if the sum of squares is not available
+            if v.get("reward_sum_squares", 0) == 0:
+                mean = min(max(stats[i][0], 0.0), 1.0)
+                stats[i] = (mean, mean * (1 - mean))
+        best = AlgorithmBase.argmax([mean for mean, _ in stats])
+        best_mean, best_variance = stats[best]
+        z_squared = (self.Z_ALPHA + self.Z_POWER) ** 2
+        required = [0.0] * len(stats)
+        for i, (mean, variance) in enumerate(stats):
+            if i == best:
+                continue
+            delta = best_mean - mean
+            if delta <= 0:
+                return None
+            required[i] = z_squared * (best_variance + variance) / delta**2
+        required[best] = max(required)
+        return int(
+            math.ceil(
+                sum(
+                    max(r - v["invocation_count"], 0)
+                    for r, v in zip(required, self.variant_metrics)
+                )
+            )
+        )
+
+
+class TopTwoThompsonSampling(BestArmIdentification):
+    STRATEGY_NAME = "TopTwoThompsonSampling"
+    MAX_RESAMPLES = 100
+
+    def __init__(self, variant_metrics: list, leader_probability: float = 0.5):
+        super().__init__(variant_metrics)
+        if leader_probability < 0 or leader_probability > 1:
+            raise Exception("Leader probability must be value between 0 and 1")
+        self.leader_probability = leader_probability
+
+    def sample_beta(self):
+        probs = []
+        for v in self.variant_metrics:
+            success = v["reward_sum"]
+            failure = max(v["invocation_count"] - success, 0)
+            probs.append(AlgorithmBase.random_beta(1 + success, 1 + failure))
+        return probs
+
+    def select_variant(self):
+        """
+        Top-two Thompson sampling picks the leader from a Thompson sample with the leader probability,
+        otherwise it resamples until a different variant wins, so the challenger gets enough samples to
+        confirm or refute the leader.
+        see: https://arxiv.org/abs/1602.08448
+        """
+        leader_index = AlgorithmBase.argmax(self.sample_beta())
+        if len(self.variant_metrics) == 1 or random.random() < self.leader_probability:
+            return self.variant_metrics[leader_index]["variant_name"]
+        for _ in range(self.MAX_RESAMPLES):
+            probs = self.sample_beta()
+            challenger_index = AlgorithmBase.argmax(probs)
+            if challenger_index != leader_index:
+                return self.variant_metrics[challenger_index]["variant_name"]
+        # Leader is clearly the best, so pick the runner up from the last sample
+        probs[leader_index] = -1
+        challenger_index = AlgorithmBase.argmax(probs)
+        return self.variant_metrics[challenger_index]["variant_name"]
+
+
+class SuccessiveElimination(BestArmIdentification):
+    STRATEGY_NAME = "SuccessiveElimination"
+
+    def __init__(self, variant_metrics: list, delta: float = 0.05):
+        super().__init__(variant_metrics)
+        if delta <= 0 or delta >= 1:
+            raise Exception("Delta must be value between 0 and 1")
+        self.delta = delta
+
+    def confidence_radius(self, n: int):
+        k = len(self.variant_metrics)
+        return math.sqrt(math.log(4.0 * k * n**2 / self.delta) / (2.0 * n))
+
+    def active_variants(self):
+        """
+        Return the variants with an upper confidence bound above the highest lower confidence bound
+        """
+        bounds = []
+        for v in self.variant_metrics:
+            mean = 1.0 * v["reward_sum"] / v["invocation_count"]
+            radius = self.confidence_radius(v["invocation_count"])
+            bounds.append((mean - radius, mean + radius))
+        best_lower = max(lower for lower, _ in bounds)
+        return [
+            v
+            for v, (_, upper) in zip(self.variant_metrics, bounds)
+            if upper >= best_lower
+        ]
+
+    def select_variant(self):
+        """
+        Successive elimination samples the remaining variants in a round robin, and eliminates any variant whose
+        upper confidence bound falls below the lower confidence bound of the best variant.
+        see: https://jmlr.org/papers/volume7/evendar06a/evendar06a.pdf
+        """
+        active = self.active_variants()
+        variant_index = AlgorithmBase.argmax([-v["invocation_count"] for v in active])
+        return active[variant_index]["variant_name"]
+
+
+class LinUCB(AlgorithmBase):
+    STRATEGY_NAME = "LinUCB"
+    MAX_FEATURES = 16
+
+    def __init__(self, variant_metrics: list, features: list, alpha: float = 1.0):
+        if len(variant_metrics) == 0:
+            raise Exception("Require at least one endpoint variant")
+        self.variant_metrics = variant_metrics
+        if features is None or len(features) == 0:
+            raise Exception("Require at least one context feature")
+        if len(features) > LinUCB.MAX_FEATURES:
+            raise Exception(f"Require at most {LinUCB.MAX_FEATURES} context features")
+        self.features = [float(x) for x in features]
+        if alpha < 0:
+            raise Exception("Alpha must be a positive value")
+        self.alpha = alpha
+
+    def select_variant(self):
+        """
+        LinUCB models the expected reward as linear in the request features, and keeps the sufficient statistics
+        A = I + sum(x * x^T) and b = sum(r * x) for each variant.  It selects the variant with the highest
+        upper confidence bound theta^T x + alpha * sqrt(x^T A^-1 x) where theta = A^-1 b.
+        """
+        x = self.features
+        d = len(x)
+        ucb_values = []
+        for v in self.variant_metrics:
+            context_a = v.get("context_a", [])
+            context_b = v.get("context_b", [])
+            # Use the ridge regularized matrix A = I + sum(x * x^T), treating missing statistics as zero
+            a = [[1.0 if i == j else 0.0 for j in range(d)] for i in range(d)]
+            for i, row in enumerate(context_a[:d]):
+                for j, value in enumerate(row[:d]):
+                    a[i][j] += value
+            b = [0.0] * d
+            for i, value in enumerate(context_b[:d]):
+                b[i] = value
+            lower = AlgorithmBase.cholesky(a)
+            theta = AlgorithmBase.cholesky_solve(lower, b)
+            a_inv_x = AlgorithmBase.cholesky_solve(lower, x)
+            mean = sum(t * f for t, f in zip(theta, x))
+            curiosity_bonus = self.alpha * math.sqrt(
+                max(sum(f * z for f, z in zip(x, a_inv_x)), 0.0)
+            )
+            ucb_values.append(mean + curiosity_bonus)
+        variant_index = AlgorithmBase.argmax(ucb_values)
+        return self.variant_metrics[variant_index]["variant_name"]
+
+
+def get_algorithm(
+    strategy: str,
+    variant_metrics: list,
+    epsilon: float,
+    features: list = None,
+    reward_range: float = 1.0,
+):
+    """
+    Return the algorithm instance for the strategy name
+    """
+    if strategy == WeightedSampling.STRATEGY_NAME:
+        return WeightedSampling(variant_metrics)
+    elif strategy == ThompsonSampling.STRATEGY_NAME:
+        return ThompsonSampling(variant_metrics)
+    elif strategy == EpsilonGreedy.STRATEGY_NAME:
+        return EpsilonGreedy(variant_metrics, epsilon)
+    elif strategy == UCB1.STRATEGY_NAME:
+        return UCB1(variant_metrics)
+    elif strategy == UCBV.STRATEGY_NAME:
+        return UCBV(variant_metrics, reward_range)
+    elif strategy == GaussianThompsonSampling.STRATEGY_NAME:
+        return GaussianThompsonSampling(variant_metrics)
+    elif strategy == TopTwoThompsonSampling.STRATEGY_NAME:
+        return TopTwoThompsonSampling(variant_metrics)
+    elif strategy == SuccessiveElimination.STRATEGY_NAME:
+        return SuccessiveElimination(variant_metrics)
+    elif strategy == LinUCB.STRATEGY_NAME:
+        return LinUCB(variant_metrics, features)
+    raise Exception(f"Strategy {strategy} not supported")
+
+
+STRATEGY_NAMES = [
+    WeightedSampling.STRATEGY_NAME,
+    EpsilonGreedy.STRATEGY_NAME,
+    UCB1.STRATEGY_NAME,
+    ThompsonSampling.STRATEGY_NAME,
+    UCBV.STRATEGY_NAME,
+    GaussianThompsonSampling.STRATEGY_NAME,
+    TopTwoThompsonSampling.STRATEGY_NAME,
+    SuccessiveElimination.STRATEGY_NAME,
+    LinUCB.STRATEGY_NAME,
+]
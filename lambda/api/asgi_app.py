@@ -0,0 +1,177 @@
+import asyncio
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+
+from passthrough import is_passthrough, get_passthrough_response
+
+# Contains an ASGI application that serves the invocation API routes from a long running process, sharing the
+# request handling, assignment cache and connection pools of lambda_invoke across concurrent requests.
+# Run with an ASGI server eg: uvicorn --factory asgi_app:create_app --host 0.0.0.0 --port 8080
+
+ROUTES = ["/invocation", "/conversion", "/stats"]
+# Limit the request body to the lambda payload size
+MAX_BODY_SIZE = 6 * 1024 * 1024
+# The number of proxies in front of the service that append to X-Forwarded-For, eg: the load balancer
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "1"))
+
+logger = logging.getLogger(__name__)
+
+
+def get_request_identity(scope: dict, trusted_proxy_count: int = TRUSTED_PROXY_COUNT):
+    """
+    Return the source ip and user agent for the request, using the forwarded address behind a load balancer.
+    Clients can send their own X-Forwarded-For, so use the address appended by the last trusted proxy.
+    """
+    headers = dict(
+        [(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]]
+    )
+    addresses = [
+        a.strip() for a in headers.get("x-forwarded-for", "").split(",") if a.strip()
+    ]
+    source_ip = None
+    if trusted_proxy_count > 0 and len(addresses) > 0:
+        source_ip = addresses[-min(trusted_proxy_count, len(addresses))]
+    if not source_ip and scope.get("client"):
+        source_ip = scope["client"][0]
+    return {"source_ip": source_ip, "user_agent": headers.get("user-agent")}
+
+
+async def read_body(receive):
+    """
+    Return the request body, or None if it exceeds the maximum size
+    """
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY_SIZE:
+            return None
+        if not message.get("more_body"):
+            return body
+
+
+async def send_body(send, status_code: int, headers: dict, body: bytes):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (k.lower().encode("latin-1"), v.encode("latin-1"))
+                for k, v in headers.items()
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, status_code: int, result: dict):
+    await send_body(
+        send,
+        status_code,
+        {"Content-Type": "application/json"},
+        json.dumps(result).encode(),
+    )
+
+
+async def handle_lifespan(receive, send, executor: ThreadPoolExecutor):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def handle_other(scope, send):
+    """
+    Return 404 for websocket and any other non http scopes, using the http response extension for websockets
+    """
+    if scope["type"] != "websocket":
+        return None
+    if "websocket.http.response" not in scope.get("extensions", {}):
+        return await send({"type": "websocket.close", "code": 1008})
+    await send(
+        {
+            "type": "websocket.http.response.start",
+            "status": 404,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send(
+        {
+            "type": "websocket.http.response.body",
+            "body": json.dumps({"message": "Not found"}).encode(),
+        }
+    )
+
+
+async def handle_http(scope, receive, send, executor: ThreadPoolExecutor, handle):
+    """
+    Validate the http request, and run the handler in the thread pool to return the json result
+    """
+    path = scope["path"]
+    if path == "/ping":
+        return await send_json(send, 200, {"status": "ok"})
+    if path not in ROUTES:
+        return await send_json(send, 404, {"message": f"Invalid path: {path}"})
+    if scope["method"] not in ["POST", "PUT"]:
+        return await send_json(send, 405, {"message": "Require HTTP POST"})
+    body = await read_body(receive)
+    if body is None:
+        return await send_json(send, 413, {"message": "Request body too large"})
+    try:
+        body = json.loads(body)
+        if not isinstance(body, dict):
+            raise Exception("Require HTTP POST with json body")
+        loop = asyncio.get_event_loop()
+        result, status_code = await loop.run_in_executor(
+            executor, handle, path, body, get_request_identity(scope)
+        )
+    except ClientError as e:
+        logger.error(e)
+        # Get boto3 specific error message
+        return await send_json(send, 500, {"message": e.response["Error"]["Message"]})
+    except Exception as e:
+        logger.error(e)
+        return await send_json(send, 400, {"message": str(e)})
+    if is_passthrough(result):
+        # Send the raw predictions with the experiment metadata in headers
+        headers, raw_predictions = get_passthrough_response(result)
+        return await send_body(send, status_code, headers, raw_predictions)
+    await send_json(send, status_code, result)
+
+
+def create_app(handle_request=None, log_metrics=None, max_workers: int = None):
+    """
+    Create the ASGI application, with the request handler and cache metrics logger from lambda_invoke by default.
+    The blocking AWS calls for each request run in a thread pool sized to the client connection pools.
+    """
+    if handle_request is None:
+        # Tracing is provided by the lambda runtime, so is disabled in the service
+        os.environ.setdefault("AWS_XRAY_SDK_ENABLED", "false")
+        import lambda_invoke
+
+        handle_request = lambda_invoke.handle_request
+        log_metrics = lambda_invoke.log_cache_metrics
+        max_workers = max_workers or lambda_invoke.MAX_POOL_CONNECTIONS
+    executor = ThreadPoolExecutor(max_workers=max_workers or 10)
+
+    def handle(path: str, body: dict, request_identity: dict):
+        result = handle_request(path, body, request_identity)
+        if log_metrics is not None:
+            log_metrics()
+        return result
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await handle_lifespan(receive, send, executor)
+        if scope["type"] != "http":
+            return await handle_other(scope, send)
+        return await handle_http(scope, receive, send, executor, handle)
+
+    return app
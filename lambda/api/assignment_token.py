@@ -0,0 +1,108 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+from time import time
+
+import boto3
+
+# Contains signed assignment tokens that clients return with each request, so the user variant can be
+# verified with the shared secret instead of reading the assignment table.
+# Tokens are bound to the user and endpoint, and include a version of the endpoint variant names,
+# so they are rejected once the variants change or the token expires.
+
+
+def encode(data: bytes):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def decode(data: str):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class AssignmentToken:
+    """
+    Class for creating and verifying HMAC signed user assignment tokens
+    """
+
+    # The truncated signature length in bytes
+    SIGNATURE_SIZE = 16
+
+    def __init__(self, secret: str, ttl_seconds: int = 86400):
+        if not secret:
+            raise Exception("Require secret to sign assignment tokens")
+        self.key = secret.encode("utf-8")
+        self.ttl_seconds = ttl_seconds
+
+    @classmethod
+    def from_secret(cls, secret_id: str, ttl_seconds: int = 86400):
+        """
+        Create the token signer with the secret string from Secrets Manager
+        """
+        sm_client = boto3.client("secretsmanager")
+        response = sm_client.get_secret_value(SecretId=secret_id)
+        return cls(response["SecretString"], ttl_seconds)
+
+    @staticmethod
+    def get_variants_version(variant_names: list):
+        """
+        Return a short hash of the endpoint variant names
+        """
+        names = ",".join(sorted(variant_names))
+        return hashlib.sha256(names.encode("utf-8")).hexdigest()[:8]
+
+    def sign(self, payload: bytes):
+        return hmac.new(self.key, payload, hashlib.sha256).digest()[
+            : self.SIGNATURE_SIZE
+        ]
+
+    def create_token(
+        self,
+        user_id: str,
+        endpoint_name: str,
+        variant_name: str,
+        variant_names: list,
+        expires_at: int = None,
+    ):
+        """
+        Return the signed token for the user endpoint variant
+        """
+        payload = json.dumps(
+            {
+                "u": user_id,
+                "e": endpoint_name,
+                "v": variant_name,
+                "s": self.get_variants_version(variant_names),
+                "x": expires_at or int(time()) + self.ttl_seconds,
+            },
+            separators=(",", ":"),
+        ).encode("utf-8")
+        return f"{encode(payload)}.{encode(self.sign(payload))}"
+
+    def verify_token(
+        self, token: str, user_id: str, endpoint_name: str, variant_names: list
+    ):
+        """
+        Return the variant name if the token signature is valid for the user, endpoint and variant names
+        and has not expired, otherwise None
+        """
+        try:
+            payload, signature = token.split(".")
+            payload = decode(payload)
+            if not hmac.compare_digest(self.sign(payload), decode(signature)):
+                logging.info(f"Invalid assignment token signature for user: {user_id}")
+                return None
+            claims = json.loads(payload)
+        except (AttributeError, ValueError) as e:
+            logging.info(f"Unable to decode assignment token: {e}")
+            return None
+        if (
+            claims.get("u") != user_id
+            or claims.get("e") != endpoint_name
+            or claims.get("s") != self.get_variants_version(variant_names)
+            or claims.get("x", 0) < time()
+        ):
+            logging.debug(f"Assignment token not valid for user: {user_id}")
+            return None
+        return claims.get("v")
@@ -0,0 +1,85 @@
+import boto3
+from botocore.exceptions import ClientError
+import json
+import logging
+
+# Contains the S3 locations for asynchronous invocations, which upload the input for the endpoint to process from
+# a queue, and store the experiment metadata until SageMaker publishes the completion notification to SNS.
+# see: https://docs.aws.amazon.com/sagemaker/latest/dg/async-inference.html
+
+
+class AsyncInference:
+    """
+    Class for storing the inputs and requests of asynchronous invocations, and reading their notifications
+    """
+
+    def __init__(self, bucket: str, prefix: str = "async/"):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = boto3.client("s3")
+
+    def get_location(self, key: str):
+        return f"s3://{self.bucket}/{key}"
+
+    def get_request_key(self, endpoint_name: str, inference_id: str):
+        return f"{self.prefix}requests/{endpoint_name}/{inference_id}.json"
+
+    def put_input(self, endpoint_name: str, inference_id: str, content_type: str, data):
+        """
+        Upload the input for the endpoint, returning the S3 location
+        """
+        key = f"{self.prefix}input/{endpoint_name}/{inference_id}"
+        logging.debug(f"Put async input: {key}")
+        self.s3.put_object(
+            Bucket=self.bucket, Key=key, Body=data, ContentType=content_type
+        )
+        return self.get_location(key)
+
+    def put_request(self, result: dict, request_identity: dict):
+        """
+        Store the invocation result and request identity to log the metric on completion
+        """
+        key = self.get_request_key(result["endpoint_name"], result["inference_id"])
+        logging.debug(f"Put async request: {key}")
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=json.dumps({"result": result, "request_identity": request_identity}),
+            ContentType="application/json",
+        )
+
+    def get_request(self, endpoint_name: str, inference_id: str):
+        """
+        Return the stored invocation result and request identity, or None if not found
+        """
+        key = self.get_request_key(endpoint_name, inference_id)
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=key)
+            return json.loads(response["Body"].read())
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise e
+            logging.warning(f"Async request not found: {key}")
+            return None
+
+    def delete_request(self, endpoint_name: str, inference_id: str):
+        """
+        Delete the stored request once the metric is logged, so a redelivered notification isn't logged again
+        """
+        key = self.get_request_key(endpoint_name, inference_id)
+        logging.debug(f"Delete async request: {key}")
+        self.s3.delete_object(Bucket=self.bucket, Key=key)
+
+    @staticmethod
+    def get_notifications(event: dict):
+        """
+        Return the inference result notifications from the SNS records in the event
+        """
+        notifications = []
+        for record in event.get("Records", []):
+            if record.get("EventSource") != "aws:sns":
+                continue
+            message = json.loads(record["Sns"]["Message"])
+            if message.get("eventName") == "InferenceResult":
+                notifications.append(message)
+        return notifications
@@ -0,0 +1,124 @@
+import io
+import json
+import logging
+from datetime import datetime
+from itertools import groupby
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Contains the schema and partitioning for archiving invocation and conversion events as parquet files,
+# so analytics and offline replay can read only the columns and partitions they require.
+# The pyarrow library is provided by an optional lambda layer when the archive is enabled.
+
+# The columns and types for the archived events, with partitions for stage, endpoint, date and hour
+SCHEMA = [
+    ("timestamp", "bigint"),
+    ("type", "string"),
+    ("endpoint_name", "string"),
+    ("endpoint_variant", "string"),
+    ("target_variant", "string"),
+    ("assigned_variant", "string"),
+    ("strategy", "string"),
+    ("inference_id", "string"),
+    ("user_id", "string"),
+    ("reward", "double"),
+    ("attribution", "string"),
+    ("features", "array<double>"),
+    ("predictions", "string"),
+    ("source_ip", "string"),
+    ("user_agent", "string"),
+]
+PARTITION_KEYS = [
+    ("stage", "string"),
+    ("endpoint", "string"),
+    ("date", "string"),
+    ("hour", "string"),
+]
+
+
+def get_partition(metric: dict):
+    """
+    Return the endpoint, date and hour partition values for the event timestamp in UTC
+    """
+    dt = datetime.utcfromtimestamp(int(metric["timestamp"]))
+    return metric["endpoint_name"], dt.strftime("%Y-%m-%d"), dt.strftime("%H")
+
+
+def get_column_value(metric: dict, name: str, column_type: str):
+    """
+    Return the event value converted to the column type, or None if not present
+    """
+    value = metric.get(name)
+    if value is None:
+        return None
+    if column_type == "bigint":
+        return int(value)
+    if column_type == "double":
+        return float(value)
+    if column_type == "array<double>":
+        return [float(v) for v in value]
+    # Nested values such as predictions are stored as json strings
+    if not isinstance(value, str):
+        return json.dumps(value)
+    return value
+
+
+def get_columns(metrics: list):
+    """
+    Return the dictionary of column name to list of values for the events
+    """
+    return dict(
+        [
+            (name, [get_column_value(m, name, column_type) for m in metrics])
+            for name, column_type in SCHEMA
+        ]
+    )
+
+
+class EventArchive:
+    """
+    Class for writing events to partitioned parquet files in S3
+    """
+
+    PYARROW_TYPES = {
+        "bigint": lambda: pyarrow.int64(),
+        "double": lambda: pyarrow.float64(),
+        "string": lambda: pyarrow.string(),
+        "array<double>": lambda: pyarrow.list_(pyarrow.float64()),
+    }
+
+    def __init__(self, s3_bucket, prefix: str, stage_name: str):
+        if pyarrow is None:
+            raise Exception("Require pyarrow layer to archive events as parquet")
+        self.s3_bucket = s3_bucket
+        self.prefix = prefix
+        self.stage_name = stage_name
+        self.schema = pyarrow.schema(
+            [(name, self.PYARROW_TYPES[t]()) for name, t in SCHEMA]
+        )
+
+    def get_key(self, endpoint_name: str, date: str, hour: str, name: str):
+        return (
+            f"{self.prefix}stage={self.stage_name}/endpoint={endpoint_name}/"
+            f"date={date}/hour={hour}/{name}.parquet"
+        )
+
+    def write_events(self, metrics: list, name: str):
+        """
+        Write a parquet file per partition named after the source, so retries overwrite rather than duplicate
+        """
+        keys = []
+        metrics = sorted(metrics, key=get_partition)
+        for (endpoint_name, date, hour), pg in groupby(metrics, get_partition):
+            table = pyarrow.Table.from_pydict(get_columns(list(pg)), schema=self.schema)
+            buf = io.BytesIO()
+            pyarrow.parquet.write_table(table, buf, compression="snappy")
+            key = self.get_key(endpoint_name, date, hour, name)
+            self.s3_bucket.put_object(Key=key, Body=buf.getvalue())
+            logging.debug(f"Archived {table.num_rows} events to: {key}")
+            keys.append(key)
+        return keys
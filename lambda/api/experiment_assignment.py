@@ -1,11 +1,97 @@
-import boto3
+from collections import OrderedDict
 from datetime import datetime, timedelta
+import logging
+import threading
+from time import time
+
+from experiment_storage import ExperimentStorage, DynamoDBStorage
 
 
 def get_ttl(days=90):
     return int((datetime.utcnow() + timedelta(days=days)).timestamp())
 
 
+class AssignmentCache:
+    """
+    Class for caching user assignments in memory with least recently used eviction and a time to live
+    """
+
+    def __init__(self, max_size: int = 10000, ttl_seconds: int = 300):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Lock for sharing the cache between request threads in the service
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_variants_key(variant_names: list):
+        """
+        Return the key for the endpoint variant set, so assignments are invalidated when it changes
+        """
+        if variant_names is None:
+            return None
+        return tuple(sorted(variant_names))
+
+    def get(self, user_id: str, endpoint_name: str, variant_names: list = None):
+        """
+        Return the cached variant if not expired and the endpoint variants are unchanged, otherwise None
+        """
+        key = (user_id, endpoint_name)
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                variant_name, variants_key, expires_at = item
+                if expires_at > time() and variants_key == self.get_variants_key(
+                    variant_names
+                ):
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return variant_name
+                del self.items[key]
+            self.misses += 1
+            return None
+
+    def put(
+        self,
+        user_id: str,
+        endpoint_name: str,
+        variant_name: str,
+        variant_names: list = None,
+    ):
+        """
+        Put the variant for the user, evicting the least recently used if the cache is full
+        """
+        key = (user_id, endpoint_name)
+        with self.lock:
+            self.items[key] = (
+                variant_name,
+                self.get_variants_key(variant_names),
+                time() + self.ttl_seconds,
+            )
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def get_stats(self, reset: bool = False):
+        """
+        Return the hits, misses and hit rate, optionally resetting the counts
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total > 0 else 0.0,
+                "size": len(self.items),
+            }
+            if reset:
+                self.hits = 0
+                self.misses = 0
+            return stats
+
+
 class ExperimentAssignment:
     """
     Class for managing experiments
@@ -14,37 +100,76 @@ class ExperimentAssignment:
     def __init__(
         self,
         assignment_table: str,
+        ttl_days: int = 90,
+        refresh_days: int = 7,
+        cache: AssignmentCache = None,
+        storage: ExperimentStorage = None,
     ):
         self.assignment_table = assignment_table
-        self.dynamodb = boto3.resource("dynamodb")
-        self.ddb_client = boto3.client("dynamodb")
-
-    def get_assignment(self, user_id: str, endpoint_name: str):
-        table = self.dynamodb.Table(self.assignment_table)
-        response = table.get_item(
-            Key={
-                "user_id": user_id,
-                "endpoint_name": endpoint_name,
-            },
-            AttributesToGet=["variant_name"],
+        # Assignments expire after the ttl, and are extended for returning users within the refresh days of expiry
+        self.ttl_days = ttl_days
+        self.refresh_days = refresh_days
+        # Optional cache for returning users served by the same container
+        self.cache = cache
+        # Assignments are stored in the DynamoDB table unless another storage backend is provided
+        self.storage = storage or DynamoDBStorage(assignment_table)
+
+    def get_assignment(
+        self, user_id: str, endpoint_name: str, variant_names: list = None
+    ):
+        """
+        Get the user endpoint variant, extending the time to live if the assignment is near expiry.
+        The cached variant is returned if the endpoint variant names are unchanged
+        """
+        if self.cache is not None:
+            variant_name = self.cache.get(user_id, endpoint_name, variant_names)
+            if variant_name is not None:
+                return variant_name
+        item = self.storage.get_assignment(user_id, endpoint_name)
+        if item is None:
+            return None
+        variant_name = item["variant_name"]
+        if item["ttl"] is not None and item["ttl"] < get_ttl(self.refresh_days):
+            self.refresh_assignment(user_id, endpoint_name, variant_name)
+        if self.cache is not None:
+            self.cache.put(user_id, endpoint_name, variant_name, variant_names)
+        return variant_name
+
+    def refresh_assignment(
+        self, user_id: str, endpoint_name: str, variant_name: str, ttl: int = None
+    ):
+        """
+        Extend the time to live if the user is still assigned the variant and it is near expiry,
+        returning False if the assignment has changed or was already refreshed
+        """
+        refreshed = self.storage.refresh_assignment(
+            user_id,
+            endpoint_name,
+            variant_name,
+            ttl if ttl is not None else get_ttl(self.ttl_days),
+            get_ttl(self.refresh_days),
         )
-        if "Item" in response:
-            return response["Item"]["variant_name"]
-        return None
+        if refreshed:
+            logging.debug(f"Refreshed assignment for user: {user_id}")
+        return refreshed
 
     def put_assignment(
-        self, user_id: str, endpoint_name: str, variant_name: str, ttl=get_ttl()
+        self,
+        user_id: str,
+        endpoint_name: str,
+        variant_name: str,
+        ttl: int = None,
+        variant_names: list = None,
     ):
         """
         Put the user endpoint variant with a time to live
         """
-        table = self.dynamodb.Table(self.assignment_table)
-        response = table.put_item(
-            Item={
-                "user_id": user_id,
-                "endpoint_name": endpoint_name,
-                "variant_name": variant_name,
-                "ttl": ttl,
-            }
+        response = self.storage.put_assignment(
+            user_id,
+            endpoint_name,
+            variant_name,
+            ttl if ttl is not None else get_ttl(self.ttl_days),
         )
+        if self.cache is not None:
+            self.cache.put(user_id, endpoint_name, variant_name, variant_names)
         return response
@@ -0,0 +1,135 @@
+from botocore.exceptions import ClientError
+import json
+import logging
+
+from thread_local import ThreadLocalResource
+
+
+class ExperimentAttribution:
+    """
+    Class for joining conversions to the variant of the invocation that caused them by inference id
+    """
+
+    dynamodb = ThreadLocalResource("dynamodb")
+
+    def __init__(self, invocations_table: str, attribution_window: int = 86400):
+        self.invocations_table = invocations_table
+        # The maximum seconds between an invocation and its conversion
+        self.attribution_window = attribution_window
+
+    def get_ttl(self, timestamp: int):
+        # Keep the invocation for the window after it was made, plus a day for late files
+        return int(timestamp) + self.attribution_window + 86400
+
+    def is_attributable(self, invocation: dict, conversion: dict):
+        """
+        Return true if the conversion is within the attribution window of the invocation
+        """
+        delta = int(conversion["timestamp"]) - int(invocation["timestamp"])
+        return (
+            invocation["endpoint_name"] == conversion["endpoint_name"]
+            and delta <= self.attribution_window
+        )
+
+    @staticmethod
+    def attribute(invocation: dict, conversion: dict):
+        """
+        Return the conversion credited to the invoked variant, keeping the variant assigned at conversion
+        """
+        return {
+            **conversion,
+            "assigned_variant": conversion["endpoint_variant"],
+            "endpoint_variant": invocation["endpoint_variant"],
+        }
+
+    def put_invocation(self, invocation: dict):
+        """
+        Record the invoked variant, returning any conversions that arrived before the invocation.
+        The pending conversions are kept until their counts are applied, so they are returned again on retry.
+        """
+        table = self.dynamodb.Table(self.invocations_table)
+        response = table.update_item(
+            Key={"inference_id": invocation["inference_id"]},
+            UpdateExpression="SET endpoint_name = :e, endpoint_variant = :v, #timestamp = :t, #ttl = :ttl",
+            ExpressionAttributeNames={"#timestamp": "timestamp", "#ttl": "ttl"},
+            ExpressionAttributeValues={
+                ":e": invocation["endpoint_name"],
+                ":v": invocation["endpoint_variant"],
+                ":t": int(invocation["timestamp"]),
+                ":ttl": self.get_ttl(invocation["timestamp"]),
+            },
+            ReturnValues="ALL_OLD",
+        )
+        pending = response.get("Attributes", {}).get("pending_conversions", [])
+        return [json.loads(c) for c in pending]
+
+    def remove_pending(self, inference_ids: list):
+        """
+        Remove the pending conversions once their counts have been applied to the invoked variant
+        """
+        table = self.dynamodb.Table(self.invocations_table)
+        for inference_id in inference_ids:
+            table.update_item(
+                Key={"inference_id": inference_id},
+                UpdateExpression="REMOVE pending_conversions",
+            )
+
+    def put_conversion(self, conversion: dict):
+        """
+        Return the invocation for the conversion, or None if the conversion was added as pending its invocation
+        """
+        table = self.dynamodb.Table(self.invocations_table)
+        try:
+            table.update_item(
+                Key={"inference_id": conversion["inference_id"]},
+                UpdateExpression="SET pending_conversions = "
+                "list_append(if_not_exists(pending_conversions, :empty), :c), "
+                "#ttl = if_not_exists(#ttl, :ttl)",
+                ConditionExpression="attribute_not_exists(endpoint_variant)",
+                ExpressionAttributeNames={"#ttl": "ttl"},
+                ExpressionAttributeValues={
+                    ":empty": [],
+                    ":c": [json.dumps(conversion)],
+                    ":ttl": self.get_ttl(conversion["timestamp"]),
+                },
+            )
+            return None
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise e
+        # The invocation has been recorded, so get the invoked variant
+        response = table.get_item(Key={"inference_id": conversion["inference_id"]})
+        return response["Item"]
+
+    def join_metrics(self, metrics: list):
+        """
+        Return the invocations, and the conversions attributed to the invoked variant within the attribution window.
+        Conversions that arrive before their invocation are held until the invocation is processed, so the inference
+        ids of the pending conversions are also returned to be removed once the counts are applied.
+        """
+        joined_metrics = []
+        pending_ids = []
+        # Process invocations first so conversions in the same batch are attributed immediately
+        for m in sorted(metrics, key=lambda m: m["type"] != "invocation"):
+            if m["type"] == "invocation" and "inference_id" in m:
+                joined_metrics.append(m)
+                pending = self.put_invocation(m)
+                if len(pending) > 0:
+                    pending_ids.append(m["inference_id"])
+                for c in pending:
+                    if self.is_attributable(m, c):
+                        joined_metrics.append(self.attribute(m, c))
+            elif m["type"] == "conversion" and m.get("attribution") == "inference_id":
+                invocation = self.put_conversion(m)
+                if invocation is None:
+                    logging.debug(f"Pending conversion for: {m['inference_id']}")
+                elif self.is_attributable(invocation, m):
+                    joined_metrics.append(self.attribute(invocation, m))
+                else:
+                    logging.info(
+                        f"Conversion outside attribution window: {m['inference_id']}"
+                    )
+            else:
+                # Conversions without an inference id are credited to the assigned variant
+                joined_metrics.append(m)
+        return joined_metrics, pending_ids
@@ -0,0 +1,115 @@
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta
+import logging
+
+from thread_local import ThreadLocalResource
+
+
+def get_ttl(days=7):
+    return int((datetime.utcnow() + timedelta(days=days)).timestamp())
+
+
+class ExperimentDedup:
+    """
+    Class for recording processed metrics, so counts are only applied once for at-least-once delivery
+    """
+
+    dynamodb = ThreadLocalResource("dynamodb")
+
+    def __init__(self, dedup_table: str, ttl_days: int = 7):
+        self.dedup_table = dedup_table
+        self.ttl_days = ttl_days
+
+    @staticmethod
+    def get_object_key(bucket: str, key: str):
+        return f"s3://{bucket}/{key}"
+
+    @staticmethod
+    def get_conversion_key(endpoint_name: str, inference_id: str):
+        return f"conversion#{endpoint_name}#{inference_id}"
+
+    @staticmethod
+    def get_async_key(endpoint_name: str, inference_id: str):
+        return f"async#{endpoint_name}#{inference_id}"
+
+    def mark_processed(self, dedup_key: str, ttl: int = None, source: str = None):
+        """
+        Record the key with a conditional put, returning False if it has already been processed.
+        Keys recorded with a source can be recorded again by the same source, so a retry keeps its keys.
+        """
+        table = self.dynamodb.Table(self.dedup_table)
+        item = {"dedup_key": dedup_key, "ttl": ttl or get_ttl(self.ttl_days)}
+        args = {"ConditionExpression": "attribute_not_exists(dedup_key)"}
+        if source is not None:
+            item["source"] = source
+            args = {
+                "ConditionExpression": "attribute_not_exists(dedup_key) OR #source = :source",
+                "ExpressionAttributeNames": {"#source": "source"},
+                "ExpressionAttributeValues": {":source": source},
+            }
+        try:
+            table.put_item(Item=item, **args)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise e
+
+    def is_processed(self, dedup_key: str):
+        """
+        Return True if the key has been recorded
+        """
+        table = self.dynamodb.Table(self.dedup_table)
+        response = table.get_item(Key={"dedup_key": dedup_key}, ConsistentRead=True)
+        return "Item" in response
+
+    def update_item_once(self, write_key: str, update: dict, ttl: int = None):
+        """
+        Apply the update item arguments with the table name, and record the write key in a single transaction,
+        returning False if the write key has already been recorded so the update was applied before
+        """
+        try:
+            self.dynamodb.meta.client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Put": {
+                            "TableName": self.dedup_table,
+                            "Item": {
+                                "dedup_key": write_key,
+                                "ttl": ttl or get_ttl(self.ttl_days),
+                            },
+                            "ConditionExpression": "attribute_not_exists(dedup_key)",
+                        }
+                    },
+                    {"Update": update},
+                ]
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "TransactionCanceledException":
+                raise e
+            reasons = [r.get("Code") for r in e.response.get("CancellationReasons", [])]
+            if reasons[:1] == ["ConditionalCheckFailed"]:
+                return False
+            raise e
+
+    def filter_conversions(self, metrics: list, ttl: int = None, source: str = None):
+        """
+        Return the metrics without duplicate conversions for the same endpoint and inference id.
+        The conversions are recorded for the source, so they are kept if the same source is retried.
+        """
+        filtered_metrics = []
+        dedup_keys = set()
+        for m in metrics:
+            if m["type"] == "conversion" and "inference_id" in m:
+                dedup_key = self.get_conversion_key(
+                    m["endpoint_name"], m["inference_id"]
+                )
+                if dedup_key in dedup_keys or not self.mark_processed(
+                    dedup_key, ttl, source
+                ):
+                    logging.info(f"Skipping duplicate conversion: {dedup_key}")
+                    continue
+                dedup_keys.add(dedup_key)
+            filtered_metrics.append(m)
+        return filtered_metrics
@@ -1,24 +1,61 @@
 import boto3
+from botocore.exceptions import ClientError
 from decimal import Decimal
 from itertools import groupby
 import json
 import logging
+import random
 from time import time
 from datetime import datetime
 
+from algorithm import LinUCB
+from experiment_dedup import ExperimentDedup, get_ttl
+from experiment_stats import ExperimentStats
+from experiment_rollups import ExperimentRollups
+from experiment_storage import ExperimentStorage
+from thread_local import ThreadLocalResource
+
 
 class ExperimentMetrics:
     """
     Class for getting and updating experiment metrics
     """
 
+    dynamodb = ThreadLocalResource("dynamodb")
+
+    # BatchGetItem is limited to 100 keys including the endpoint item
+    MAX_SHARDS = 99
+    # The minimum seconds between reading the merged totals of an endpoint to check for a winner
+    WINNER_CHECK_INTERVAL = 60
+
     def __init__(
-        self, metrics_table: str, delivery_stream_name: str, synchronous: bool = False
+        self,
+        metrics_table: str,
+        delivery_stream_name: str,
+        synchronous: bool = False,
+        metrics_shards: int = 0,
+        rollups: ExperimentRollups = None,
+        storage: ExperimentStorage = None,
+        dedup: ExperimentDedup = None,
     ):
         self.metrics_table = metrics_table
         self.delivery_stream_name = delivery_stream_name
         self.synchronous = synchronous
-        self.dynamodb = boto3.resource("dynamodb")
+        # Optionally spread the counter updates across shard items to avoid a hot partition
+        if metrics_shards < 0 or metrics_shards > self.MAX_SHARDS:
+            raise Exception(f"Metrics shards must be between 0 and {self.MAX_SHARDS}")
+        self.metrics_shards = metrics_shards
+        # Optionally increment the counts in time buckets for the history of each variant
+        self.rollups = rollups
+        self.winner_checked_at = {}
+        # Optionally increment the counts in a storage backend, instead of the endpoint or shard items
+        self.storage = (
+            storage if storage is not None and storage.stores_counts else None
+        )
+        if self.storage is not None and metrics_shards > 0:
+            raise Exception("Metrics shards are not supported with a storage backend")
+        # Optionally apply each write once for the source of the metrics, so a retried source isn't counted twice
+        self.dedup = dedup
         self.ddb_client = boto3.client("dynamodb")
         self.firehose = boto3.client("firehose")
         self.cloudwatch = boto3.client("cloudwatch")
@@ -30,9 +67,27 @@ class ExperimentMetrics:
         strategy: str,
         epsilon: float,
         warmup: int,
-        timestamp: int = int(time()),
+        timestamp: int = None,
+        auto_stop: bool = False,
+        reward_range: float = 1.0,
     ):
         logging.debug(f"Get metrics for endpoint: {endpoint_name}")
+        if timestamp is None:
+            timestamp = int(time())
+        # Merge with an existing registration to preserve the counts for variants that are kept
+        item = self.get_endpoint_item(endpoint_name)
+        if item is not None and "deleted_at" not in item and "variant_names" in item:
+            return self.merge_variant_metrics(
+                item,
+                endpoint_variants,
+                strategy,
+                epsilon,
+                warmup,
+                timestamp,
+                auto_stop,
+                reward_range,
+            )
+
         table = self.dynamodb.Table(self.metrics_table)
         # Format variants as a dictionary for persistence with only the initial weight
         variant_names = [v["variant_name"] for v in endpoint_variants]
@@ -49,6 +104,10 @@ class ExperimentMetrics:
                 for v in endpoint_variants
             ]
         )
+        # Contextual strategies require an empty map to add the sufficient statistics to
+        if strategy == LinUCB.STRATEGY_NAME:
+            for v in variant_metrics.values():
+                v["context"] = {}
         logging.debug(variant_metrics)
         response = table.put_item(
             Item={
@@ -58,19 +117,151 @@ class ExperimentMetrics:
                 "variant_metrics": variant_metrics,
                 "epsilon": Decimal(str(epsilon)),
                 "warmup": warmup,
+                "auto_stop": auto_stop,
+                "reward_range": Decimal(str(reward_range)),
                 "created_at": timestamp,
             },
             ReturnValues="ALL_OLD",
             ReturnConsumedCapacity="TOTAL",
         )
+        # Reset the counts for any previous registration
+        if self.storage is not None:
+            self.storage.delete_counts(endpoint_name)
+        if self.metrics_shards > 0:
+            with table.batch_writer() as batch:
+                for shard in range(self.metrics_shards):
+                    batch.delete_item(
+                        Key={"endpoint_name": self.get_shard_key(endpoint_name, shard)}
+                    )
         return response
 
+    def merge_variant_metrics(
+        self,
+        item: dict,
+        endpoint_variants: list,
+        strategy: str,
+        epsilon: float,
+        warmup: int,
+        timestamp: int,
+        auto_stop: bool,
+        reward_range: float = 1.0,
+    ):
+        """
+        Update the registration keeping the counts for existing variants, adding new variants,
+        and archiving the metrics for removed variants
+        """
+        endpoint_name = item["endpoint_name"]
+        variant_metrics = item["variant_metrics"]
+        variant_names = [v["variant_name"] for v in endpoint_variants]
+        removed_names = [v for v in item["variant_names"] if v not in variant_names]
+        logging.info(
+            f"Merging endpoint: {endpoint_name} variants: {variant_names} removing: {removed_names}"
+        )
+
+        set_actions = [
+            "variant_names = :variant_names",
+            "strategy = :strategy",
+            "epsilon = :epsilon",
+            "warmup = :warmup",
+            "auto_stop = :auto_stop",
+            "reward_range = :reward_range",
+        ]
+        remove_actions = []
+        names = {}
+        values = {
+            ":variant_names": variant_names,
+            ":strategy": strategy,
+            ":epsilon": Decimal(str(epsilon)),
+            ":warmup": warmup,
+            ":auto_stop": auto_stop,
+            ":reward_range": Decimal(str(reward_range)),
+            ":previous_names": item["variant_names"],
+        }
+        for i, v in enumerate(endpoint_variants):
+            names[f"#v{i}"] = v["variant_name"]
+            weight = Decimal(str(v["initial_variant_weight"]))
+            if v["variant_name"] not in variant_metrics:
+                values[f":v{i}"] = {"initial_variant_weight": weight}
+                set_actions.append(f"variant_metrics.#v{i} = :v{i}")
+                continue
+            values[f":w{i}"] = weight
+            set_actions.append(f"variant_metrics.#v{i}.initial_variant_weight = :w{i}")
+        # Contextual strategies require an empty map to add the sufficient statistics to
+        if strategy == LinUCB.STRATEGY_NAME:
+            values[":context"] = {}
+            for i, v in enumerate(endpoint_variants):
+                if v["variant_name"] not in variant_metrics:
+                    values[f":v{i}"]["context"] = {}
+                else:
+                    set_actions.append(
+                        f"variant_metrics.#v{i}.context = if_not_exists(variant_metrics.#v{i}.context, :context)"
+                    )
+        # Archive the removed variants with the time they were removed
+        if len(removed_names) > 0:
+            archived_variants = item.get("archived_variants", {})
+            for i, v in enumerate(removed_names):
+                names[f"#r{i}"] = v
+                remove_actions.append(f"variant_metrics.#r{i}")
+                archived_variants[v] = {**variant_metrics[v], "archived_at": timestamp}
+            values[":archived_variants"] = archived_variants
+            set_actions.append("archived_variants = :archived_variants")
+        # Restart a stopped experiment if the variants have changed
+        if set(variant_names) != set(item["variant_names"]):
+            remove_actions += ["winner", "stopped_at"]
+
+        table = self.dynamodb.Table(self.metrics_table)
+        # Fail if the variants were changed by another registration since the item was read
+        response = table.update_item(
+            Key={"endpoint_name": endpoint_name},
+            UpdateExpression="SET "
+            + ", ".join(set_actions)
+            + (" REMOVE " + ", ".join(remove_actions) if remove_actions else ""),
+            ConditionExpression="variant_names = :previous_names",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues="UPDATED_NEW",
+        )
+        self.remove_shard_variants(endpoint_name, removed_names)
+        return response
+
+    def remove_shard_variants(self, endpoint_name: str, variant_names: list):
+        """
+        Remove the counts for the variants from each shard, which have been archived in the endpoint item
+        """
+        if self.storage is not None and len(variant_names) > 0:
+            self.storage.delete_counts(endpoint_name, variant_names)
+        if self.metrics_shards == 0 or len(variant_names) == 0:
+            return
+        table = self.dynamodb.Table(self.metrics_table)
+        prefixes = tuple(f"{v}#" for v in variant_names)
+        for shard in range(self.metrics_shards):
+            key = {"endpoint_name": self.get_shard_key(endpoint_name, shard)}
+            # Get the count and contextual statistics attributes for the variants in this shard
+            shard_item = table.get_item(Key=key).get("Item", {})
+            names = dict(
+                [
+                    (f"#a{i}", k)
+                    for i, k in enumerate(
+                        [k for k in shard_item if k.startswith(prefixes)]
+                    )
+                ]
+            )
+            if len(names) == 0:
+                continue
+            table.update_item(
+                Key=key,
+                UpdateExpression="REMOVE " + ", ".join(names.keys()),
+                ExpressionAttributeNames=names,
+            )
+
     def delete_endpoint(
         self,
         endpoint_name: str,
-        timestamp: int = int(time()),
+        timestamp: int = None,
     ):
         logging.debug(f"Delete endpoint: {endpoint_name}")
+        if timestamp is None:
+            timestamp = int(time())
         table = self.dynamodb.Table(self.metrics_table)
         # Set the deleted_at property in DDB for this endpoint
         response = table.update_item(
@@ -83,26 +274,226 @@ class ExperimentMetrics:
         )
         return response
 
+    def update_variant_weights(self, endpoint_name: str, endpoint_variants: list):
+        """
+        Update the initial weight for existing variants, preserving the metrics
+        """
+        logging.debug(f"Update variant weights for endpoint: {endpoint_name}")
+        table = self.dynamodb.Table(self.metrics_table)
+        names = dict(
+            [(f"#v{i}", v["variant_name"]) for i, v in enumerate(endpoint_variants)]
+        )
+        values = dict(
+            [
+                (f":w{i}", Decimal(str(v["initial_variant_weight"])))
+                for i, v in enumerate(endpoint_variants)
+            ]
+        )
+        response = table.update_item(
+            Key={"endpoint_name": endpoint_name},
+            UpdateExpression="SET "
+            + ", ".join(
+                [
+                    f"variant_metrics.#v{i}.initial_variant_weight = :w{i}"
+                    for i in range(len(endpoint_variants))
+                ]
+            ),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues="UPDATED_NEW",
+        )
+        return response
+
+    def get_registered_endpoints(self):
+        """
+        Return the list of endpoint names that are registered and not deleted
+        """
+        return [
+            item["endpoint_name"]
+            for item in self.get_registered_items(["endpoint_name"])
+        ]
+
+    def get_registered_items(self, attributes: list):
+        """
+        Return the list of items with the attributes for endpoints that are registered and not deleted
+        """
+        table = self.dynamodb.Table(self.metrics_table)
+        # Shard items don't have the variant names
+        args = {
+            "ProjectionExpression": ", ".join(
+                [f"#a{i}" for i in range(len(attributes))]
+            ),
+            "ExpressionAttributeNames": dict(
+                [(f"#a{i}", a) for i, a in enumerate(attributes)]
+            ),
+            "FilterExpression": "attribute_not_exists(deleted_at) AND attribute_exists(variant_names)",
+        }
+        items = []
+        while True:
+            response = table.scan(**args)
+            items += response["Items"]
+            if "LastEvaluatedKey" not in response:
+                return items
+            args = {**args, "ExclusiveStartKey": response["LastEvaluatedKey"]}
+
+    def update_weights_updated_at(
+        self, endpoint_name: str, min_interval: int, timestamp: int = None
+    ):
+        """
+        Set the time the endpoint weights were updated, returning False if updated within the minimum interval
+        """
+        if timestamp is None:
+            timestamp = int(time())
+        table = self.dynamodb.Table(self.metrics_table)
+        try:
+            table.update_item(
+                Key={"endpoint_name": endpoint_name},
+                UpdateExpression="SET weights_updated_at = :now ",
+                ConditionExpression="attribute_not_exists(weights_updated_at) OR weights_updated_at < :min",
+                ExpressionAttributeValues={
+                    ":now": timestamp,
+                    ":min": timestamp - min_interval,
+                },
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise e
+
+    def clear_weights_updated_at(self, endpoint_name: str, timestamp: int):
+        """
+        Remove the time the endpoint weights were updated if still set to the timestamp, so a failed update
+        doesn't rate limit the next update
+        """
+        table = self.dynamodb.Table(self.metrics_table)
+        try:
+            table.update_item(
+                Key={"endpoint_name": endpoint_name},
+                UpdateExpression="REMOVE weights_updated_at",
+                ConditionExpression="weights_updated_at = :now",
+                ExpressionAttributeValues={":now": timestamp},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise e
+
     def get_variant_metrics(self, endpoint_name):
         """
         Return the strategy and the list of varints, with the counts defaulted to zero if not exist
         """
-        table = self.dynamodb.Table(self.metrics_table)
-        response = table.get_item(
-            Key={
-                "endpoint_name": endpoint_name,
-            },
-            ReturnConsumedCapacity="TOTAL",
+        endpoint_metrics = self.get_endpoint_metrics(endpoint_name)
+        return (
+            endpoint_metrics["strategy"],
+            endpoint_metrics["epsilon"],
+            endpoint_metrics["warmup"],
+            endpoint_metrics["variant_metrics"],
         )
+
+    def get_endpoint_metrics(self, endpoint_name):
+        """
+        Return the endpoint configuration, list of variants and winner if the experiment has been stopped
+        """
         # Return the list of invocation and success counts per variant
-        if "Item" not in response:
+        item = self.get_endpoint_item(endpoint_name)
+        if item is None:
             raise Exception(f"Endpoint {endpoint_name} not found")
 
-        strategy = response["Item"]["strategy"]
-        epsilon = float(response["Item"]["epsilon"])
-        warmup = int(response["Item"]["warmup"])
-        variant_names = response["Item"]["variant_names"]
-        variant_metrics = response["Item"]["variant_metrics"]
+        return {
+            "endpoint_name": endpoint_name,
+            "strategy": item["strategy"],
+            "epsilon": float(item["epsilon"]),
+            "warmup": int(item["warmup"]),
+            "auto_stop": bool(item.get("auto_stop", False)),
+            "reward_range": float(item.get("reward_range", 1)),
+            "winner": item.get("winner"),
+            "stopped_at": int(item["stopped_at"]) if "stopped_at" in item else None,
+            "deleted_at": int(item["deleted_at"]) if "deleted_at" in item else None,
+            "variant_metrics": self.get_variant_list(endpoint_name, item),
+        }
+
+    @staticmethod
+    def get_shard_key(endpoint_name: str, shard: int):
+        """
+        Return the metrics table key for a shard of the endpoint counts
+        """
+        return f"{endpoint_name}#shard{shard}"
+
+    def get_endpoint_item(self, endpoint_name: str):
+        """
+        Return the endpoint item with the counts merged from any shards, or None if not found
+        """
+        if self.metrics_shards == 0:
+            table = self.dynamodb.Table(self.metrics_table)
+            response = table.get_item(
+                Key={
+                    "endpoint_name": endpoint_name,
+                },
+                ReturnConsumedCapacity="TOTAL",
+            )
+            item = response.get("Item")
+            if item is None or self.storage is None:
+                return item
+            return self.merge_shard_items(
+                item, [self.get_storage_counts(endpoint_name)]
+            )
+
+        # Get the endpoint and shard items in a single batch, retrying any unprocessed keys
+        keys = [{"endpoint_name": endpoint_name}] + [
+            {"endpoint_name": self.get_shard_key(endpoint_name, shard)}
+            for shard in range(self.metrics_shards)
+        ]
+        request_items = {self.metrics_table: {"Keys": keys}}
+        items = []
+        while len(request_items) > 0:
+            response = self.dynamodb.batch_get_item(RequestItems=request_items)
+            items += response["Responses"].get(self.metrics_table, [])
+            request_items = response.get("UnprocessedKeys", {})
+
+        item = next((i for i in items if i["endpoint_name"] == endpoint_name), None)
+        if item is None:
+            return None
+        return self.merge_shard_items(
+            item, [i for i in items if i["endpoint_name"] != endpoint_name]
+        )
+
+    def get_storage_counts(self, endpoint_name: str):
+        """
+        Return the counts from the storage backend as decimals, to add to the counts in the endpoint item
+        """
+        counts = self.storage.get_counts(endpoint_name)
+        return dict([(k, Decimal(str(v))) for k, v in counts.items()])
+
+    @staticmethod
+    def merge_shard_items(item: dict, shard_items: list):
+        """
+        Add the counts stored as {variant_name}#{count} attributes in shard items to the endpoint variant metrics,
+        and the contextual statistics stored as {variant_name}#context_{key} attributes
+        """
+        variant_metrics = item["variant_metrics"]
+        for shard_item in shard_items:
+            for key, value in shard_item.items():
+                if "#" not in key:
+                    continue
+                variant_name, count_name = key.rsplit("#", 1)
+                if variant_name not in variant_metrics:
+                    continue
+                metrics = variant_metrics[variant_name]
+                if count_name.startswith("context_"):
+                    # Only merge the contextual statistics for variants registered with a contextual strategy
+                    if "context" in metrics:
+                        k = count_name[len("context_") :]
+                        metrics["context"][k] = metrics["context"].get(k, 0) + value
+                else:
+                    metrics[count_name] = metrics.get(count_name, 0) + value
+        return item
+
+    def get_variant_list(self, endpoint_name: str, item: dict):
+        """
+        Return the list of variants from the metrics item in order of variant names
+        """
+        variant_names = item["variant_names"]
+        variant_metrics = item["variant_metrics"]
         metrics = [
             {
                 "endpoint_name": endpoint_name,
@@ -113,10 +504,90 @@ class ExperimentMetrics:
                 "invocation_count": int(variant_metrics[v].get("invocation_count", 0)),
                 "conversion_count": int(variant_metrics[v].get("conversion_count", 0)),
                 "reward_sum": float(variant_metrics[v].get("reward_sum", 0)),
+                "reward_sum_squares": float(
+                    variant_metrics[v].get("reward_sum_squares", 0)
+                ),
             }
             for v in variant_names
         ]
-        return strategy, epsilon, warmup, metrics
+        # Add the contextual statistics if they have been recorded
+        for m in metrics:
+            context = variant_metrics[m["variant_name"]].get("context")
+            if context is not None:
+                m["context_a"], m["context_b"] = self.get_context_matrix(context)
+        return metrics
+
+    @staticmethod
+    def get_context_matrix(context: dict):
+        """
+        Return the symmetric A matrix and b vector from the upper triangle stored as a_i_j and b_i keys
+        """
+        d = 0
+        for key in context:
+            d = max([d] + [int(i) + 1 for i in key.split("_")[1:]])
+        context_a = [[0.0] * d for _ in range(d)]
+        context_b = [0.0] * d
+        for key, value in context.items():
+            parts = key.split("_")
+            if parts[0] == "a":
+                i, j = int(parts[1]), int(parts[2])
+                context_a[i][j] = context_a[j][i] = float(value)
+            elif parts[0] == "b":
+                context_b[int(parts[1])] = float(value)
+        return context_a, context_b
+
+    @staticmethod
+    def get_context_deltas(metrics: list):
+        """
+        Return the sums to add to the upper triangle of A for invocations, and b for rewarded conversions
+        """
+        deltas = {}
+        for m in metrics:
+            features = m.get("features")
+            if not features:
+                continue
+            x = [float(f) for f in features[: LinUCB.MAX_FEATURES]]
+            if m["type"] == "invocation":
+                for i in range(len(x)):
+                    for j in range(i, len(x)):
+                        key = f"a_{i}_{j}"
+                        deltas[key] = deltas.get(key, 0.0) + x[i] * x[j]
+            elif m["type"] == "conversion":
+                for i in range(len(x)):
+                    key = f"b_{i}"
+                    deltas[key] = deltas.get(key, 0.0) + m["reward"] * x[i]
+        return deltas
+
+    def update_variant_context(
+        self, endpoint_name: str, variant_name: str, deltas: dict, write_key: str = None
+    ):
+        """
+        Increment the contextual statistics for a variant, logging a warning if the endpoint isn't contextual
+        """
+        try:
+            response = self.update_item(
+                self.metrics_table,
+                {
+                    "Key": {"endpoint_name": endpoint_name},
+                    "UpdateExpression": "ADD "
+                    + ", ".join(
+                        [f"variant_metrics.#variant.context.{k} :{k}" for k in deltas]
+                    ),
+                    "ConditionExpression": "attribute_exists(variant_metrics.#variant.context)",
+                    "ExpressionAttributeNames": {"#variant": variant_name},
+                    "ExpressionAttributeValues": dict(
+                        [(f":{k}", Decimal(str(v))) for k, v in deltas.items()]
+                    ),
+                },
+                write_key,
+            )
+            logging.debug(response)
+            return response
+        except ClientError as e:
+            logging.warning(
+                f"Unable to update context for endpoint: {endpoint_name}, variant: {variant_name}"
+            )
+            logging.warning(e)
 
     def put_cloudwatch_metric(
         self,
@@ -124,8 +595,10 @@ class ExperimentMetrics:
         endpoint_name: str,
         variant_name: str,
         metric_value: float,
-        dt: datetime = datetime.now(),
+        dt: datetime = None,
     ):
+        if dt is None:
+            dt = datetime.now()
         logging.debug(
             f"Putting metric: {metric_value} for {metric_name} on endpoint: {endpoint_name}, variant: variant_name at {dt}"
         )
@@ -149,89 +622,417 @@ class ExperimentMetrics:
         )
         logging.debug(response)
 
-    def update_variant_metrics(self, metrics: list, timestamp=int(time())):
+    def put_variant_cloudwatch_metrics(
+        self,
+        endpoint_name: str,
+        variant_name: str,
+        invocation_count: int,
+        conversion_count: int,
+        reward_sum: float,
+        dt: datetime,
+    ):
         """
-        Group by endpoint variants and metric type to increment dynamodb counts
+        Put the invocation, conversion and reward metrics for the variant if there are any counts,
+        logging a warning on failure so the update isn't retried once the counts are applied
         """
-        table = self.dynamodb.Table(self.metrics_table)
+        try:
+            if invocation_count > 0:
+                self.put_cloudwatch_metric(
+                    "Invocations", endpoint_name, variant_name, invocation_count, dt
+                )
+            if conversion_count > 0:
+                self.put_cloudwatch_metric(
+                    "Conversions", endpoint_name, variant_name, conversion_count, dt
+                )
+                self.put_cloudwatch_metric(
+                    "Rewards", endpoint_name, variant_name, reward_sum, dt
+                )
+        except ClientError as e:
+            logging.warning(
+                f"Unable to put cloudwatch metrics for endpoint: {endpoint_name}, variant: {variant_name}"
+            )
+            logging.warning(e)
+
+    @staticmethod
+    def get_metric_totals(metrics: list):
+        """
+        Return the invocation count, conversion count, reward sum and reward sum of squares for the metrics
+        """
+        invocation_count = 0
+        conversion_count = 0
+        reward_sum = 0.0
+        reward_sum_squares = 0.0
+        for m in metrics:
+            if m["type"] == "invocation":
+                invocation_count += 1
+            elif m["type"] == "conversion":
+                conversion_count += 1
+                reward_sum += m["reward"]
+                reward_sum_squares += m["reward"] ** 2
+            else:
+                raise Exception("Unsupported type {}".format(m["type"]))
+        return invocation_count, conversion_count, reward_sum, reward_sum_squares
+
+    def update_variant_metrics(
+        self, metrics: list, timestamp: int = None, source: str = None
+    ):
+        """
+        Group by endpoint variants and metric type to increment dynamodb counts. If the source of the metrics is
+        provided with dedup, each write is applied once so a retry of the same source doesn't count it twice.
+        """
+        if timestamp is None:
+            timestamp = int(time())
 
         # Sort the list by endpoint_name and variant_name first to ensure groupby is efficient
         metrics = sorted(
             metrics, key=lambda m: (m["endpoint_name"], m["endpoint_variant"])
         )
 
-        responses = []
+        updated_variants = []
         for (endpoint_name, variant_name), vg in groupby(
             metrics, lambda m: (m["endpoint_name"], m["endpoint_variant"])
         ):
             # Get the total invocation and rewards
-            invocation_count = 0
-            conversion_count = 0
-            reward_sum = 0.0
-            for m in vg:
-                if m["type"] == "invocation":
-                    invocation_count += 1
-                elif m["type"] == "conversion":
-                    conversion_count += 1
-                    reward_sum += m["reward"]
-                else:
-                    raise Exception("Unsupported type {}".format(m["type"]))
+            vg = list(vg)
+            (
+                invocation_count,
+                conversion_count,
+                reward_sum,
+                reward_sum_squares,
+            ) = self.get_metric_totals(vg)
             logging.debug(
                 f"Update metrics for endpoint: {endpoint_name}, variant: {variant_name} invocations: {invocation_count}, conversions: {conversion_count}, rewards: {reward_sum}"
             )
-            # Update variant in dynamo db with these counts
-            response = table.update_item(
-                Key={"endpoint_name": endpoint_name},
-                UpdateExpression="ADD variant_metrics.#variant.invocation_count :i, "
+            values = {
+                ":i": int(invocation_count),
+                ":c": int(conversion_count),
+                ":r": Decimal(str(reward_sum)),
+                ":s": Decimal(str(reward_sum_squares)),
+                ":now": timestamp,
+            }
+            # Update the contextual statistics if any metrics include features
+            context_deltas = self.get_context_deltas(vg)
+            write_key = self.get_write_key(source, endpoint_name, variant_name)
+            item = self.update_counts(
+                endpoint_name, variant_name, values, context_deltas, write_key
+            )
+
+            # Update the time bucketed counts for the metrics timestamps
+            if self.rollups is not None:
+                self.update_rollups(
+                    endpoint_name, variant_name, vg, timestamp, write_key
+                )
+
+            if item is None:
+                logging.info(f"Skipping counts already applied for: {write_key}")
+                continue
+            updated_variants.append((endpoint_name, variant_name, item))
+
+            # Put cloudwatch metrics against this timestamp
+            self.put_variant_cloudwatch_metrics(
+                endpoint_name,
+                variant_name,
+                invocation_count,
+                conversion_count,
+                reward_sum,
+                datetime.fromtimestamp(timestamp),
+            )
+
+        # Return total counts per endpoint_name and endpoint_variant, or the counts added if the totals weren't read
+        # The updates don't return the totals if they are merged from other items, or applied with a write key
+        merged = self.merges_counts or (source is not None and self.dedup is not None)
+        endpoint_items = self.get_updated_items(updated_variants, merged)
+        responses = []
+        for endpoint_name, variant_name, item in updated_variants:
+            endpoint_item = endpoint_items.get(endpoint_name, {})
+            if merged and "variant_metrics" in endpoint_item:
+                item = endpoint_item
+            responses.append(self.get_variant_counts(endpoint_name, variant_name, item))
+
+        # Check for a winner with the latest totals returned for each endpoint
+        for endpoint_name, item in endpoint_items.items():
+            self.update_experiment_winner(endpoint_name, item, timestamp)
+
+        return responses
+
+    @staticmethod
+    def get_variant_counts(endpoint_name: str, variant_name: str, item: dict):
+        """
+        Return the total counts for a variant from the endpoint item
+        """
+        metrics = item.get("variant_metrics", {}).get(variant_name, {})
+        return {
+            "endpoint_name": endpoint_name,
+            "endpoint_variant": variant_name,
+            "invocation_count": metrics.get("invocation_count", 0),
+            "conversion_count": metrics.get("conversion_count", 0),
+            "reward_sum": metrics.get("reward_sum", 0.0),
+            "reward_sum_squares": metrics.get("reward_sum_squares", 0.0),
+        }
+
+    @property
+    def merges_counts(self):
+        """
+        Return True if the counts are stored outside the endpoint item, and merged when read
+        """
+        return self.metrics_shards > 0 or self.storage is not None
+
+    @staticmethod
+    def get_added_item(variant_name: str, values: dict):
+        """
+        Return an item with the counts added for a variant, for when the totals are merged from other items
+        """
+        return {
+            "variant_metrics": {
+                variant_name: {
+                    "invocation_count": values[":i"],
+                    "conversion_count": values[":c"],
+                    "reward_sum": values[":r"],
+                    "reward_sum_squares": values[":s"],
+                }
+            }
+        }
+
+    def update_counts(
+        self,
+        endpoint_name: str,
+        variant_name: str,
+        values: dict,
+        context_deltas: dict = None,
+        write_key: str = None,
+    ):
+        """
+        Increment the counts and contextual statistics for a variant in the storage backend, a random shard or
+        the endpoint item, returning the updated endpoint item or the counts added if the totals are merged or
+        the write key is applied. Returns None if the counts have already been applied for the write key.
+        """
+        added_item = self.get_added_item(variant_name, values)
+        if self.metrics_shards > 0:
+            # Update a random shard including the contextual statistics, so no writes go to the endpoint item
+            response = self.update_shard_metrics(
+                endpoint_name, variant_name, values, context_deltas, write_key
+            )
+            logging.debug(response)
+            return None if response is None else added_item
+        if self.storage is not None:
+            applied = self.storage.increment_counts(
+                endpoint_name,
+                variant_name,
+                {
+                    "invocation_count": values[":i"],
+                    "conversion_count": values[":c"],
+                    "reward_sum": float(values[":r"]),
+                    "reward_sum_squares": float(values[":s"]),
+                },
+                write_key,
+                self.dedup and get_ttl(self.dedup.ttl_days),
+            )
+            item = added_item if applied else None
+        else:
+            response = self.update_endpoint_metrics(
+                endpoint_name, variant_name, values, write_key
+            )
+            logging.debug(response)
+            item = None if response is None else response.get("Attributes", added_item)
+        # The context is applied with its own write key, so a retry completes it even if the counts were applied
+        if context_deltas:
+            self.update_variant_context(
+                endpoint_name,
+                variant_name,
+                context_deltas,
+                write_key and f"{write_key}#context",
+            )
+        return item
+
+    def update_endpoint_metrics(
+        self, endpoint_name: str, variant_name: str, values: dict, write_key: str = None
+    ):
+        """
+        Increment the counts for a variant in the endpoint item, returning all the updated attributes
+        """
+        return self.update_item(
+            self.metrics_table,
+            {
+                "Key": {"endpoint_name": endpoint_name},
+                "UpdateExpression": "ADD variant_metrics.#variant.invocation_count :i, "
                 "variant_metrics.#variant.conversion_count :c, "
-                "variant_metrics.#variant.reward_sum :r "
+                "variant_metrics.#variant.reward_sum :r, "
+                "variant_metrics.#variant.reward_sum_squares :s "
                 "SET #created_at = if_not_exists(#created_at, :now), #updated_at = :now ",
-                ExpressionAttributeNames={
+                "ExpressionAttributeNames": {
                     "#variant": variant_name,
                     "#created_at": "created_at",
                     "#updated_at": "updated_at",
                 },
-                ExpressionAttributeValues={
-                    ":i": int(invocation_count),
-                    ":c": int(conversion_count),
-                    ":r": Decimal(str(reward_sum)),
-                    ":now": timestamp,
-                },
-                ReturnValues="UPDATED_NEW",
+                "ExpressionAttributeValues": values,
+                "ReturnValues": "ALL_NEW",
+            },
+            write_key,
+        )
+
+    def update_shard_metrics(
+        self,
+        endpoint_name: str,
+        variant_name: str,
+        values: dict,
+        context_deltas: dict = None,
+        write_key: str = None,
+    ):
+        """
+        Increment the counts and contextual statistics for a variant in a random shard item, stored as top level
+        attributes so they are created on the first update without requiring the shard to be registered
+        """
+        shard = random.randrange(self.metrics_shards)
+        names = {
+            "#i": f"{variant_name}#invocation_count",
+            "#c": f"{variant_name}#conversion_count",
+            "#r": f"{variant_name}#reward_sum",
+            "#s": f"{variant_name}#reward_sum_squares",
+            "#updated_at": "updated_at",
+        }
+        values = dict(values)
+        context_deltas = context_deltas or {}
+        for i, (k, v) in enumerate(context_deltas.items()):
+            names[f"#x{i}"] = f"{variant_name}#context_{k}"
+            values[f":x{i}"] = Decimal(str(v))
+        return self.update_item(
+            self.metrics_table,
+            {
+                "Key": {"endpoint_name": self.get_shard_key(endpoint_name, shard)},
+                "UpdateExpression": "ADD "
+                + ", ".join(
+                    ["#i :i", "#c :c", "#r :r", "#s :s"]
+                    + [f"#x{i} :x{i}" for i in range(len(context_deltas))]
+                )
+                + " SET #updated_at = :now ",
+                "ExpressionAttributeNames": names,
+                "ExpressionAttributeValues": values,
+                "ReturnValues": "NONE",
+            },
+            write_key,
+        )
+
+    def get_write_key(self, source: str, endpoint_name: str, variant_name: str):
+        """
+        Return the key to apply the counts for a variant once for the source, or None without dedup
+        """
+        if source is None or self.dedup is None:
+            return None
+        return f"{source}#{endpoint_name}#{variant_name}"
+
+    def update_item(self, table_name: str, args: dict, write_key: str = None):
+        """
+        Update the item, or with a write key apply the update and record the key in a single transaction,
+        returning an empty response if applied, or None if the write key has already been applied
+        """
+        if write_key is None:
+            return self.dynamodb.Table(table_name).update_item(**args)
+        update = dict([(k, v) for k, v in args.items() if k != "ReturnValues"])
+        if self.dedup.update_item_once(write_key, {"TableName": table_name, **update}):
+            return {}
+        return None
+
+    def update_rollups(
+        self,
+        endpoint_name: str,
+        variant_name: str,
+        metrics: list,
+        timestamp: int,
+        write_key: str = None,
+    ):
+        """
+        Increment the time bucketed counts, applying each bucket once with the write key
+        """
+        if write_key is None:
+            return self.rollups.update_rollups(
+                endpoint_name, variant_name, metrics, timestamp
+            )
+        for args in self.rollups.get_rollup_updates(
+            endpoint_name, variant_name, metrics, timestamp
+        ):
+            self.update_item(
+                self.rollups.rollups_table,
+                args,
+                f"{write_key}#{args['Key']['rollup_key']}",
             )
 
-            # Return total counts per endpoint_name and endpoint_variant
-            logging.debug(response)
-            metrics = response["Attributes"]["variant_metrics"][variant_name]
-            new_counts = {
-                "endpoint_name": endpoint_name,
-                "endpoint_variant": variant_name,
-                "invocation_count": metrics.get("invocation_count", 0),
-                "conversion_count": metrics.get("conversion_count", 0),
-                "reward_sum": metrics.get("reward_sum", 0.0),
-            }
-            responses.append(new_counts)
+    def get_updated_items(self, updated_variants: list, merged: bool = False):
+        """
+        Return the latest endpoint item for each updated endpoint to check for a winner. If the totals weren't
+        returned by the updates, they are only read for endpoints with auto stop, at most once per check interval.
+        """
+        endpoint_items = {}
+        for endpoint_name, _, item in updated_variants:
+            if not merged:
+                endpoint_items[endpoint_name] = item
+            elif endpoint_name not in endpoint_items and self.is_winner_check_due(
+                endpoint_name
+            ):
+                endpoint_items[endpoint_name] = self.get_auto_stop_item(endpoint_name)
+        return endpoint_items
 
-            # Put cloudwatch metrics against this timestamp
-            dt = datetime.fromtimestamp(timestamp)
-            if invocation_count > 0:
-                self.put_cloudwatch_metric(
-                    "Invocations", endpoint_name, variant_name, invocation_count, dt
-                )
-            if conversion_count > 0:
-                self.put_cloudwatch_metric(
-                    "Conversions", endpoint_name, variant_name, conversion_count, dt
-                )
-                self.put_cloudwatch_metric(
-                    "Rewards", endpoint_name, variant_name, reward_sum, dt
-                )
+    def is_winner_check_due(self, endpoint_name: str):
+        """
+        Return True if the merged totals haven't been checked for a winner within the interval
+        """
+        now = time()
+        if (
+            now - self.winner_checked_at.get(endpoint_name, 0)
+            < self.WINNER_CHECK_INTERVAL
+        ):
+            return False
+        self.winner_checked_at[endpoint_name] = now
+        return True
 
-        return responses
+    def get_auto_stop_item(self, endpoint_name: str):
+        """
+        Return the endpoint item with the merged totals if auto stop is enabled without a winner,
+        otherwise only the auto stop and winner attributes
+        """
+        table = self.dynamodb.Table(self.metrics_table)
+        response = table.get_item(
+            Key={"endpoint_name": endpoint_name},
+            ProjectionExpression="#a, #w",
+            ExpressionAttributeNames={"#a": "auto_stop", "#w": "winner"},
+        )
+        item = response.get("Item", {})
+        if not item.get("auto_stop") or "winner" in item:
+            return item
+        return self.get_endpoint_item(endpoint_name) or {}
+
+    def update_experiment_winner(self, endpoint_name: str, item: dict, timestamp: int):
+        """
+        Stop the experiment by setting the winner if auto stop is enabled and the stats have decided a winner
+        """
+        if not item.get("auto_stop") or "winner" in item or "variant_names" not in item:
+            return None
+        stats = ExperimentStats(self.get_variant_list(endpoint_name, item)).get_stats()
+        winner = stats["winner"]
+        if winner is None:
+            return None
+
+        logging.info(f"Stopping endpoint: {endpoint_name} with winner: {winner}")
+        table = self.dynamodb.Table(self.metrics_table)
+        try:
+            table.update_item(
+                Key={"endpoint_name": endpoint_name},
+                UpdateExpression="SET winner = :winner, stopped_at = :now ",
+                ConditionExpression="attribute_not_exists(winner)",
+                ExpressionAttributeValues={
+                    ":winner": winner,
+                    ":now": timestamp,
+                },
+            )
+        except ClientError as e:
+            # Another update has already stopped the experiment
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise e
+        return winner
 
-    def log_metrics(self, metrics):
+    def log_metrics(self, metrics, source: str = None):
         # Update metrics directly in DDB if required.
         if self.synchronous:
-            return self.update_variant_metrics(metrics)
+            return self.update_variant_metrics(metrics, source=source)
 
         # Dump the results as a json lines with trailing new line
         event_log = "\n".join([json.dumps(metric) for metric in metrics]) + "\n"
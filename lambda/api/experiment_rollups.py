@@ -0,0 +1,174 @@
+from decimal import Decimal
+import logging
+from time import time
+
+from thread_local import ThreadLocalResource
+
+
+class ExperimentRollups:
+    """
+    Class for incrementing and querying the per variant metrics in fixed time buckets
+    """
+
+    dynamodb = ThreadLocalResource("dynamodb")
+
+    # The bucket size in seconds for each resolution
+    RESOLUTIONS = {"minute": 60, "hour": 3600}
+    # The number of buckets returned if the start is not provided
+    DEFAULT_BUCKETS = {"minute": 60, "hour": 24}
+    # Minute buckets are only kept for recent curves
+    MINUTE_RETENTION_DAYS = 2
+    # Query is limited to 1MB per page, so limit the number of buckets that can be requested
+    MAX_BUCKETS = 1440
+
+    def __init__(self, rollups_table: str, retention_days: int = 30):
+        self.rollups_table = rollups_table
+        self.retention_days = retention_days
+
+    def get_bucket(self, resolution: str, timestamp: int):
+        """
+        Return the start of the bucket in epoch seconds
+        """
+        if resolution not in self.RESOLUTIONS:
+            raise Exception(
+                f"Resolution {resolution} not in {list(self.RESOLUTIONS.keys())}"
+            )
+        size = self.RESOLUTIONS[resolution]
+        return int(timestamp) // size * size
+
+    @staticmethod
+    def get_rollup_key(resolution: str, bucket: int, variant_name: str = ""):
+        """
+        Return the sort key for the bucket, zero padded so the keys sort by time
+        """
+        return f"{resolution}#{bucket:010d}#{variant_name}"
+
+    def get_ttl(self, resolution: str, bucket: int):
+        days = self.retention_days
+        if resolution == "minute":
+            days = min(days, self.MINUTE_RETENTION_DAYS)
+        return bucket + self.RESOLUTIONS[resolution] + days * 86400
+
+    @staticmethod
+    def get_bucket_counts(metrics: list, bucket_fn, timestamp: int):
+        """
+        Return the invocation, conversion and reward sums for each bucket of the metrics,
+        using the timestamp for any metrics without one
+        """
+        buckets = {}
+        for m in metrics:
+            bucket = bucket_fn(m.get("timestamp", timestamp))
+            counts = buckets.setdefault(bucket, [0, 0, 0.0, 0.0])
+            if m["type"] == "invocation":
+                counts[0] += 1
+            elif m["type"] == "conversion":
+                counts[1] += 1
+                counts[2] += m["reward"]
+                counts[3] += m["reward"] ** 2
+        return buckets
+
+    def get_rollup_updates(
+        self, endpoint_name: str, variant_name: str, metrics: list, timestamp: int
+    ):
+        """
+        Return the update item arguments to increment the counts for each resolution and bucket of the variant metrics
+        """
+        updates = []
+        for resolution in self.RESOLUTIONS:
+            buckets = self.get_bucket_counts(
+                metrics, lambda t: self.get_bucket(resolution, t), timestamp
+            )
+            for bucket, (i, c, r, s) in buckets.items():
+                updates.append(
+                    {
+                        "Key": {
+                            "endpoint_name": endpoint_name,
+                            "rollup_key": self.get_rollup_key(
+                                resolution, bucket, variant_name
+                            ),
+                        },
+                        "UpdateExpression": "ADD invocation_count :i, conversion_count :c, "
+                        "reward_sum :r, reward_sum_squares :s "
+                        "SET #ttl = if_not_exists(#ttl, :ttl)",
+                        "ExpressionAttributeNames": {"#ttl": "ttl"},
+                        "ExpressionAttributeValues": {
+                            ":i": i,
+                            ":c": c,
+                            ":r": Decimal(str(r)),
+                            ":s": Decimal(str(s)),
+                            ":ttl": self.get_ttl(resolution, bucket),
+                        },
+                    }
+                )
+        return updates
+
+    def update_rollups(
+        self, endpoint_name: str, variant_name: str, metrics: list, timestamp: int
+    ):
+        """
+        Increment the counts for each resolution and bucket of the variant metrics, returning the number of updates
+        """
+        table = self.dynamodb.Table(self.rollups_table)
+        updates = self.get_rollup_updates(
+            endpoint_name, variant_name, metrics, timestamp
+        )
+        for args in updates:
+            response = table.update_item(**args)
+            logging.debug(response)
+        return len(updates)
+
+    def get_rollups(
+        self,
+        endpoint_name: str,
+        resolution: str = "hour",
+        start: int = None,
+        end: int = None,
+    ):
+        """
+        Return the list of buckets for each variant between the start and end inclusive,
+        defaulting to the last day of hours or last hour of minutes
+        """
+        end = self.get_bucket(resolution, end if end is not None else time())
+        size = self.RESOLUTIONS[resolution]
+        if start is None:
+            start = end - size * (self.DEFAULT_BUCKETS[resolution] - 1)
+        start = self.get_bucket(resolution, start)
+        if start > end:
+            raise Exception("Require start before end")
+        if (end - start) // size >= self.MAX_BUCKETS:
+            raise Exception(f"Require at most {self.MAX_BUCKETS} {resolution} buckets")
+
+        table = self.dynamodb.Table(self.rollups_table)
+        args = {
+            "KeyConditionExpression": "endpoint_name = :e AND rollup_key BETWEEN :start AND :end",
+            "ExpressionAttributeValues": {
+                ":e": endpoint_name,
+                ":start": self.get_rollup_key(resolution, start),
+                # The tilde sorts after all variant names
+                ":end": self.get_rollup_key(resolution, end, "~"),
+            },
+        }
+        variant_rollups = {}
+        while True:
+            response = table.query(**args)
+            for item in response["Items"]:
+                _, bucket, variant_name = item["rollup_key"].split("#", 2)
+                variant_rollups.setdefault(variant_name, []).append(
+                    {
+                        "timestamp": int(bucket),
+                        "invocation_count": int(item.get("invocation_count", 0)),
+                        "conversion_count": int(item.get("conversion_count", 0)),
+                        "reward_sum": float(item.get("reward_sum", 0)),
+                        "reward_sum_squares": float(item.get("reward_sum_squares", 0)),
+                    }
+                )
+            if "LastEvaluatedKey" not in response:
+                break
+            args = {**args, "ExclusiveStartKey": response["LastEvaluatedKey"]}
+
+        return {
+            "resolution": resolution,
+            "start": start,
+            "end": end,
+            "variant_rollups": variant_rollups,
+        }
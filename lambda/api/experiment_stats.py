@@ -0,0 +1,158 @@
+import math
+import random
+
+# Contains pure python statistics for deciding when an experiment has found a winning variant.
+# Posteriors of the mean reward per invocation use a normal approximation from the count, sum and sum of squares,
+# so the cost only depends on the number of variants, and not the number of invocations.
+# For the mixture sequential probability ratio test (mSPRT) see: https://arxiv.org/abs/1512.04922
+
+
+class ExperimentStats:
+    """
+    Class for computing probability of best, expected loss and sequential tests for variants
+    """
+
+    # Stop when a variant is the best with 95% probability, and is expected to lose less than 1% of its reward
+    PROB_BEST_THRESHOLD = 0.95
+    EXPECTED_LOSS_THRESHOLD = 0.01
+    MIN_INVOCATIONS = 100
+
+    def __init__(
+        self,
+        variant_metrics: list,
+        alpha: float = 0.05,
+        samples: int = 1000,
+        seed: int = None,
+    ):
+        if len(variant_metrics) == 0:
+            raise Exception("Require at least one endpoint variant")
+        self.variant_metrics = variant_metrics
+        if alpha <= 0 or alpha >= 1:
+            raise Exception("Alpha must be value between 0 and 1")
+        self.alpha = alpha
+        self.samples = samples
+        self.random = random.Random(seed)
+
+    @staticmethod
+    def posterior(variant: dict):
+        """
+        Return the mean and variance of the per invocation reward, and the variance of the mean
+        """
+        n = variant["invocation_count"]
+        if n == 0:
+            return 0.0, 0.25, 0.25
+        sum_squares = variant.get("reward_sum_squares", 0)
+        if sum_squares == 0:
+            # Use the beta posterior with a uniform prior if the sum of squares is not available
+            p = (variant["reward_sum"] + 1.0) / (n + 2.0)
+            p = min(max(p, 0.0), 1.0)
+            return 1.0 * variant["reward_sum"] / n, p * (1 - p), p * (1 - p) / (n + 3)
+        mean = 1.0 * variant["reward_sum"] / n
+        variance = max(1.0 * sum_squares / n - mean**2, 0.0)
+        return mean, variance, max(variance, 1e-12) / n
+
+    def get_probability_best(self):
+        """
+        Return the probability of each variant being the best, and the expected loss of choosing it,
+        using monte carlo samples from the posterior of the mean reward
+        """
+        posteriors = [self.posterior(v) for v in self.variant_metrics]
+        k = len(posteriors)
+        wins = [0] * k
+        losses = [0.0] * k
+        for _ in range(self.samples):
+            draws = [
+                self.random.gauss(mean, math.sqrt(mean_variance))
+                for mean, _, mean_variance in posteriors
+            ]
+            best = max(draws)
+            wins[draws.index(best)] += 1
+            for i in range(k):
+                losses[i] += best - draws[i]
+        probability_best = [w / self.samples for w in wins]
+        expected_loss = [loss / self.samples for loss in losses]
+        return probability_best, expected_loss
+
+    def get_sequential_test(self, control: dict, treatment: dict):
+        """
+        Return the log likelihood ratio of the mSPRT for the difference in mean reward between treatment and control.
+        The test can be evaluated after every update, and is significant when above the log(1/alpha) boundary.
+        """
+        if control["invocation_count"] == 0 or treatment["invocation_count"] == 0:
+            return 0.0
+        control_mean, control_variance, _ = self.posterior(control)
+        treatment_mean, treatment_variance, _ = self.posterior(treatment)
+        # Variance of the difference in means, and the mixing variance for effects of 10% of a standard deviation
+        w = (
+            control_variance / control["invocation_count"]
+            + treatment_variance / treatment["invocation_count"]
+        )
+        tau_squared = 0.01 * (control_variance + treatment_variance) / 2
+        if w == 0 or tau_squared == 0:
+            return 0.0
+        delta = treatment_mean - control_mean
+        return 0.5 * math.log(w / (w + tau_squared)) + (
+            tau_squared * delta**2 / (2 * w * (w + tau_squared))
+        )
+
+    def is_significantly_best(self, best: int):
+        """
+        Return True if the mSPRT of the best variant against every other variant is above the boundary, with the
+        alpha split across the comparisons. The mSPRT is valid at any time, so the winner can be checked after
+        every update without inflating the false positive rate of the Bayesian thresholds from peeking.
+        """
+        others = [i for i in range(len(self.variant_metrics)) if i != best]
+        boundary = math.log(max(len(others), 1) / self.alpha)
+        best_metrics = self.variant_metrics[best]
+        return all(
+            self.get_sequential_test(self.variant_metrics[i], best_metrics) >= boundary
+            for i in others
+        )
+
+    def get_winner(self, probability_best: list, expected_loss: list):
+        """
+        Return the variant name with a high probability of being best and low expected loss, which is also
+        significantly different from the other variants by the sequential test, or None
+        """
+        if any(
+            v["invocation_count"] < self.MIN_INVOCATIONS for v in self.variant_metrics
+        ):
+            return None
+        best = probability_best.index(max(probability_best))
+        mean, _, _ = self.posterior(self.variant_metrics[best])
+        max_loss = self.EXPECTED_LOSS_THRESHOLD * abs(mean)
+        if (
+            probability_best[best] >= self.PROB_BEST_THRESHOLD
+            and expected_loss[best] <= max_loss
+            and self.is_significantly_best(best)
+        ):
+            return self.variant_metrics[best]["variant_name"]
+        return None
+
+    def get_stats(self):
+        """
+        Return the stats for each variant against the first (champion) variant, and the winner if decided
+        """
+        probability_best, expected_loss = self.get_probability_best()
+        control = self.variant_metrics[0]
+        boundary = math.log(1 / self.alpha)
+        variant_stats = []
+        for i, v in enumerate(self.variant_metrics):
+            mean, variance, _ = self.posterior(v)
+            log_likelihood_ratio = self.get_sequential_test(control, v)
+            variant_stats.append(
+                {
+                    "variant_name": v["variant_name"],
+                    "reward_mean": mean,
+                    "reward_variance": variance,
+                    "probability_best": probability_best[i],
+                    "expected_loss": expected_loss[i],
+                    "log_likelihood_ratio": log_likelihood_ratio,
+                    "significant": i > 0 and log_likelihood_ratio >= boundary,
+                }
+            )
+        return {
+            "boundary": boundary,
+            "variant_stats": variant_stats,
+            "winner": self.get_winner(probability_best, expected_loss),
+        }
@@ -0,0 +1,478 @@
+from botocore.exceptions import ClientError
+import logging
+import sqlite3
+import threading
+from time import time
+
+from thread_local import ThreadLocalResource
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Contains the storage backends for user assignments and variant counts, selected with the STORAGE_BACKEND
+# environment variable so lower latency stores can be used without changing the lambda handlers.
+# Variant counts are stored as {variant_name}#{count_name} values per endpoint, which are merged with the
+# endpoint configuration in the metrics table.
+
+COUNT_NAMES = [
+    "invocation_count",
+    "conversion_count",
+    "reward_sum",
+    "reward_sum_squares",
+]
+
+
+class ExperimentStorage:
+    """
+    Base class for storing user assignments and variant counts
+    """
+
+    # Whether variant counts are stored in the backend, rather than the metrics table items
+    stores_counts = True
+
+    def get_assignment(self, user_id: str, endpoint_name: str):
+        """
+        Return the dictionary with the variant_name and ttl, or None if not assigned or expired
+        """
+        raise NotImplementedError()
+
+    def put_assignment(
+        self, user_id: str, endpoint_name: str, variant_name: str, ttl: int
+    ):
+        raise NotImplementedError()
+
+    def refresh_assignment(
+        self,
+        user_id: str,
+        endpoint_name: str,
+        variant_name: str,
+        ttl: int,
+        refresh: int,
+    ):
+        """
+        Set the ttl if the user is still assigned the variant and the ttl is before refresh,
+        returning False if not updated
+        """
+        raise NotImplementedError()
+
+    def increment_counts(
+        self,
+        endpoint_name: str,
+        variant_name: str,
+        counts: dict,
+        write_key: str = None,
+        ttl: int = None,
+    ):
+        """
+        Increment the counts by name for the endpoint variant. If the write key is provided, the counts are only
+        incremented once for the key until the ttl, returning False if they have already been incremented
+        """
+        raise NotImplementedError()
+
+    def get_counts(self, endpoint_name: str):
+        """
+        Return the dictionary of {variant_name}#{count_name} to value for the endpoint
+        """
+        raise NotImplementedError()
+
+    def delete_counts(self, endpoint_name: str, variant_names: list = None):
+        """
+        Delete the counts for the variants, or all variants of the endpoint
+        """
+        raise NotImplementedError()
+
+
+class DynamoDBStorage(ExperimentStorage):
+    """
+    Class for storing user assignments in the DynamoDB assignment table
+    """
+
+    dynamodb = ThreadLocalResource("dynamodb")
+
+    # Counts are stored in the metrics table endpoint or shard items
+    stores_counts = False
+
+    def __init__(self, assignment_table: str):
+        self.assignment_table = assignment_table
+
+    def get_assignment(self, user_id: str, endpoint_name: str):
+        table = self.dynamodb.Table(self.assignment_table)
+        response = table.get_item(
+            Key={
+                "user_id": user_id,
+                "endpoint_name": endpoint_name,
+            },
+            ProjectionExpression="variant_name, #ttl",
+            ExpressionAttributeNames={"#ttl": "ttl"},
+        )
+        if "Item" not in response:
+            return None
+        item = response["Item"]
+        ttl = int(item["ttl"]) if "ttl" in item else None
+        # Expired items can be returned until they are deleted, so treat them as unassigned like the other backends
+        if ttl is not None and ttl < time():
+            return None
+        return {"variant_name": item["variant_name"], "ttl": ttl}
+
+    def put_assignment(
+        self, user_id: str, endpoint_name: str, variant_name: str, ttl: int
+    ):
+        table = self.dynamodb.Table(self.assignment_table)
+        return table.put_item(
+            Item={
+                "user_id": user_id,
+                "endpoint_name": endpoint_name,
+                "variant_name": variant_name,
+                "ttl": ttl,
+            }
+        )
+
+    def refresh_assignment(
+        self,
+        user_id: str,
+        endpoint_name: str,
+        variant_name: str,
+        ttl: int,
+        refresh: int,
+    ):
+        table = self.dynamodb.Table(self.assignment_table)
+        try:
+            table.update_item(
+                Key={
+                    "user_id": user_id,
+                    "endpoint_name": endpoint_name,
+                },
+                UpdateExpression="SET #ttl = :ttl",
+                ConditionExpression="variant_name = :variant_name AND #ttl < :refresh",
+                ExpressionAttributeNames={"#ttl": "ttl"},
+                ExpressionAttributeValues={
+                    ":ttl": ttl,
+                    ":variant_name": variant_name,
+                    ":refresh": refresh,
+                },
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise e
+
+
+class MemoryStorage(ExperimentStorage):
+    """
+    Class for storing user assignments and variant counts in memory for tests and local runs
+    """
+
+    def __init__(self):
+        self.assignments = {}
+        self.counts = {}
+        self.writes = {}
+        self.lock = threading.Lock()
+
+    def get_assignment(self, user_id: str, endpoint_name: str):
+        item = self.assignments.get((user_id, endpoint_name))
+        if item is None or item["ttl"] < time():
+            return None
+        return dict(item)
+
+    def put_assignment(
+        self, user_id: str, endpoint_name: str, variant_name: str, ttl: int
+    ):
+        self.assignments[(user_id, endpoint_name)] = {
+            "variant_name": variant_name,
+            "ttl": ttl,
+        }
+
+    def refresh_assignment(
+        self,
+        user_id: str,
+        endpoint_name: str,
+        variant_name: str,
+        ttl: int,
+        refresh: int,
+    ):
+        with self.lock:
+            item = self.assignments.get((user_id, endpoint_name))
+            if item is None or item["variant_name"] != variant_name:
+                return False
+            if item["ttl"] >= refresh:
+                return False
+            item["ttl"] = ttl
+            return True
+
+    def increment_counts(
+        self,
+        endpoint_name: str,
+        variant_name: str,
+        counts: dict,
+        write_key: str = None,
+        ttl: int = None,
+    ):
+        with self.lock:
+            if write_key is not None:
+                if self.writes.get(write_key, 0) >= time():
+                    return False
+                # Keep a write key without a ttl, as the SQLite backend does
+                self.writes[write_key] = ttl if ttl is not None else float("inf")
+            endpoint_counts = self.counts.setdefault(endpoint_name, {})
+            for count_name, value in counts.items():
+                key = f"{variant_name}#{count_name}"
+                endpoint_counts[key] = endpoint_counts.get(key, 0) + value
+            return True
+
+    def get_counts(self, endpoint_name: str):
+        return dict(self.counts.get(endpoint_name, {}))
+
+    def delete_counts(self, endpoint_name: str, variant_names: list = None):
+        with self.lock:
+            if variant_names is None:
+                self.counts.pop(endpoint_name, None)
+                return
+            endpoint_counts = self.counts.get(endpoint_name, {})
+            for key in list(endpoint_counts.keys()):
+                if key.rsplit("#", 1)[0] in variant_names:
+                    del endpoint_counts[key]
+
+
+class SQLiteStorage(ExperimentStorage):
+    """
+    Class for storing user assignments and variant counts in a SQLite database file for local runs
+    """
+
+    def __init__(self, database: str = ":memory:"):
+        self.connection = sqlite3.connect(
+            database, isolation_level=None, check_same_thread=False
+        )
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS assignment ("
+                "user_id TEXT, endpoint_name TEXT, variant_name TEXT, ttl INTEGER, "
+                "PRIMARY KEY (user_id, endpoint_name))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS counts ("
+                "endpoint_name TEXT, count_key TEXT, value REAL, "
+                "PRIMARY KEY (endpoint_name, count_key))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS writes ("
+                "write_key TEXT PRIMARY KEY, ttl INTEGER)"
+            )
+
+    def get_assignment(self, user_id: str, endpoint_name: str):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT variant_name, ttl FROM assignment "
+                "WHERE user_id = ? AND endpoint_name = ? AND ttl >= ?",
+                (user_id, endpoint_name, int(time())),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"variant_name": row[0], "ttl": row[1]}
+
+    def put_assignment(
+        self, user_id: str, endpoint_name: str, variant_name: str, ttl: int
+    ):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO assignment VALUES (?, ?, ?, ?)",
+                (user_id, endpoint_name, variant_name, ttl),
+            )
+
+    def refresh_assignment(
+        self,
+        user_id: str,
+        endpoint_name: str,
+        variant_name: str,
+        ttl: int,
+        refresh: int,
+    ):
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE assignment SET ttl = ? "
+                "WHERE user_id = ? AND endpoint_name = ? AND variant_name = ? AND ttl < ?",
+                (ttl, user_id, endpoint_name, variant_name, refresh),
+            )
+        return cursor.rowcount > 0
+
+    def increment_counts(
+        self,
+        endpoint_name: str,
+        variant_name: str,
+        counts: dict,
+        write_key: str = None,
+        ttl: int = None,
+    ):
+        with self.lock, self.connection:
+            # Record the write key in the same transaction as the counts
+            self.connection.execute("BEGIN")
+            if write_key is not None:
+                self.connection.execute(
+                    "DELETE FROM writes WHERE write_key = ? AND ttl < ?",
+                    (write_key, int(time())),
+                )
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO writes VALUES (?, ?)", (write_key, ttl)
+                )
+                if cursor.rowcount == 0:
+                    return False
+            for count_name, value in counts.items():
+                key = f"{variant_name}#{count_name}"
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO counts VALUES (?, ?, 0)",
+                    (endpoint_name, key),
+                )
+                self.connection.execute(
+                    "UPDATE counts SET value = value + ? "
+                    "WHERE endpoint_name = ? AND count_key = ?",
+                    (float(value), endpoint_name, key),
+                )
+            return True
+
+    def get_counts(self, endpoint_name: str):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT count_key, value FROM counts WHERE endpoint_name = ?",
+                (endpoint_name,),
+            ).fetchall()
+        return dict(rows)
+
+    def delete_counts(self, endpoint_name: str, variant_names: list = None):
+        with self.lock:
+            if variant_names is None:
+                self.connection.execute(
+                    "DELETE FROM counts WHERE endpoint_name = ?", (endpoint_name,)
+                )
+                return
+            for variant_name in variant_names:
+                self.connection.execute(
+                    "DELETE FROM counts WHERE endpoint_name = ? AND count_key LIKE ?",
+                    (endpoint_name, f"{variant_name}#%"),
+                )
+
+
+class RedisStorage(ExperimentStorage):
+    """
+    Class for storing user assignments as keys that expire, and variant counts as hashes, in a Redis protocol store
+    """
+
+    # Set the ttl only if the user is still assigned the variant and the ttl is before refresh
+    REFRESH_SCRIPT = """
+    if redis.call("GET", KEYS[1]) ~= ARGV[1] then return 0 end
+    local expires = redis.call("TTL", KEYS[1])
+    if expires < 0 or tonumber(ARGV[3]) <= tonumber(ARGV[4]) + expires then return 0 end
+    return redis.call("EXPIREAT", KEYS[1], ARGV[2])
+    """
+    # Set the write key if it doesn't exist, and increment the count fields of the hash in the same script
+    INCREMENT_SCRIPT = """
+    if not redis.call("SET", KEYS[2], 1, "NX") then return 0 end
+    redis.call("EXPIREAT", KEYS[2], ARGV[1])
+    for i = 2, #ARGV, 2 do redis.call("HINCRBYFLOAT", KEYS[1], ARGV[i], ARGV[i + 1]) end
+    return 1
+    """
+
+    def __init__(self, url: str):
+        if redis is None:
+            raise Exception("Require redis package for the redis storage backend")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.refresh_script = self.client.register_script(self.REFRESH_SCRIPT)
+        self.increment_script = self.client.register_script(self.INCREMENT_SCRIPT)
+
+    @staticmethod
+    def get_assignment_key(user_id: str, endpoint_name: str):
+        return f"assignment#{endpoint_name}#{user_id}"
+
+    @staticmethod
+    def get_counts_key(endpoint_name: str):
+        return f"counts#{endpoint_name}"
+
+    def get_assignment(self, user_id: str, endpoint_name: str):
+        key = self.get_assignment_key(user_id, endpoint_name)
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.get(key)
+        pipeline.ttl(key)
+        variant_name, expires = pipeline.execute()
+        if variant_name is None:
+            return None
+        return {
+            "variant_name": variant_name,
+            "ttl": int(time()) + expires if expires >= 0 else None,
+        }
+
+    def put_assignment(
+        self, user_id: str, endpoint_name: str, variant_name: str, ttl: int
+    ):
+        key = self.get_assignment_key(user_id, endpoint_name)
+        pipeline = self.client.pipeline()
+        pipeline.set(key, variant_name)
+        pipeline.expireat(key, ttl)
+        return pipeline.execute()
+
+    def refresh_assignment(
+        self,
+        user_id: str,
+        endpoint_name: str,
+        variant_name: str,
+        ttl: int,
+        refresh: int,
+    ):
+        key = self.get_assignment_key(user_id, endpoint_name)
+        updated = self.refresh_script(
+            keys=[key], args=[variant_name, ttl, refresh, int(time())]
+        )
+        return bool(updated)
+
+    def increment_counts(
+        self,
+        endpoint_name: str,
+        variant_name: str,
+        counts: dict,
+        write_key: str = None,
+        ttl: int = None,
+    ):
+        key = self.get_counts_key(endpoint_name)
+        if write_key is not None:
+            args = [ttl]
+            for count_name, value in counts.items():
+                args += [f"{variant_name}#{count_name}", float(value)]
+            applied = self.increment_script(keys=[key, f"write#{write_key}"], args=args)
+            return bool(applied)
+        pipeline = self.client.pipeline()
+        for count_name, value in counts.items():
+            field = f"{variant_name}#{count_name}"
+            if isinstance(value, int):
+                pipeline.hincrby(key, field, value)
+            else:
+                pipeline.hincrbyfloat(key, field, float(value))
+        pipeline.execute()
+        return True
+
+    def get_counts(self, endpoint_name: str):
+        counts = self.client.hgetall(self.get_counts_key(endpoint_name))
+        return dict([(k, float(v)) for k, v in counts.items()])
+
+    def delete_counts(self, endpoint_name: str, variant_names: list = None):
+        key = self.get_counts_key(endpoint_name)
+        if variant_names is None:
+            return self.client.delete(key)
+        fields = [f"{v}#{c}" for v in variant_names for c in COUNT_NAMES]
+        return self.client.hdel(key, *fields)
+
+
+def get_storage(backend: str, assignment_table: str = None, url: str = None):
+    """
+    Return the storage for the backend name, with the url for the sqlite database or redis server
+    """
+    logging.info(f"Using {backend} storage backend")
+    if backend == "dynamodb":
+        return DynamoDBStorage(assignment_table)
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "sqlite":
+        return SQLiteStorage(url or ":memory:")
+    if backend == "redis":
+        return RedisStorage(url)
+    raise Exception(f"Unsupported storage backend: {backend}")
@@ -0,0 +1,195 @@
+import json
+import logging
+import threading
+
+# Contains a micro-batcher for the service mode, which coalesces concurrent invocations of the same endpoint variant
+# with an {"instances": [...]} body into a single invoke endpoint call, and returns each request its predictions.
+# Requests with any arguments that can't be shared by the batch, such as Accept or InferenceId, are not batched.
+
+
+class Batch:
+    """
+    Class for the instances of the concurrent requests for an endpoint variant
+    """
+
+    def __init__(self):
+        self.instances = []
+        # The instances for each request in the batch
+        self.requests = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        # The invoked variant and predictions, or the error for each request
+        self.results = []
+        self.errors = []
+
+
+class InvocationBatcher:
+    """
+    Class for batching invocations per endpoint variant within a time and size window
+    """
+
+    # The invoke endpoint arguments that are the same for every request in a batch
+    BATCH_ARGS = ["EndpointName", "ContentType", "Body", "TargetVariant"]
+
+    def __init__(self, sm_runtime, max_batch_size: int = 32, max_wait_ms: int = 5):
+        if max_batch_size < 1 or max_wait_ms < 0:
+            raise Exception("Require max batch size >= 1 and max wait >= 0")
+        self.sm_runtime = sm_runtime
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def get_instances(self, args: dict):
+        """
+        Return the list of instances if the invoke endpoint arguments can be batched, otherwise None
+        """
+        if any(k not in self.BATCH_ARGS for k in args):
+            return None
+        if (
+            args.get("TargetVariant") is None
+            or args["ContentType"] != "application/json"
+        ):
+            return None
+        try:
+            body = json.loads(args["Body"])
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(body, dict) or list(body.keys()) != ["instances"]:
+            return None
+        instances = body["instances"]
+        if (
+            not isinstance(instances, list)
+            or not 0 < len(instances) <= self.max_batch_size
+        ):
+            return None
+        return instances
+
+    @staticmethod
+    def split_predictions(predictions, sizes: list):
+        """
+        Return the predictions for each request, from a list or a dictionary with a predictions list
+        """
+        values = predictions
+        if isinstance(predictions, dict):
+            values = predictions.get("predictions")
+        if not isinstance(values, list) or len(values) != sum(sizes):
+            raise Exception("Unable to split batch predictions for each request")
+        parts = []
+        start = 0
+        for size in sizes:
+            part = values[start : start + size]
+            parts.append(
+                {**predictions, "predictions": part}
+                if isinstance(predictions, dict)
+                else part
+            )
+            start += size
+        return parts
+
+    def invoke(
+        self,
+        endpoint_name: str,
+        target_variant: str,
+        content_type: str,
+        instances: list,
+    ):
+        """
+        Add the instances to the batch for the endpoint variant, returning the invoked variant and predictions.
+        The first request waits for the batch to fill or the window to pass, then invokes the endpoint for all.
+        """
+        key = (endpoint_name, target_variant, content_type)
+        with self.lock:
+            batch = self.batches.get(key)
+            leader = (
+                batch is None
+                or len(batch.instances) + len(instances) > self.max_batch_size
+            )
+            if leader:
+                if batch is not None:
+                    # Start a new batch, as the current batch is full
+                    batch.full.set()
+                batch = Batch()
+                self.batches[key] = batch
+            index = len(batch.requests)
+            batch.requests.append(instances)
+            batch.instances += instances
+            if len(batch.instances) >= self.max_batch_size:
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.max_wait_ms / 1000)
+            with self.lock:
+                if self.batches.get(key) is batch:
+                    del self.batches[key]
+            self.invoke_batch(endpoint_name, target_variant, content_type, batch)
+        else:
+            batch.done.wait()
+
+        if batch.errors[index] is not None:
+            raise batch.errors[index]
+        return batch.results[index]
+
+    def invoke_instances(
+        self, endpoint_name: str, target_variant: str, content_type: str, instances
+    ):
+        """
+        Invoke the endpoint for the instances, returning the invoked variant and predictions
+        """
+        response = self.sm_runtime.invoke_endpoint(
+            EndpointName=endpoint_name,
+            ContentType=content_type,
+            Body=json.dumps({"instances": instances}),
+            TargetVariant=target_variant,
+        )
+        return response["InvokedProductionVariant"], json.loads(response["Body"].read())
+
+    def invoke_batch(
+        self, endpoint_name: str, target_variant: str, content_type: str, batch: Batch
+    ):
+        """
+        Invoke the endpoint for all the requests in the batch, falling back to invoking each request on its own
+        if the batch fails or the predictions can't be split for each request
+        """
+        logging.debug(
+            f"Invoke endpoint: {endpoint_name} variant: {target_variant} batch: {len(batch.requests)} requests"
+        )
+        try:
+            invoked_variant, predictions = self.invoke_instances(
+                endpoint_name, target_variant, content_type, batch.instances
+            )
+            predictions = self.split_predictions(
+                predictions, [len(r) for r in batch.requests]
+            )
+            batch.results = [(invoked_variant, p) for p in predictions]
+            batch.errors = [None] * len(batch.requests)
+        except Exception as e:
+            if len(batch.requests) > 1:
+                logging.warning(f"Invoking {len(batch.requests)} requests on their own")
+                logging.warning(e)
+                self.invoke_requests(endpoint_name, target_variant, content_type, batch)
+            else:
+                batch.results = [None]
+                batch.errors = [e]
+        finally:
+            batch.done.set()
+
+    def invoke_requests(
+        self, endpoint_name: str, target_variant: str, content_type: str, batch: Batch
+    ):
+        """
+        Invoke the endpoint for each request in the batch, recording the result or error of each
+        """
+        batch.results = []
+        batch.errors = []
+        for instances in batch.requests:
+            try:
+                batch.results.append(
+                    self.invoke_instances(
+                        endpoint_name, target_variant, content_type, instances
+                    )
+                )
+                batch.errors.append(None)
+            except Exception as e:
+                batch.results.append(None)
+                batch.errors.append(e)
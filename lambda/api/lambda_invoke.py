@@ -1,7 +1,10 @@
+import base64
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import json
 import os
+import threading
 import time
 import uuid
 import logging
@@ -9,14 +12,52 @@ from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 
 from experiment_metrics import ExperimentMetrics
-from experiment_assignment import ExperimentAssignment
-from algorithm import ThompsonSampling, EpsilonGreedy, UCB1, WeightedSampling
+from experiment_assignment import ExperimentAssignment, AssignmentCache
+from assignment_token import AssignmentToken
+from async_inference import AsyncInference
+from invocation_batcher import InvocationBatcher
+from passthrough import is_passthrough, get_passthrough_response
+from experiment_dedup import ExperimentDedup
+from experiment_rollups import ExperimentRollups
+from experiment_storage import get_storage
+from experiment_stats import ExperimentStats
+from traffic_filter import TrafficFilter
+from algorithm import (
+    ThompsonSampling,
+    WeightedSampling,
+    LinUCB,
+    BestArmIdentification,
+    get_algorithm,
+)
 
 # Get environment variables
 ASSIGNMENT_TABLE = os.environ["ASSIGNMENT_TABLE"]
+ASSIGNMENT_TTL_DAYS = int(os.getenv("ASSIGNMENT_TTL_DAYS", "90"))
+ASSIGNMENT_REFRESH_DAYS = int(os.getenv("ASSIGNMENT_REFRESH_DAYS", "7"))
+ASSIGNMENT_CACHE_SIZE = int(os.getenv("ASSIGNMENT_CACHE_SIZE", "0"))
+ASSIGNMENT_CACHE_TTL = int(os.getenv("ASSIGNMENT_CACHE_TTL", "300"))
+CACHE_METRICS_INTERVAL = int(os.getenv("CACHE_METRICS_INTERVAL", "60"))
+ASSIGNMENT_TOKEN_SECRET = os.getenv("ASSIGNMENT_TOKEN_SECRET")
+ASSIGNMENT_TOKEN_TTL = int(os.getenv("ASSIGNMENT_TOKEN_TTL", "86400"))
 METRICS_TABLE = os.environ["METRICS_TABLE"]
 DELIVERY_STREAM_NAME = os.environ["DELIVERY_STREAM_NAME"]
+METRICS_SHARDS = int(os.getenv("METRICS_SHARDS", "0"))
 DELIVERY_SYNC = os.getenv("DELIVERY_SYNC", "False").lower() == "true"
+DEDUP_TABLE = os.getenv("DEDUP_TABLE")
+DEDUP_TTL_DAYS = int(os.getenv("DEDUP_TTL_DAYS", "7"))
+ROLLUPS_TABLE = os.getenv("ROLLUPS_TABLE")
+ROLLUPS_RETENTION_DAYS = int(os.getenv("ROLLUPS_RETENTION_DAYS", "30"))
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "dynamodb")
+STORAGE_URL = os.getenv("STORAGE_URL")
+MAX_POOL_CONNECTIONS = int(os.getenv("MAX_POOL_CONNECTIONS", "10"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "0"))
+BATCH_MAX_WAIT_MS = int(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+ASYNC_BUCKET = os.getenv("ASYNC_BUCKET")
+ASYNC_PREFIX = os.getenv("ASYNC_PREFIX", "async/")
+TRAFFIC_RULES = os.getenv(
+    "TRAFFIC_RULES", os.path.join(os.path.dirname(__file__), "traffic_rules.json")
+)
+TRAFFIC_WINDOW = int(os.getenv("TRAFFIC_WINDOW", "60"))
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
 # Configure logging and patch xray
@@ -25,59 +66,136 @@ logger.setLevel(LOG_LEVEL)
 patch_all()
 
 # Create the experiment classes from the lambda layer
-exp_assignment = ExperimentAssignment(ASSIGNMENT_TABLE)
-exp_metrics = ExperimentMetrics(METRICS_TABLE, DELIVERY_STREAM_NAME, DELIVERY_SYNC)
+assignment_cache = (
+    AssignmentCache(ASSIGNMENT_CACHE_SIZE, ASSIGNMENT_CACHE_TTL)
+    if ASSIGNMENT_CACHE_SIZE > 0
+    else None
+)
+storage = get_storage(STORAGE_BACKEND, ASSIGNMENT_TABLE, STORAGE_URL)
+exp_assignment = ExperimentAssignment(
+    ASSIGNMENT_TABLE,
+    ASSIGNMENT_TTL_DAYS,
+    ASSIGNMENT_REFRESH_DAYS,
+    assignment_cache,
+    storage,
+)
+cache_metrics_time = time.time()
+# Lock for the cache metrics time, as the service logs the metrics from request threads
+cache_metrics_lock = threading.Lock()
+assignment_token = (
+    AssignmentToken.from_secret(ASSIGNMENT_TOKEN_SECRET, ASSIGNMENT_TOKEN_TTL)
+    if ASSIGNMENT_TOKEN_SECRET
+    else None
+)
+exp_rollups = (
+    ExperimentRollups(ROLLUPS_TABLE, ROLLUPS_RETENTION_DAYS) if ROLLUPS_TABLE else None
+)
+# Conversions delivered through firehose are deduplicated by the metrics lambda
+exp_dedup = (
+    ExperimentDedup(DEDUP_TABLE, DEDUP_TTL_DAYS)
+    if DEDUP_TABLE and DELIVERY_SYNC
+    else None
+)
+exp_metrics = ExperimentMetrics(
+    METRICS_TABLE,
+    DELIVERY_STREAM_NAME,
+    DELIVERY_SYNC,
+    METRICS_SHARDS,
+    exp_rollups,
+    storage,
+    exp_dedup,
+)
+async_inference = AsyncInference(ASYNC_BUCKET, ASYNC_PREFIX) if ASYNC_BUCKET else None
+# Filter metrics written synchronously, as the metrics lambda filters metrics delivered through firehose
+traffic_filter = (
+    TrafficFilter.from_file(TRAFFIC_RULES)
+    if DELIVERY_SYNC and os.path.exists(TRAFFIC_RULES)
+    else None
+)
 
 # Log the boto version (Require 1.17.5 for InferenceId target)
 logger.info(f"boto version: {boto3.__version__}")
 
 # Define he boto3 client resources
-sm_runtime = boto3.client("sagemaker-runtime")
+# Keep a connection per concurrent request when served by the service
+sm_runtime = boto3.client(
+    "sagemaker-runtime", config=Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+)
 sm_client = boto3.client("sagemaker")
 lambda_client = boto3.client("lambda")
 
+# Optionally batch concurrent invocations per variant when served by the service
+invocation_batcher = (
+    InvocationBatcher(sm_runtime, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+    if BATCH_MAX_SIZE > 0
+    else None
+)
+
+
+def get_assigned_variant(
+    endpoint_name: str, user_id: str, variant_names: list, token: str = None
+):
+    """
+    Get the variant from a valid assignment token, otherwise from the assignment table
+    """
+    if assignment_token is not None and token is not None:
+        user_variant = assignment_token.verify_token(
+            token, user_id, endpoint_name, variant_names
+        )
+        if user_variant is not None:
+            return user_variant
+    return exp_assignment.get_assignment(
+        user_id=user_id, endpoint_name=endpoint_name, variant_names=variant_names
+    )
+
 
 @xray_recorder.capture("Get User Variant")
-def get_user_variant(endpoint_name: str, user_id: str):
+def get_user_variant(
+    endpoint_name: str, user_id: str, features: list = None, token: str = None
+):
     # Get the variants metrics (this will fail if endpoint doesn't exist)
-    strategy, epsilon, warmup, variant_metrics = exp_metrics.get_variant_metrics(
-        endpoint_name
-    )
+    endpoint_metrics = exp_metrics.get_endpoint_metrics(endpoint_name)
+    strategy = endpoint_metrics["strategy"]
+    epsilon = endpoint_metrics["epsilon"]
+    reward_range = endpoint_metrics["reward_range"]
+    warmup = endpoint_metrics["warmup"]
+    variant_metrics = endpoint_metrics["variant_metrics"]
+    winner = endpoint_metrics["winner"]
+    variant_names = [v["variant_name"] for v in variant_metrics]
 
     # Get the configuration for the endpoint name
     logger.info(f"Getting variant for user: {user_id}")
-    user_variant = exp_assignment.get_assignment(
-        user_id=user_id, endpoint_name=endpoint_name
-    )
+    user_variant = get_assigned_variant(endpoint_name, user_id, variant_names, token)
 
     # Ensure that our user variant is still in current metrics
     target_variant = user_variant
-    if user_variant is not None:
-        user_match = [v for v in variant_metrics if v["variant_name"] == user_variant]
-        if len(user_match) == 0:
-            logger.info(f"User variant {user_variant} not in endpoint variants")
+    if user_variant is not None and user_variant not in variant_names:
+        logger.info(f"User variant {user_variant} not in endpoint variants")
+        target_variant = None
+
+    # If the experiment has stopped, all users are assigned to the winner
+    if winner is not None:
+        strategy = "Winner"
+        if user_variant != winner:
+            logger.info(f"User variant {user_variant} not the winner {winner}")
             target_variant = None
 
     # Get the new target variant if not assigned
     status_code = 200
-    if target_variant is None:
+    if target_variant is None and winner is not None:
+        target_variant = winner
+        status_code = 201
+    elif target_variant is None:
         # See if all variants have invocation metrics
         with_invocations = [
             v for v in variant_metrics if v["invocation_count"] > warmup
         ]
         if len(with_invocations) < len(variant_metrics):
             strategy = WeightedSampling.STRATEGY_NAME
-            algo = WeightedSampling(variant_metrics)
-        elif strategy == WeightedSampling.STRATEGY_NAME:
-            algo = WeightedSampling(variant_metrics)
-        elif strategy == ThompsonSampling.STRATEGY_NAME:
-            algo = ThompsonSampling(variant_metrics)
-        elif strategy == EpsilonGreedy.STRATEGY_NAME:
-            algo = EpsilonGreedy(variant_metrics, epsilon)
-        elif strategy == UCB1.STRATEGY_NAME:
-            algo = UCB1(variant_metrics)
-        else:
-            raise Exception(f"Strategy {strategy} not supported")
+        elif strategy == LinUCB.STRATEGY_NAME and features is None:
+            # Contextual strategy requires features, so use the non-contextual counts
+            strategy = ThompsonSampling.STRATEGY_NAME
+        algo = get_algorithm(strategy, variant_metrics, epsilon, features, reward_range)
         target_variant = algo.select_variant()
         status_code = 201
 
@@ -85,29 +203,85 @@ def get_user_variant(endpoint_name: str, user_id: str):
     if user_variant != target_variant:
         logger.info(f"Set target variant: {target_variant} for user: {user_id}")
         exp_assignment.put_assignment(
-            user_id=user_id, endpoint_name=endpoint_name, variant_name=target_variant
+            user_id=user_id,
+            endpoint_name=endpoint_name,
+            variant_name=target_variant,
+            variant_names=variant_names,
+        )
+
+    # Return a signed token for the client to send with the next request
+    new_token = None
+    if assignment_token is not None:
+        new_token = assignment_token.create_token(
+            user_id, endpoint_name, target_variant, variant_names
         )
 
     # Return the result
-    return strategy, target_variant, status_code
+    return strategy, target_variant, status_code, new_token
 
 
 @xray_recorder.capture("Stats")
-def handle_stats(endpoint_name: str):
+def handle_stats(endpoint_name: str, rollups: dict = None):
     # Get the variants metrics (this will fail if endpoint doesn't exist)
-    strategy, epsilon, warmup, variant_metrics = exp_metrics.get_variant_metrics(
-        endpoint_name
-    )
+    endpoint_metrics = exp_metrics.get_endpoint_metrics(endpoint_name)
+    strategy = endpoint_metrics["strategy"]
+    epsilon = endpoint_metrics["epsilon"]
+    variant_metrics = endpoint_metrics["variant_metrics"]
     result = {
         "endpoint_name": endpoint_name,
         "variant_metrics": variant_metrics,
         "strategy": strategy,
         "epsilon": epsilon,
-        "warmup": warmup,
+        "warmup": endpoint_metrics["warmup"],
+        "auto_stop": endpoint_metrics["auto_stop"],
+        "reward_range": endpoint_metrics["reward_range"],
+        "winner": endpoint_metrics["winner"],
+        "stopped_at": endpoint_metrics["stopped_at"],
     }
+    # Add the probability of best, expected loss and sequential test for each variant
+    result["stats"] = ExperimentStats(variant_metrics).get_stats()
+    # Report the estimated samples to decision for best arm identification strategies
+    if strategy != LinUCB.STRATEGY_NAME:
+        algo = get_algorithm(
+            strategy,
+            variant_metrics,
+            epsilon,
+            reward_range=endpoint_metrics["reward_range"],
+        )
+        if isinstance(algo, BestArmIdentification):
+            result["samples_to_decision"] = algo.samples_to_decision()
+    # Add the time bucketed counts per variant if requested
+    if rollups is not None:
+        if exp_rollups is None:
+            raise Exception("Rollups are not enabled")
+        result["rollups"] = exp_rollups.get_rollups(
+            endpoint_name,
+            rollups.get("resolution", "hour"),
+            rollups.get("start"),
+            rollups.get("end"),
+        )
     return result, 200
 
 
+def invoke_endpoint(args: dict, generated_inference_id: bool = False):
+    """
+    Invoke the endpoint, batched with concurrent requests for the same variant if enabled,
+    returning the invoked variant and predictions
+    """
+    instances = None
+    if invocation_batcher is not None and generated_inference_id:
+        # Drop the generated inference id only if the request is batched, as it can't be shared by the batch
+        instances = invocation_batcher.get_instances(
+            dict([(k, v) for k, v in args.items() if k != "InferenceId"])
+        )
+    if instances is not None:
+        return invocation_batcher.invoke(
+            args["EndpointName"], args["TargetVariant"], args["ContentType"], instances
+        )
+    response = sm_runtime.invoke_endpoint(**args)
+    return response["InvokedProductionVariant"], json.loads(response["Body"].read())
+
+
 @xray_recorder.capture("Invocation")
 def handle_invocation(
     strategy: str,
@@ -117,37 +291,152 @@ def handle_invocation(
     user_id: str,
     target_variant: str,
     data,
+    features: list = None,
+    target_model: str = None,
+    accept: str = None,
+    passthrough: bool = False,
+    generated_inference_id: bool = False,
 ):
     # InferenceId is not available in 1.16.31 which is default boto3 in lambda by default
     # https://boto3.amazonaws.com/v1/documentation/api/1.16.31/reference/services/sagemaker-runtime.html#SageMakerRuntime.Client.invoke_endpoint
+    args = {
+        "EndpointName": endpoint_name,
+        "ContentType": content_type,
+        "Body": data,
+        "InferenceId": inference_id,
+    }
     if target_variant is None:
         logger.warning("Invoking endpiont without target variant")
-        response = sm_runtime.invoke_endpoint(
-            EndpointName=endpoint_name,
-            ContentType=content_type,
-            Body=data,
-            InferenceId=inference_id,
-        )
     else:
         logger.info(f"Invoke endpoint with target variant: {target_variant}")
-        response = sm_runtime.invoke_endpoint(
-            EndpointName=endpoint_name,
-            ContentType=content_type,
-            TargetVariant=target_variant,
-            Body=data,
-            InferenceId=inference_id,
+        args["TargetVariant"] = target_variant
+    # Multi-model variants require the target model relative to the model data url
+    if target_model is not None:
+        args["TargetModel"] = target_model
+    if accept is not None:
+        args["Accept"] = accept
+
+    result = {
+        "strategy": strategy,
+        "endpoint_name": endpoint_name,
+        "target_variant": target_variant,
+        "inference_id": inference_id,
+        "user_id": user_id,
+    }
+    if passthrough:
+        # Return the raw model response and content type, without parsing the predictions
+        response = sm_runtime.invoke_endpoint(**args)
+        result["endpoint_variant"] = response["InvokedProductionVariant"]
+        result["content_type"] = response.get("ContentType")
+        result["raw_predictions"] = response["Body"].read()
+    else:
+        result["endpoint_variant"], result["predictions"] = invoke_endpoint(
+            args, generated_inference_id
         )
-    invoked_variant = response["InvokedProductionVariant"]
+    # Include the features to update the contextual statistics
+    if features is not None:
+        result["features"] = features
+    if target_model is not None:
+        result["target_model"] = target_model
+    return result
 
-    return {
+
+@xray_recorder.capture("Async Invocation")
+def handle_async_invocation(
+    strategy: str,
+    endpoint_name: str,
+    content_type: str,
+    inference_id: str,
+    user_id: str,
+    target_variant: str,
+    data,
+    request_identity: dict,
+    features: list = None,
+    accept: str = None,
+    input_location: str = None,
+):
+    """
+    Upload the input to S3 and queue the invocation, returning the locations for the client to poll.
+    The invocation metric is logged when the completion notification is received.
+    """
+    if async_inference is None:
+        raise Exception("Async inference is not enabled")
+    # Requests are routed by the variant weights, so the metric can only be attributed to a single variant
+    item = exp_metrics.get_endpoint_item(endpoint_name)
+    if item is None or len(item["variant_names"]) != 1:
+        raise Exception(
+            f"Async inference requires a single variant for endpoint: {endpoint_name}"
+        )
+    target_variant = item["variant_names"][0]
+    # Large inputs can be uploaded by the client, and provided as the input location
+    if input_location is None:
+        input_location = async_inference.put_input(
+            endpoint_name, inference_id, content_type, data
+        )
+    result = {
         "strategy": strategy,
         "endpoint_name": endpoint_name,
         "target_variant": target_variant,
-        "endpoint_variant": invoked_variant,
         "inference_id": inference_id,
         "user_id": user_id,
-        "predictions": json.loads(response["Body"].read()),
     }
+    # Include the features to update the contextual statistics
+    if features is not None:
+        result["features"] = features
+    # Store the request before invoking, so it exists when the notification is received
+    async_inference.put_request(result, request_identity)
+
+    logger.info(f"Invoke endpoint async for variant: {target_variant}")
+    args = {
+        "EndpointName": endpoint_name,
+        "ContentType": content_type,
+        "InferenceId": inference_id,
+        "InputLocation": input_location,
+    }
+    if accept is not None:
+        args["Accept"] = accept
+    response = sm_runtime.invoke_endpoint_async(**args)
+    return {
+        **result,
+        "input_location": input_location,
+        "output_location": response["OutputLocation"],
+    }
+
+
+@xray_recorder.capture("Async Completion")
+def handle_async_completion(message: dict):
+    """
+    Log the invocation metric for the variant of a completed async inference once, as SNS delivers
+    notifications at least once
+    """
+    inference_id = message["inferenceId"]
+    endpoint_name = message["requestParameters"]["endpointName"]
+    if message.get("invocationStatus") != "Completed":
+        logger.warning(
+            f"Async inference: {inference_id} failed: {message.get('failureReason')}"
+        )
+        return False
+    # With dedup the writes for the inference are applied once, otherwise the request is deleted once logged
+    dedup_key = None
+    if exp_dedup is not None:
+        dedup_key = exp_dedup.get_async_key(endpoint_name, inference_id)
+        if exp_dedup.is_processed(dedup_key):
+            logger.info(f"Async inference: {inference_id} already logged")
+            return False
+    request = async_inference.get_request(endpoint_name, inference_id)
+    if request is None:
+        return False
+    result = {
+        **request["result"],
+        "endpoint_variant": request["result"]["target_variant"],
+        "output_location": message["responseParameters"]["outputLocation"],
+    }
+    if not log_metric("invocation", result, request["request_identity"], dedup_key):
+        return False
+    if exp_dedup is not None:
+        exp_dedup.mark_processed(dedup_key)
+    async_inference.delete_request(endpoint_name, inference_id)
+    return True
 
 
 @xray_recorder.capture("Conversion")
@@ -158,15 +447,51 @@ def handle_conversion(
     user_id: str,
     user_variant: str,
     reward: float,
+    features: list = None,
+    attribution: str = "assignment",
 ):
-    return {
+    result = {
         "strategy": strategy,
         "endpoint_name": endpoint_name,
         "endpoint_variant": user_variant,
         "inference_id": inference_id,
         "user_id": user_id,
         "reward": reward,
+        "attribution": attribution,
     }
+    # Include the features to update the contextual statistics
+    if features is not None:
+        result["features"] = features
+    # Only apply the reward once per inference when updating metrics synchronously
+    if exp_dedup is not None and exp_dedup.is_processed(
+        exp_dedup.get_conversion_key(endpoint_name, inference_id)
+    ):
+        logger.info(f"Duplicate conversion for inference: {inference_id}")
+        result["duplicate"] = True
+    return result
+
+
+def get_features(body: dict):
+    """
+    Get the optional list of numeric context features from the request body
+    """
+    features = body.get("features")
+    if features is None:
+        return None
+    if not isinstance(features, list) or len(features) == 0:
+        raise Exception("Require features to be a non-empty list of numbers")
+    if len(features) > LinUCB.MAX_FEATURES:
+        raise Exception(f"Require at most {LinUCB.MAX_FEATURES} features")
+    return [float(f) for f in features]
+
+
+def get_data(body: dict):
+    """
+    Get the invocation data from the request body, where binary data such as images can be base64 encoded
+    """
+    if "data_base64" in body:
+        return base64.b64decode(body["data_base64"])
+    return body["data"]
 
 
 @xray_recorder.capture("Log Metric")
@@ -174,101 +499,247 @@ def log_metric(
     event_type: str,
     body: dict,
     request_identity: dict,
+    source: str = None,
 ):
-    # Merge all properties together into a flat dictionary
+    """
+    Log the metric, applying the writes once for the source when updating synchronously.
+    Returns True if the metric was logged.
+    """
+    # Merge all properties together into a flat dictionary, excluding the raw predictions for passthrough
+    body = dict([(k, v) for k, v in body.items() if k != "raw_predictions"])
     metrics = [
         {"timestamp": int(time.time()), "type": event_type, **body, **request_identity}
     ]
+    # Exclude bots and high frequency sources, counting the events per source in each window
+    if traffic_filter is not None:
+        traffic_filter.reset_after(TRAFFIC_WINDOW)
+        metrics = list(traffic_filter.filter(metrics))
+        if len(metrics) == 0:
+            return True
     try:
-        response = exp_metrics.log_metrics(metrics)
+        response = exp_metrics.log_metrics(metrics, source)
         logger.debug("Log metric response")
         logger.debug(response)
+        return True
     except Exception as e:
         # Log warning that we were unable to log metrics
         logger.warning("Unable to log metrics")
         logger.warning(e)
+        return False
+
+
+def log_conversion(result: dict, request_identity: dict):
+    """
+    Log the conversion metric, and with dedup record the conversion only once its writes have been applied
+    """
+    if exp_dedup is None:
+        log_metric("conversion", result, request_identity)
+        return
+    dedup_key = exp_dedup.get_conversion_key(
+        result["endpoint_name"], result["inference_id"]
+    )
+    if log_metric("conversion", result, request_identity, dedup_key):
+        exp_dedup.mark_processed(dedup_key)
+
+
+def get_request_variant(
+    endpoint_name: str,
+    user_id: str,
+    features: list = None,
+    endpoint_variant: str = None,
+    token: str = None,
+):
+    """
+    Get the strategy, variant, status code and assignment token for the request
+    """
+    if endpoint_variant is not None:
+        # Log the manual strategy for the endpoint variant
+        logger.info(
+            f"Manual override endpoint: {endpoint_name} variant: {endpoint_variant}"
+        )
+        return "Manual", endpoint_variant, 202, None
+    try:
+        # Get the configuration for the endpoint name
+        return get_user_variant(endpoint_name, user_id, features, token)
+    except Exception as e:
+        # Log warning and return fallback strategy
+        logger.warning("Unable to get user variant")
+        logger.warning(e)
+        return "Fallback", None, 202, None
+
+
+def log_cache_metrics():
+    """
+    Log the assignment cache hits and misses since the last log in the embedded metric format,
+    so CloudWatch extracts the hit rate without an api call on the request path
+    """
+    global cache_metrics_time
+    if assignment_cache is None:
+        return
+    with cache_metrics_lock:
+        now = time.time()
+        if now - cache_metrics_time < CACHE_METRICS_INTERVAL:
+            return
+        cache_metrics_time = now
+        stats = assignment_cache.get_stats(reset=True)
+    metric = {
+        "_aws": {
+            "Timestamp": int(now * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": "aws/sagemaker/Endpoints/ab-testing",
+                    "Dimensions": [["FunctionName"]],
+                    "Metrics": [
+                        {"Name": "AssignmentCacheHits", "Unit": "Count"},
+                        {"Name": "AssignmentCacheMisses", "Unit": "Count"},
+                        {"Name": "AssignmentCacheHitRate", "Unit": "None"},
+                    ],
+                }
+            ],
+        },
+        "FunctionName": os.getenv("AWS_LAMBDA_FUNCTION_NAME"),
+        "AssignmentCacheHits": stats["hits"],
+        "AssignmentCacheMisses": stats["misses"],
+        "AssignmentCacheHitRate": stats["hit_rate"],
+    }
+    # Print to stdout as the log handler prefixes messages with the level and request id
+    print(json.dumps(metric))
+
+
+def handle_request(path: str, body: dict, request_identity: dict):
+    """
+    Handle the request body for the path, returning the result and status code
+    """
+    endpoint_name = body.get("endpoint_name")
+    if endpoint_name is None:
+        raise Exception("Require endpoint name in body")
+
+    # Optionally allow overriding the endpoint variant
+    endpoint_variant = body.get("endpoint_variant")
+
+    if path == "/stats":
+        # Get stats for existing endpoint
+        return handle_stats(endpoint_name, body.get("rollups"))
+
+    # Get inference id and user id from request, or generate a new ones
+    inference_id = body.get("inference_id", str(uuid.uuid4()))
+    user_id = str(body.get("user_id", uuid.uuid4()))
+    features = get_features(body)
+
+    strategy, user_variant, status_code, token = get_request_variant(
+        endpoint_name,
+        user_id,
+        features,
+        endpoint_variant,
+        body.get("assignment_token"),
+    )
+
+    # Based on path handle invocation
+    if path == "/invocation" and body.get("async"):
+        # Queue the invocation, and log the metric when it completes
+        result = handle_async_invocation(
+            strategy=strategy,
+            endpoint_name=endpoint_name,
+            content_type=body.get("content_type", "application/json"),
+            inference_id=inference_id,
+            user_id=user_id,
+            target_variant=user_variant,
+            data=None if "input_location" in body else get_data(body),
+            request_identity=request_identity,
+            features=features,
+            accept=body.get("accept"),
+            input_location=body.get("input_location"),
+        )
+    elif path == "/invocation":
+        result = handle_invocation(
+            strategy=strategy,
+            endpoint_name=endpoint_name,
+            content_type=body.get("content_type", "application/json"),
+            inference_id=inference_id,
+            user_id=user_id,
+            target_variant=user_variant,
+            data=get_data(body),
+            features=features,
+            target_model=body.get("target_model"),
+            accept=body.get("accept"),
+            passthrough=bool(body.get("passthrough", False)),
+            # Generated inference ids aren't sent if the request is batched, so it can share a batch
+            generated_inference_id="inference_id" not in body,
+        )
+        log_metric("invocation", result, request_identity)
+    elif path == "/conversion":
+        # Get default reward of "1" unless provided
+        reward = float(body.get("reward", "1"))
+        result = handle_conversion(
+            strategy=strategy,
+            endpoint_name=endpoint_name,
+            inference_id=inference_id,
+            user_id=user_id,
+            user_variant=user_variant,
+            reward=reward,
+            features=features,
+            # Join to the invoked variant if the inference id is provided
+            attribution=("inference_id" if "inference_id" in body else "assignment"),
+        )
+        if not result.get("duplicate"):
+            log_conversion(result, request_identity)
+    else:
+        raise Exception(f"Invalid path: {path}")
+
+    # Return the assignment token to the client, which is not logged with the metrics
+    if token is not None:
+        result["assignment_token"] = token
+    return result, status_code
+
+
+def handle_async_notifications(event):
+    """
+    Log the invocation metrics for the async inference notifications published to SNS
+    """
+    metric_count = 0
+    for message in AsyncInference.get_notifications(event):
+        if handle_async_completion(message):
+            metric_count += 1
+    return {"statusCode": 200, "body": json.dumps({"metric_count": metric_count})}
 
 
 def lambda_handler(event, context):
     try:
         logger.debug(json.dumps(event))
 
+        # Handle the completion notifications for async invocations
+        if "Records" in event:
+            return handle_async_notifications(event)
+
         # Get elements from API payload
         if event["httpMethod"] in ["POST", "PUT"] and "body" in event:
-            body = json.loads(event["body"])
+            # The body is base64 encoded as the api accepts binary media types
+            body = json.loads(
+                base64.b64decode(event["body"])
+                if event.get("isBase64Encoded")
+                else event["body"]
+            )
         else:
             raise Exception("Require HTTP POST with json body")
 
-        endpoint_name = body.get("endpoint_name")
-        if endpoint_name is None:
-            raise Exception("Require endpoint name in body")
-
-        # Optionally allow overriding the endpoint variant
-        endpoint_variant = body.get("endpoint_variant")
-
-        # If this is a POST/PUT to root, then we are creating a new endpoint
-        path = event["path"]
-        if path == "/stats":
-            # Get stats for existing endpoint
-            result, status_code = handle_stats(endpoint_name)
-        else:
-            # Get inference id and user id from request, or generate a new ones
-            inference_id = body.get("inference_id", str(uuid.uuid4()))
-            user_id = str(body.get("user_id", uuid.uuid4()))
-
-            if endpoint_variant is None:
-                try:
-                    # Get the configuration for the endpoint name
-                    strategy, user_variant, status_code = get_user_variant(
-                        endpoint_name, user_id
-                    )
-                except Exception as e:
-                    # Log warning and return fallback strategy
-                    logger.warning("Unable to get user variant")
-                    logger.warning(e)
-                    strategy, user_variant, status_code = ("Fallback", None, 202)
-            else:
-                # Log the manual strategy for the endpoint variant
-                logger.info(
-                    f"Manual override endpoint: {endpoint_name} variant: {endpoint_variant}"
-                )
-                strategy, user_variant, status_code = ("Manual", endpoint_variant, 202)
-
-            # Get request identity that is non null (eg sourcIP, useragent)
-            request_identity = {
-                "source_ip": event["requestContext"]["identity"]["sourceIp"],
-                "user_agent": event["requestContext"]["identity"]["userAgent"],
+        # Get request identity that is non null (eg sourcIP, useragent)
+        request_identity = {
+            "source_ip": event["requestContext"]["identity"]["sourceIp"],
+            "user_agent": event["requestContext"]["identity"]["userAgent"],
+        }
+        result, status_code = handle_request(event["path"], body, request_identity)
+
+        log_cache_metrics()
+        if is_passthrough(result):
+            # Return the raw predictions as binary, with the experiment metadata in headers
+            headers, raw_predictions = get_passthrough_response(result)
+            return {
+                "statusCode": status_code,
+                "headers": headers,
+                "body": base64.b64encode(raw_predictions).decode("ascii"),
+                "isBase64Encoded": True,
             }
 
-            # Based on path handle invocation
-            if path == "/invocation":
-                content_type = body.get("content_type", "application/json")
-                data = body["data"]
-                result = handle_invocation(
-                    strategy=strategy,
-                    endpoint_name=endpoint_name,
-                    content_type=content_type,
-                    inference_id=inference_id,
-                    user_id=user_id,
-                    target_variant=user_variant,
-                    data=data,
-                )
-                log_metric("invocation", result, request_identity)
-            elif path == "/conversion":
-                # Get default reward of "1" unless provided
-                reward = float(body.get("reward", "1"))
-                result = handle_conversion(
-                    strategy=strategy,
-                    endpoint_name=endpoint_name,
-                    inference_id=inference_id,
-                    user_id=user_id,
-                    user_variant=user_variant,
-                    reward=reward,
-                )
-                log_metric("conversion", result, request_identity)
-            else:
-                raise Exception(f"Invalid path: {path}")
-
         # Log result succesful result and return
         logger.debug(json.dumps(result))
         return {"statusCode": status_code, "body": json.dumps(result)}
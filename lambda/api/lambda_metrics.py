@@ -1,7 +1,6 @@
 import boto3
 from botocore.exceptions import ClientError
 import gzip
-import io
 import json
 import os
 import logging
@@ -10,14 +9,54 @@ from aws_xray_sdk.core import patch_all
 from urllib.parse import unquote_plus
 
 from experiment_metrics import ExperimentMetrics
+from experiment_dedup import ExperimentDedup
+from experiment_attribution import ExperimentAttribution
+from experiment_rollups import ExperimentRollups
+from experiment_storage import get_storage
+from event_archive import EventArchive
+from traffic_filter import TrafficFilter
 
 # set environment variable
 METRICS_TABLE = os.environ["METRICS_TABLE"]
 DELIVERY_STREAM_NAME = os.environ["DELIVERY_STREAM_NAME"]
+METRICS_SHARDS = int(os.getenv("METRICS_SHARDS", "0"))
+DEDUP_TABLE = os.getenv("DEDUP_TABLE")
+DEDUP_TTL_DAYS = int(os.getenv("DEDUP_TTL_DAYS", "7"))
+TRAFFIC_RULES = os.getenv(
+    "TRAFFIC_RULES", os.path.join(os.path.dirname(__file__), "traffic_rules.json")
+)
+INVOCATIONS_TABLE = os.getenv("INVOCATIONS_TABLE")
+ATTRIBUTION_WINDOW = int(os.getenv("ATTRIBUTION_WINDOW", "86400"))
+ROLLUPS_TABLE = os.getenv("ROLLUPS_TABLE")
+ROLLUPS_RETENTION_DAYS = int(os.getenv("ROLLUPS_RETENTION_DAYS", "30"))
+ARCHIVE_BUCKET = os.getenv("ARCHIVE_BUCKET")
+ARCHIVE_PREFIX = os.getenv("ARCHIVE_PREFIX", "archive/")
+STAGE_NAME = os.getenv("STAGE_NAME", "dev")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "dynamodb")
+STORAGE_URL = os.getenv("STORAGE_URL")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
 # Create the experiment classes from the lambda layer
-exp_metrics = ExperimentMetrics(METRICS_TABLE, DELIVERY_STREAM_NAME)
+exp_rollups = (
+    ExperimentRollups(ROLLUPS_TABLE, ROLLUPS_RETENTION_DAYS) if ROLLUPS_TABLE else None
+)
+exp_dedup = ExperimentDedup(DEDUP_TABLE, DEDUP_TTL_DAYS) if DEDUP_TABLE else None
+exp_metrics = ExperimentMetrics(
+    METRICS_TABLE,
+    DELIVERY_STREAM_NAME,
+    metrics_shards=METRICS_SHARDS,
+    rollups=exp_rollups,
+    storage=get_storage(STORAGE_BACKEND, url=STORAGE_URL),
+    dedup=exp_dedup,
+)
+exp_attribution = (
+    ExperimentAttribution(INVOCATIONS_TABLE, ATTRIBUTION_WINDOW)
+    if INVOCATIONS_TABLE
+    else None
+)
+traffic_filter = (
+    TrafficFilter.from_file(TRAFFIC_RULES) if os.path.exists(TRAFFIC_RULES) else None
+)
 
 # Configure logging and patch xray
 logger = logging.getLogger()
@@ -28,53 +67,96 @@ patch_all()
 dynamodb = boto3.resource("dynamodb")
 s3 = boto3.resource("s3")
 
+# Archive the events as parquet if the bucket is provided
+event_archive = (
+    EventArchive(s3.Bucket(ARCHIVE_BUCKET), ARCHIVE_PREFIX, STAGE_NAME)
+    if ARCHIVE_BUCKET
+    else None
+)
+
 
 @xray_recorder.capture("Read Metrics")
-def get_metrics(event):
+def get_metrics(bucket: str, key: str):
     """
-    Download the s3 file contents, and enuemrage json lienes to extract metrics
+    Stream the s3 file contents, and enumerate json lines to extract metrics
     """
     metrics = []
-    for record in event["Records"]:
-        bucket = record["s3"]["bucket"]["name"]
-        key = unquote_plus(record["s3"]["object"]["key"])
-        obj = s3.Object(bucket, key)
-        with gzip.GzipFile(fileobj=obj.get()["Body"]) as gzipfile:
-            content = gzipfile.read()
-            buf = io.BytesIO(content)
-            line = buf.readline()
-            while line:
-                metrics.append(json.loads(line))
-                line = buf.readline()
+    obj = s3.Object(bucket, key)
+    with gzip.GzipFile(fileobj=obj.get()["Body"]) as gzipfile:
+        for line in gzipfile:
+            metrics.append(json.loads(line))
     return metrics
 
 
 @xray_recorder.capture("Write Metrics")
-def update_metrics(metrics):
-    # TODO: Consider filtering metrics for high frequency sourceIp or bad user agent
-    exp_metrics.update_variant_metrics(metrics)
+def update_metrics(metrics, source: str = None):
+    # Exclude bots and high frequency sources before the counts are applied
+    if traffic_filter is not None:
+        metrics = list(traffic_filter.filter(metrics))
+
+    # Remove conversions already applied by another source. Each write is applied once for the source,
+    # so a retry after a partial update keeps its conversions and only applies the remaining writes.
+    if exp_dedup is not None:
+        metrics = exp_dedup.filter_conversions(metrics, source=source)
+    # Credit conversions to the variant of the invocation with the same inference id
+    pending_ids = []
+    if exp_attribution is not None:
+        metrics, pending_ids = exp_attribution.join_metrics(metrics)
+    exp_metrics.update_variant_metrics(metrics, source=source)
+    # Remove the pending conversions only once their counts are applied, so a retry attributes them again
+    if len(pending_ids) > 0:
+        exp_attribution.remove_pending(pending_ids)
+    return len(metrics)
+
+
+def process_record(record):
+    """
+    Update metrics for the s3 object in the record, skipping objects that have already been processed
+    """
+    bucket = record["s3"]["bucket"]["name"]
+    key = unquote_plus(record["s3"]["object"]["key"])
+    object_key = None
+    if exp_dedup is not None:
+        object_key = exp_dedup.get_object_key(bucket, key)
+        if exp_dedup.is_processed(object_key):
+            logger.info(f"Skipping processed object: {object_key}")
+            return 0
+    metrics = get_metrics(bucket, key)
+    # Archive all events named after the source object, so retries replace the same files
+    if event_archive is not None:
+        event_archive.write_events(metrics, os.path.basename(key))
+    metric_count = update_metrics(metrics, object_key)
+    # Record the object once all writes are applied, so a redelivery doesn't read it again
+    if object_key is not None:
+        exp_dedup.mark_processed(object_key)
+    return metric_count
 
 
 def lambda_handler(event, context):
     try:
         logger.debug(json.dumps(event))
 
+        # Count the events per source across all files in the invocation
+        if traffic_filter is not None:
+            traffic_filter.reset()
+
         # Get metrics from s3 json lines
-        metrics = []
+        metric_count = 0
         if "Records" in event:
-            metrics = get_metrics(event)
+            for record in event["Records"]:
+                metric_count += process_record(record)
         elif "Metrics" in event:
-            metrics = event["Metrics"]
-
-        update_metrics(metrics)
+            # Asynchronous invocation retries keep the request id, so use it as the source of the metrics
+            metric_count = update_metrics(
+                event["Metrics"], f"request#{context.aws_request_id}"
+            )
 
-        # TODO: Consider correlating ground through metrics against for user_id invocations/clicks to return
-        # see: https://docs.aws.amazon.com/sagemaker/latest/dg/model-monitor-model-quality-merge.html
-        # see also: https://github.com/aws/amazon-sagemaker-examples/blob/master/sagemaker_model_monitor/model_quality/model_quality_churn_sdk.ipynb
+        if traffic_filter is not None:
+            traffic_filter.log_summary()
 
         # Log the metrics count
         result = {
-            "metric_count": len(metrics),
+            "metric_count": metric_count,
         }
         return {"statusCode": 200, "body": json.dumps(result)}
     except ClientError as e:
@@ -1,20 +1,27 @@
 import boto3
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 import os
+from time import time
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 
 from experiment_metrics import ExperimentMetrics
-from algorithm import ThompsonSampling
+from experiment_storage import get_storage
+from algorithm import ThompsonSampling, STRATEGY_NAMES
 
 # Get environment variables
 METRICS_TABLE = os.environ["METRICS_TABLE"]
 DELIVERY_STREAM_NAME = os.environ["DELIVERY_STREAM_NAME"]
+METRICS_SHARDS = int(os.getenv("METRICS_SHARDS", "0"))
 STAGE_NAME = os.environ["STAGE_NAME"]
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "dynamodb")
+STORAGE_URL = os.getenv("STORAGE_URL")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 ENDPOINT_PREFIX = os.getenv("ENDPOINT_PREFIX", "")
+RECONCILE_WORKERS = int(os.getenv("RECONCILE_WORKERS", "16"))
 
 # Configure logging and patch xray
 logger = logging.getLogger()
@@ -22,7 +29,12 @@ logger.setLevel(LOG_LEVEL)
 patch_all()
 
 # Create the experiment classes from the lambda layer
-exp_metrics = ExperimentMetrics(METRICS_TABLE, DELIVERY_STREAM_NAME)
+exp_metrics = ExperimentMetrics(
+    METRICS_TABLE,
+    DELIVERY_STREAM_NAME,
+    metrics_shards=METRICS_SHARDS,
+    storage=get_storage(STORAGE_BACKEND, url=STORAGE_URL),
+)
 
 # Configure logging and patch xray
 logger = logging.getLogger()
@@ -33,28 +45,136 @@ patch_all()
 sm_client = boto3.client("sagemaker")
 
 
-@xray_recorder.capture("Get Endpoint Variants")
-def get_endpoint_variants(endpoint_name):
+def get_variants(response: dict):
     """
-    Get the list of production variant names for an endpoint
+    Return the list of production variant names and weights from the describe endpoint response
     """
-    logger.info(f"Getting variants for endpoint: {endpoint_name}")
-    response = sm_client.describe_endpoint(EndpointName=endpoint_name)
-    endpoint_variants = [
+    return [
         {
             "variant_name": r["VariantName"],
             "initial_variant_weight": r["CurrentWeight"],
         }
         for r in response["ProductionVariants"]
     ]
+
+
+@xray_recorder.capture("Get Endpoint Variants")
+def get_endpoint_variants(endpoint_name):
+    """
+    Get the list of production variant names for an endpoint
+    """
+    logger.info(f"Getting variants for endpoint: {endpoint_name}")
+    response = sm_client.describe_endpoint(EndpointName=endpoint_name)
+    endpoint_variants = get_variants(response)
     logger.debug(endpoint_variants)
     return endpoint_variants
 
 
+def get_registration(endpoint_name: str, endpoint_tags: dict):
+    """
+    Return the strategy configuration from the endpoint tags with a status code of 200,
+    or None with the status code and message if the endpoint is not enabled for this stage
+    """
+    # If this endpoint does not match prefix or not enabled return Not Modified (304)
+    endpoint_enabled = endpoint_tags.get("ab-testing:enabled", "").lower() == "true"
+    if not (endpoint_name.startswith(ENDPOINT_PREFIX) and endpoint_enabled):
+        error_message = (
+            f"Endpoint: {endpoint_name} not enabled for prefix: {ENDPOINT_PREFIX}"
+        )
+        return None, 304, error_message
+
+    # If the API stage name doesn't match the deployment stage name return Not Modified (304)
+    deployment_stage = endpoint_tags.get("sagemaker:deployment-stage")
+    if deployment_stage != STAGE_NAME:
+        error_message = f"Endpoint: {endpoint_name} deployment stage: {deployment_stage} not equal to API stage: {STAGE_NAME}"
+        return None, 304, error_message
+
+    # Use defaults if enabled is provided without additional arguments
+    try:
+        registration = {
+            "strategy": endpoint_tags.get("ab-testing:strategy", "ThompsonSampling"),
+            "epsilon": float(endpoint_tags.get("ab-testing:epsilon", 0.1)),
+            "warmup": int(endpoint_tags.get("ab-testing:warmup", 0)),
+            "auto_stop": endpoint_tags.get("ab-testing:auto-stop", "").lower()
+            == "true",
+            "reward_range": float(endpoint_tags.get("ab-testing:reward-range", 1.0)),
+        }
+    except ValueError as e:
+        error_message = f"Endpoint: {endpoint_name} has an invalid tag: {e}"
+        return None, 400, error_message
+    if registration["strategy"] not in STRATEGY_NAMES:
+        error_message = f"Endpoint: {endpoint_name} strategy: {registration['strategy']} not supported."
+        return None, 400, error_message
+    if registration["reward_range"] <= 0:
+        error_message = f"Endpoint: {endpoint_name} reward range: {registration['reward_range']} must be positive."
+        return None, 400, error_message
+    return registration, 200, None
+
+
+def is_same_registration(
+    registered: dict,
+    endpoint_variants: list,
+    strategy: str,
+    epsilon: float,
+    warmup: int,
+    auto_stop: bool,
+    reward_range: float = 1.0,
+):
+    """
+    Return true if the registered endpoint has the same variants and configuration
+    """
+    return (
+        registered is not None
+        and registered["deleted_at"] is None
+        and registered["variant_names"]
+        == [v["variant_name"] for v in endpoint_variants]
+        and registered["strategy"] == strategy
+        and registered["epsilon"] == epsilon
+        and registered["warmup"] == warmup
+        and registered["auto_stop"] == auto_stop
+        and registered["reward_range"] == reward_range
+    )
+
+
+def is_registered(
+    endpoint_name: str,
+    endpoint_variants: list,
+    strategy: str,
+    epsilon: float,
+    warmup: int,
+    auto_stop: bool,
+    reward_range: float = 1.0,
+):
+    """
+    Return true if the endpoint is registered with the same variants and configuration
+    """
+    try:
+        endpoint_metrics = exp_metrics.get_endpoint_metrics(endpoint_name)
+    except Exception as e:
+        logger.debug(e)
+        return False
+    registered = {
+        **endpoint_metrics,
+        "variant_names": [
+            v["variant_name"] for v in endpoint_metrics["variant_metrics"]
+        ],
+    }
+    return is_same_registration(
+        registered,
+        endpoint_variants,
+        strategy,
+        epsilon,
+        warmup,
+        auto_stop,
+        reward_range,
+    )
+
+
 @xray_recorder.capture("Delete")
 def handle_delete(endpoint_name: str):
     response = exp_metrics.delete_endpoint(
         endpoint_name=endpoint_name,
+        timestamp=int(time()),
     )
     result = {
         "endpoint_name": endpoint_name,
@@ -63,31 +183,219 @@ def handle_delete(endpoint_name: str):
 
 
 @xray_recorder.capture("Register")
-def handle_register(endpoint_name: str, strategy: str, epsilon: float, warmup: int):
-    endpoint_variants = get_endpoint_variants(endpoint_name)
-    response = exp_metrics.create_variant_metrics(
-        endpoint_name=endpoint_name,
-        endpoint_variants=endpoint_variants,
-        strategy=strategy,
-        epsilon=epsilon,
-        warmup=warmup,
-    )
+def handle_register(
+    endpoint_name: str,
+    strategy: str,
+    epsilon: float,
+    warmup: int,
+    auto_stop: bool = False,
+    endpoint_variants: list = None,
+    reward_range: float = 1.0,
+):
+    if endpoint_variants is None:
+        endpoint_variants = get_endpoint_variants(endpoint_name)
     result = {
         "endpoint_name": endpoint_name,
         "endpoint_variants": endpoint_variants,
         "strategy": strategy,
         "epsilon": epsilon,
         "warmup": warmup,
+        "auto_stop": auto_stop,
+        "reward_range": reward_range,
     }
+
+    # If only the weights have changed (eg by the weights controller) preserve the existing metrics
+    if is_registered(
+        endpoint_name,
+        endpoint_variants,
+        strategy,
+        epsilon,
+        warmup,
+        auto_stop,
+        reward_range,
+    ):
+        logger.info(f"Updating weights for registered endpoint: {endpoint_name}")
+        exp_metrics.update_variant_weights(endpoint_name, endpoint_variants)
+        return result, 200
+
+    response = exp_metrics.create_variant_metrics(
+        endpoint_name=endpoint_name,
+        endpoint_variants=endpoint_variants,
+        strategy=strategy,
+        epsilon=epsilon,
+        warmup=warmup,
+        timestamp=int(time()),
+        auto_stop=auto_stop,
+        reward_range=reward_range,
+    )
     if "Attributes" not in response:
         return result, 201
     return result, 200
 
 
+def map_concurrent(fn, items: list):
+    """
+    Return the results of the function for each item run in a thread pool, with the current trace
+    """
+    entity = xray_recorder.get_trace_entity()
+
+    def run(item):
+        xray_recorder.set_trace_entity(entity)
+        return fn(item)
+
+    with ThreadPoolExecutor(max_workers=RECONCILE_WORKERS) as executor:
+        return list(executor.map(run, items))
+
+
+def list_endpoint_names():
+    """
+    Return the names of all endpoints that start with the prefix
+    """
+    args = {"NameContains": ENDPOINT_PREFIX} if ENDPOINT_PREFIX else {}
+    paginator = sm_client.get_paginator("list_endpoints")
+    return [
+        e["EndpointName"]
+        for page in paginator.paginate(**args)
+        for e in page["Endpoints"]
+        if e["EndpointName"].startswith(ENDPOINT_PREFIX)
+    ]
+
+
+def describe_endpoint_tags(endpoint_name: str):
+    """
+    Return the endpoint name, describe endpoint response and tags, or None for the response and tags if failed
+    """
+    try:
+        response = sm_client.describe_endpoint(EndpointName=endpoint_name)
+        paginator = sm_client.get_paginator("list_tags")
+        endpoint_tags = dict(
+            [
+                (t["Key"], t["Value"])
+                for page in paginator.paginate(ResourceArn=response["EndpointArn"])
+                for t in page["Tags"]
+            ]
+        )
+        return endpoint_name, response, endpoint_tags
+    except Exception as e:
+        logger.warning(f"Unable to describe endpoint: {endpoint_name}")
+        logger.warning(e)
+        return endpoint_name, None, None
+
+
+def get_registered():
+    """
+    Return the registered endpoints with the variant names and configuration
+    """
+    items = exp_metrics.get_registered_items(
+        [
+            "endpoint_name",
+            "variant_names",
+            "strategy",
+            "epsilon",
+            "warmup",
+            "auto_stop",
+            "reward_range",
+        ]
+    )
+    return dict(
+        [
+            (
+                item["endpoint_name"],
+                {
+                    "deleted_at": None,
+                    "variant_names": item["variant_names"],
+                    "strategy": item["strategy"],
+                    "epsilon": float(item["epsilon"]),
+                    "warmup": int(item["warmup"]),
+                    "auto_stop": bool(item.get("auto_stop", False)),
+                    "reward_range": float(item.get("reward_range", 1)),
+                },
+            )
+            for item in items
+        ]
+    )
+
+
+def reconcile_endpoint(args: tuple):
+    """
+    Register or delete the endpoint, returning the endpoint name and the status code or error message
+    """
+    endpoint_name, registration, endpoint_variants = args
+    try:
+        if registration is None:
+            handle_delete(endpoint_name)
+            return endpoint_name, 200
+        _, status_code = handle_register(
+            endpoint_name, **registration, endpoint_variants=endpoint_variants
+        )
+        return endpoint_name, status_code
+    except Exception as e:
+        logger.warning(f"Unable to reconcile endpoint: {endpoint_name}")
+        logger.warning(e)
+        return endpoint_name, str(e)
+
+
+@xray_recorder.capture("Reconcile")
+def handle_reconcile():
+    """
+    Register all enabled endpoints that are in service with changed variants or configuration,
+    and delete registered endpoints that no longer exist or are no longer enabled
+    """
+    endpoint_names = list_endpoint_names()
+    registered = get_registered()
+    described = map_concurrent(describe_endpoint_tags, endpoint_names)
+
+    changes = []
+    enabled = set()
+    errors = {}
+    for endpoint_name, response, endpoint_tags in described:
+        # Keep the registration if the endpoint couldn't be described
+        if response is None:
+            enabled.add(endpoint_name)
+            continue
+        registration, status_code, error_message = get_registration(
+            endpoint_name, endpoint_tags
+        )
+        # Keep the registration and report the error if the endpoint tags are invalid
+        if status_code == 400:
+            enabled.add(endpoint_name)
+            errors[endpoint_name] = error_message
+        if status_code != 200:
+            continue
+        enabled.add(endpoint_name)
+        endpoint_variants = get_variants(response)
+        if response["EndpointStatus"] == "InService" and not is_same_registration(
+            registered.get(endpoint_name), endpoint_variants, **registration
+        ):
+            changes.append((endpoint_name, registration, endpoint_variants))
+    changes += [(e, None, None) for e in registered if e not in enabled]
+
+    logger.info(f"Reconciling {len(changes)} of {len(endpoint_names)} endpoints")
+    results = map_concurrent(reconcile_endpoint, changes)
+    return {
+        "endpoint_count": len(endpoint_names),
+        "registered": [e for e, r, _ in changes if r is not None],
+        "deleted": [e for e, r, _ in changes if r is None],
+        "errors": {
+            **errors,
+            **dict([(e, r) for e, r in results if isinstance(r, str)]),
+        },
+    }, 200
+
+
 def lambda_handler(event, context):
     try:
         logger.debug(json.dumps(event))
 
+        # Reconcile all endpoints for the scheduled event
+        if (
+            event.get("source") == "aws.events"
+            and event.get("detail-type") == "Scheduled Event"
+        ):
+            result, status_code = handle_reconcile()
+            logger.info(json.dumps(result))
+            return {"statusCode": status_code, "body": json.dumps(result)}
+
         if not (
             event.get("source") == "aws.sagemaker"
             and event.get("detail-type") == "SageMaker Endpoint State Change"
@@ -96,40 +404,32 @@ def lambda_handler(event, context):
                 "Expect CloudWatch Event for SageMaker Endpoint Stage Change"
             )
 
-        # If this endpoint does not match prefix or not enabled return Not Modified (304)
+        # If this endpoint is not enabled for this stage return Not Modified (304)
         endpoint_name = event["detail"]["EndpointName"]
         endpoint_tags = event["detail"]["Tags"]
-        endpoint_enabled = endpoint_tags.get("ab-testing:enabled", "").lower() == "true"
-        if not (endpoint_name.startswith(ENDPOINT_PREFIX) and endpoint_enabled):
-            error_message = (
-                f"Endpoint: {endpoint_name} not enabled for prefix: {ENDPOINT_PREFIX}"
-            )
-            logger.warning(error_message)
-            return {"statusCode": 304, "body": error_message}
-
-        # If the API stage name doesn't match the deployment stage name return Not Modified (304)
-        deployment_stage = endpoint_tags.get("sagemaker:deployment-stage")
-        if deployment_stage != STAGE_NAME:
-            error_message = f"Endpoint: {endpoint_name} deployment stage: {deployment_stage} not equal to API stage: {STAGE_NAME}"
+        registration, status_code, error_message = get_registration(
+            endpoint_name, endpoint_tags
+        )
+        if status_code == 304:
             logger.warning(error_message)
-            return {"statusCode": 304, "body": error_message}
+            return {"statusCode": status_code, "body": error_message}
 
         # Delete or register the endpoint depending on status change
         endpoint_status = event["detail"]["EndpointStatus"]
         if endpoint_status == "DELETING":
             logger.info(f"Deleting Endpoint: {endpoint_name}")
             result, status_code = handle_delete(endpoint_name)
+        elif registration is None:
+            # Return Bad Request (400) if the strategy is not supported
+            logger.warning(error_message)
+            return {"statusCode": status_code, "body": error_message}
         elif endpoint_status == "IN_SERVICE":
-            # Use defaults if enabled is provided without additional arguments
-            strategy = endpoint_tags.get("ab-testing:strategy", "ThompsonSampling")
-            epsilon = float(endpoint_tags.get("ab-testing:epsilon", 0.1))
-            warmup = int(endpoint_tags.get("ab-testing:warmup", 0))
             logger.info(
-                f"Registering Endpoint: {endpoint_name} with strategy: {strategy}, epsilon: {epsilon}, warmup: {warmup}"
-            )
-            result, status_code = handle_register(
-                endpoint_name, strategy, epsilon, warmup
+                f"Registering Endpoint: {endpoint_name} with strategy: {registration['strategy']}, "
+                f"epsilon: {registration['epsilon']}, warmup: {registration['warmup']}, "
+                f"auto stop: {registration['auto_stop']}, reward range: {registration['reward_range']}"
             )
+            result, status_code = handle_register(endpoint_name, **registration)
         else:
             error_message = (
                 f"Endpoint: {endpoint_name} Status: {endpoint_status} not supported."
@@ -0,0 +1,258 @@
+import boto3
+from botocore.exceptions import ClientError
+import json
+import logging
+import os
+from time import time
+from aws_xray_sdk.core import xray_recorder
+from aws_xray_sdk.core import patch_all
+
+from experiment_metrics import ExperimentMetrics
+from experiment_storage import get_storage
+from algorithm import ThompsonSampling, LinUCB, get_algorithm
+
+# Get environment variables
+METRICS_TABLE = os.environ["METRICS_TABLE"]
+DELIVERY_STREAM_NAME = os.environ["DELIVERY_STREAM_NAME"]
+METRICS_SHARDS = int(os.getenv("METRICS_SHARDS", "0"))
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "dynamodb")
+STORAGE_URL = os.getenv("STORAGE_URL")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+ENDPOINT_PREFIX = os.getenv("ENDPOINT_PREFIX", "")
+WEIGHTS_MIN_WEIGHT = float(os.getenv("WEIGHTS_MIN_WEIGHT", "0.05"))
+WEIGHTS_THRESHOLD = float(os.getenv("WEIGHTS_THRESHOLD", "0.1"))
+WEIGHTS_MIN_INTERVAL = int(os.getenv("WEIGHTS_MIN_INTERVAL", "3600"))
+WEIGHTS_SCALE_CAPACITY = os.getenv("WEIGHTS_SCALE_CAPACITY", "False").lower() == "true"
+
+# Configure logging and patch xray
+logger = logging.getLogger()
+logger.setLevel(LOG_LEVEL)
+patch_all()
+
+# Create the experiment classes from the lambda layer
+exp_metrics = ExperimentMetrics(
+    METRICS_TABLE,
+    DELIVERY_STREAM_NAME,
+    metrics_shards=METRICS_SHARDS,
+    storage=get_storage(STORAGE_BACKEND, url=STORAGE_URL),
+)
+
+# Define he boto3 client resources
+sm_client = boto3.client("sagemaker")
+as_client = boto3.client("application-autoscaling")
+
+
+def get_desired_weights(endpoint_metrics: dict):
+    """
+    Get the desired weight per variant from the bandit allocation, with a minimum weight so variants keep capacity
+    """
+    variant_metrics = endpoint_metrics["variant_metrics"]
+    winner = endpoint_metrics["winner"]
+    if winner is not None:
+        allocation = dict(
+            [
+                (v["variant_name"], 1.0 if v["variant_name"] == winner else 0.0)
+                for v in variant_metrics
+            ]
+        )
+    else:
+        # Contextual strategy allocation depends on features, so use the non-contextual counts
+        strategy = endpoint_metrics["strategy"]
+        if strategy == LinUCB.STRATEGY_NAME:
+            strategy = ThompsonSampling.STRATEGY_NAME
+        algo = get_algorithm(
+            strategy,
+            variant_metrics,
+            endpoint_metrics["epsilon"],
+            reward_range=endpoint_metrics["reward_range"],
+        )
+        allocation = algo.get_allocation()
+    weights = dict([(k, max(a, WEIGHTS_MIN_WEIGHT)) for k, a in allocation.items()])
+    total = sum(weights.values())
+    return dict([(k, round(w / total, 3)) for k, w in weights.items()])
+
+
+def get_capacity_bounds(endpoint_name: str, variant_names: list, total_instances: int):
+    """
+    Get the min and max instance count per variant from the autoscaling scalable targets, defaulting to at least one
+    """
+    bounds = dict([(v, (1, total_instances)) for v in variant_names])
+    response = as_client.describe_scalable_targets(
+        ServiceNamespace="sagemaker",
+        ResourceIds=[f"endpoint/{endpoint_name}/variant/{v}" for v in variant_names],
+        ScalableDimension="sagemaker:variant:DesiredInstanceCount",
+    )
+    for target in response["ScalableTargets"]:
+        variant_name = target["ResourceId"].split("/")[-1]
+        bounds[variant_name] = (target["MinCapacity"], target["MaxCapacity"])
+    return bounds
+
+
+def get_desired_instances(total_instances: int, weights: dict, bounds: dict):
+    """
+    Get the instances per variant in proportion to the weights within the bounds, keeping the total if possible
+    """
+    shares = dict([(k, total_instances * w) for k, w in weights.items()])
+    instances = dict(
+        [(k, min(max(int(s), bounds[k][0]), bounds[k][1])) for k, s in shares.items()]
+    )
+    # Add to the variant furthest below its share, or remove from the variant furthest above its share
+    while sum(instances.values()) < total_instances:
+        below = [k for k in instances if instances[k] < bounds[k][1]]
+        if len(below) == 0:
+            break
+        instances[max(below, key=lambda k: shares[k] - instances[k])] += 1
+    while sum(instances.values()) > total_instances:
+        above = [k for k in instances if instances[k] > bounds[k][0]]
+        if len(above) == 0:
+            break
+        instances[min(above, key=lambda k: shares[k] - instances[k])] -= 1
+    return instances
+
+
+def get_desired_weights_and_capacities(
+    endpoint_name: str, desired_weights: dict, current_instances: dict
+):
+    """
+    Get the desired weight per variant, optionally moving the instances across variants in proportion to the weights
+    """
+    desired = [
+        {"VariantName": k, "DesiredWeight": w} for k, w in desired_weights.items()
+    ]
+    if WEIGHTS_SCALE_CAPACITY and len(current_instances) > 0:
+        total_instances = sum(current_instances.values())
+        bounds = get_capacity_bounds(
+            endpoint_name, list(current_instances), total_instances
+        )
+        desired_instances = get_desired_instances(
+            total_instances,
+            dict([(k, desired_weights[k]) for k in current_instances]),
+            bounds,
+        )
+        for d in desired:
+            if d["VariantName"] in desired_instances:
+                d["DesiredInstanceCount"] = desired_instances[d["VariantName"]]
+    return desired
+
+
+@xray_recorder.capture("Update Endpoint Weights")
+def handle_update_weights(endpoint_name: str):
+    """
+    Update the endpoint weights if the bandit allocation has moved more than the threshold
+    """
+    endpoint_metrics = exp_metrics.get_endpoint_metrics(endpoint_name)
+    variant_metrics = endpoint_metrics["variant_metrics"]
+    result = {"endpoint_name": endpoint_name, "updated": False}
+
+    # Don't update weights until all variants are warmed up
+    warmup = endpoint_metrics["warmup"]
+    if any(v["invocation_count"] <= warmup for v in variant_metrics):
+        result["message"] = "Endpoint variants not warmed up"
+        return result
+
+    # Get the current weights, and only update if the variants match the registered variants
+    response = sm_client.describe_endpoint(EndpointName=endpoint_name)
+    if response["EndpointStatus"] != "InService":
+        result["message"] = (
+            f"Endpoint status: {response['EndpointStatus']} not InService"
+        )
+        return result
+    current_weights = dict(
+        [(r["VariantName"], r["CurrentWeight"]) for r in response["ProductionVariants"]]
+    )
+    current_total = sum(current_weights.values())
+    current_instances = dict(
+        [
+            (r["VariantName"], r["CurrentInstanceCount"])
+            for r in response["ProductionVariants"]
+            if "CurrentInstanceCount" in r
+        ]
+    )
+    desired_weights = get_desired_weights(endpoint_metrics)
+    if set(current_weights) != set(desired_weights):
+        result["message"] = "Endpoint variants not equal to registered variants"
+        return result
+    result["current_weights"] = current_weights
+    result["desired_weights"] = desired_weights
+
+    # Apply hysteresis so that we don't update weights for small changes in allocation
+    max_change = max(
+        abs(desired_weights[k] - current_weights[k] / current_total)
+        for k in desired_weights
+    )
+    if max_change < WEIGHTS_THRESHOLD:
+        result["message"] = (
+            f"Weight change: {max_change:.3f} less than threshold: {WEIGHTS_THRESHOLD}"
+        )
+        return result
+
+    desired = get_desired_weights_and_capacities(
+        endpoint_name, desired_weights, current_instances
+    )
+
+    # Rate limit the updates per endpoint, releasing the update time if the update fails
+    timestamp = int(time())
+    if not exp_metrics.update_weights_updated_at(
+        endpoint_name, WEIGHTS_MIN_INTERVAL, timestamp
+    ):
+        result["message"] = (
+            f"Weights updated within the last {WEIGHTS_MIN_INTERVAL} seconds"
+        )
+        return result
+
+    logger.info(f"Updating endpoint: {endpoint_name} weights: {desired}")
+    try:
+        sm_client.update_endpoint_weights_and_capacities(
+            EndpointName=endpoint_name,
+            DesiredWeightsAndCapacities=desired,
+        )
+    except Exception as e:
+        exp_metrics.clear_weights_updated_at(endpoint_name, timestamp)
+        raise e
+    result["desired_weights_and_capacities"] = desired
+    result["updated"] = True
+    return result
+
+
+def lambda_handler(event, context):
+    try:
+        logger.debug(json.dumps(event))
+
+        # Update the provided endpoint, otherwise all registered endpoints for the scheduled event
+        if "EndpointName" in event:
+            endpoint_names = [event["EndpointName"]]
+        else:
+            endpoint_names = [
+                e
+                for e in exp_metrics.get_registered_endpoints()
+                if e.startswith(ENDPOINT_PREFIX)
+            ]
+
+        results = []
+        for endpoint_name in endpoint_names:
+            try:
+                result = handle_update_weights(endpoint_name)
+            except Exception as e:
+                # Log warning and continue with the next endpoint
+                logger.warning(
+                    f"Unable to update weights for endpoint: {endpoint_name}"
+                )
+                logger.warning(e)
+                result = {
+                    "endpoint_name": endpoint_name,
+                    "updated": False,
+                    "message": str(e),
+                }
+            logger.info(result)
+            results.append(result)
+
+        return {"statusCode": 200, "body": json.dumps(results)}
+    except ClientError as e:
+        logger.error(e)
+        # Get boto3 specific error message
+        error_message = e.response["Error"]["Message"]
+        logger.error(error_message)
+        raise Exception(error_message)
+    except Exception as e:
+        logger.error(e)
+        raise e
@@ -0,0 +1,29 @@
+# Contains the response headers for passthrough invocations, which return the raw model response body and content
+# type to the caller with the experiment metadata in headers, instead of parsing the predictions as json.
+
+# The result properties returned as headers
+PASSTHROUGH_HEADERS = [
+    ("strategy", "X-AB-Strategy"),
+    ("endpoint_name", "X-AB-Endpoint-Name"),
+    ("target_variant", "X-AB-Target-Variant"),
+    ("endpoint_variant", "X-AB-Endpoint-Variant"),
+    ("inference_id", "X-AB-Inference-Id"),
+    ("user_id", "X-AB-User-Id"),
+    ("target_model", "X-AB-Target-Model"),
+    ("assignment_token", "X-AB-Assignment-Token"),
+]
+
+
+def is_passthrough(result: dict):
+    return "raw_predictions" in result
+
+
+def get_passthrough_response(result: dict):
+    """
+    Return the headers with the content type and experiment metadata, and the raw predictions body
+    """
+    headers = {"Content-Type": result.get("content_type") or "application/octet-stream"}
+    for name, header in PASSTHROUGH_HEADERS:
+        if result.get(name) is not None:
+            headers[header] = str(result[name])
+    return headers, result["raw_predictions"]
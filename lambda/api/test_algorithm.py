@@ -1,4 +1,15 @@
-from algorithm import EpsilonGreedy, UCB1, ThompsonSampling, WeightedSampling
+from algorithm import (
+    EpsilonGreedy,
+    UCB1,
+    UCBV,
+    ThompsonSampling,
+    GaussianThompsonSampling,
+    TopTwoThompsonSampling,
+    SuccessiveElimination,
+    WeightedSampling,
+    LinUCB,
+    get_algorithm,
+)
 
 
 def test_epsilon_greedy():
@@ -102,6 +113,160 @@ def test_thompson_sampling():
     assert max(lst, key=lst.count) == "v3"
 
 
+def test_thompson_sampling_rewards_greater_than_one():
+    algo = ThompsonSampling(
+        [
+            {
+                "variant_name": "v1",
+                "invocation_count": 10,
+                "reward_sum": 50,
+            },
+            {
+                "variant_name": "v2",
+                "invocation_count": 10,
+                "reward_sum": 1,
+            },
+        ]
+    )
+    # Validate we don't fail with a negative beta parameter
+    lst = [algo.select_variant() for i in range(100)]
+    assert max(lst, key=lst.count) == "v1"
+
+
+def test_UCBV():
+    # Same mean, but v2 has a much higher variance so gets the larger bonus
+    algo = UCBV(
+        [
+            {
+                "variant_name": "v1",
+                "invocation_count": 100,
+                "reward_sum": 50,
+                "reward_sum_squares": 25,
+            },
+            {
+                "variant_name": "v2",
+                "invocation_count": 100,
+                "reward_sum": 50,
+                "reward_sum_squares": 500,
+            },
+        ]
+    )
+    assert algo.select_variant() == "v2"
+
+
+def test_UCBV_reward_range():
+    # v2 has fewer invocations, so is only explored when the bonus is scaled by the default range
+    variant_metrics = [
+        {
+            "variant_name": "v1",
+            "invocation_count": 1000,
+            "reward_sum": 600,
+            "reward_sum_squares": 360,
+        },
+        {
+            "variant_name": "v2",
+            "invocation_count": 100,
+            "reward_sum": 50,
+            "reward_sum_squares": 25,
+        },
+    ]
+    algo = get_algorithm("UCBV", variant_metrics, epsilon=0.1)
+    assert algo.select_variant() == "v2"
+    algo = get_algorithm("UCBV", variant_metrics, epsilon=0.1, reward_range=0.1)
+    assert algo.select_variant() == "v1"
+
+
+def test_gaussian_thompson_sampling():
+    # v2 has fewer conversions, but higher revenue per invocation
+    algo = GaussianThompsonSampling(
+        [
+            {
+                "variant_name": "v1",
+                "invocation_count": 1000,
+                "reward_sum": 1000,
+                "reward_sum_squares": 2000,
+            },
+            {
+                "variant_name": "v2",
+                "invocation_count": 1000,
+                "reward_sum": 2000,
+                "reward_sum_squares": 8000,
+            },
+        ]
+    )
+
+    lst = [algo.select_variant() for i in range(100)]
+    assert max(lst, key=lst.count) == "v2"
+
+
+def test_top_two_thompson_sampling():
+    algo = TopTwoThompsonSampling(
+        [
+            {
+                "variant_name": "v1",
+                "invocation_count": 1000,
+                "reward_sum": 100,
+            },
+            {
+                "variant_name": "v2",
+                "invocation_count": 1000,
+                "reward_sum": 500,
+            },
+        ]
+    )
+    # Validate the challenger gets around half the traffic even when clearly worse
+    lst = [algo.select_variant() for i in range(1000)]
+    assert 400 < lst.count("v1") < 600
+
+
+def test_successive_elimination():
+    algo = SuccessiveElimination(
+        [
+            {
+                "variant_name": "v1",
+                "invocation_count": 1000,
+                "reward_sum": 100,
+            },
+            {
+                "variant_name": "v2",
+                "invocation_count": 1000,
+                "reward_sum": 150,
+            },
+            {
+                "variant_name": "v3",
+                "invocation_count": 1200,
+                "reward_sum": 600,
+            },
+        ]
+    )
+    # Validate v1 and v2 are eliminated
+    assert [v["variant_name"] for v in algo.active_variants()] == ["v3"]
+    assert algo.select_variant() == "v3"
+    assert algo.samples_to_decision() == 0
+
+
+def test_samples_to_decision():
+    variant_metrics = [
+        {
+            "variant_name": "v1",
+            "invocation_count": 100,
+            "reward_sum": 10,
+        },
+        {
+            "variant_name": "v2",
+            "invocation_count": 100,
+            "reward_sum": 15,
+        },
+    ]
+    # Require ~ 7.85 * (0.09 + 0.1275) / 0.05^2 = 683 invocations per variant
+    algo = SuccessiveElimination(variant_metrics)
+    assert algo.samples_to_decision() == 1166
+
+    # Not able to estimate for equal rewards
+    variant_metrics[1]["reward_sum"] = 10
+    assert algo.samples_to_decision() is None
+
+
 def test_weighted_sampling():
     algo = WeightedSampling(
         [
@@ -112,3 +277,52 @@ def test_weighted_sampling():
 
     lst = [algo.select_variant() for i in range(100)]
     assert max(lst, key=lst.count) == "v1"
+
+
+def test_linucb():
+    # v1 rewards the first feature, v2 rewards the second feature
+    variant_metrics = [
+        {
+            "variant_name": "v1",
+            "context_a": [[100, 0], [0, 100]],
+            "context_b": [50, 0],
+        },
+        {
+            "variant_name": "v2",
+            "context_a": [[100, 0], [0, 100]],
+            "context_b": [0, 50],
+        },
+    ]
+    algo = LinUCB(variant_metrics, features=[1, 0])
+    assert algo.select_variant() == "v1"
+    algo = LinUCB(variant_metrics, features=[0, 1])
+    assert algo.select_variant() == "v2"
+
+
+def test_linucb_explore():
+    # Prefer the variant without statistics for the requested features
+    algo = LinUCB(
+        [
+            {
+                "variant_name": "v1",
+                "context_a": [[100]],
+                "context_b": [10],
+            },
+            {"variant_name": "v2"},
+        ],
+        features=[1],
+    )
+    assert algo.select_variant() == "v2"
+
+
+def test_allocation():
+    algo = WeightedSampling(
+        [
+            {"variant_name": "v1", "initial_variant_weight": 0.75},
+            {"variant_name": "v2", "initial_variant_weight": 0.25},
+        ],
+    )
+
+    allocation = algo.get_allocation(samples=1000)
+    assert sum(allocation.values()) == 1
+    assert 0.65 < allocation["v1"] < 0.85
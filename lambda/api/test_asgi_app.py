@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+from asgi_app import create_app, get_request_identity
+
+
+def call_json(app, method: str, path: str, body: bytes = b"", chunks: int = 1):
+    sent = call_app(app, method, path, body, chunks)
+    return sent[0]["status"], json.loads(sent[1]["body"])
+
+
+def call_app(app, method: str, path: str, body: bytes = b"", chunks: int = 1):
+    # Send the request body in chunks, and collect the response messages
+    size = max(1, len(body) // chunks)
+    parts = [body[i : i + size] for i in range(0, len(body), size)] or [b""]
+    messages = [
+        {"type": "http.request", "body": p, "more_body": i < len(parts) - 1}
+        for i, p in enumerate(parts)
+    ]
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "headers": [
+            (b"user-agent", b"test"),
+            (b"x-forwarded-for", b"6.6.6.6, 1.2.3.4"),
+        ],
+        "client": ("10.0.0.1", 1234),
+    }
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return sent
+
+
+def test_asgi_app():
+    requests = []
+
+    def handle_request(path: str, body: dict, request_identity: dict):
+        requests.append((path, body, request_identity))
+        if "endpoint_name" not in body:
+            raise Exception("Require endpoint name in body")
+        return {"endpoint_name": body["endpoint_name"]}, 201
+
+    app = create_app(handle_request, max_workers=1)
+
+    # Routes are handled with the request identity from the forwarded address
+    body = json.dumps({"endpoint_name": "e1", "user_id": "user-1"}).encode()
+    assert call_json(app, "POST", "/invocation", body, chunks=3) == (
+        201,
+        {"endpoint_name": "e1"},
+    )
+    assert requests[0] == (
+        "/invocation",
+        {"endpoint_name": "e1", "user_id": "user-1"},
+        {"source_ip": "1.2.3.4", "user_agent": "test"},
+    )
+
+    # Invalid requests return an error status with a message
+    assert call_json(app, "POST", "/conversion", b"{}")[0] == 400
+    assert call_json(app, "POST", "/conversion", b"not json")[0] == 400
+    assert call_json(app, "GET", "/stats")[0] == 405
+    assert call_json(app, "POST", "/other", body)[0] == 404
+    assert call_json(app, "GET", "/ping") == (200, {"status": "ok"})
+    assert len(requests) == 2
+
+
+def test_get_request_identity():
+    scope = {
+        "headers": [(b"x-forwarded-for", b"6.6.6.6, 1.2.3.4, 10.0.0.2")],
+        "client": ("10.0.0.1", 1234),
+    }
+    # Validate the address appended by the last trusted proxy is used, not the leftmost sent by the client
+    assert get_request_identity(scope, 1)["source_ip"] == "10.0.0.2"
+    assert get_request_identity(scope, 2)["source_ip"] == "1.2.3.4"
+    assert get_request_identity(scope, 5)["source_ip"] == "6.6.6.6"
+    assert get_request_identity(scope, 0)["source_ip"] == "10.0.0.1"
+
+
+def test_asgi_app_websocket():
+    app = create_app(lambda path, body, request_identity: ({}, 200), max_workers=1)
+    sent = []
+
+    async def receive():
+        return {"type": "websocket.connect"}
+
+    async def send(message):
+        sent.append(message)
+
+    # Validate websockets receive a 404 response with the extension, or are closed without it
+    scope = {"type": "websocket", "path": "/invocation", "headers": []}
+    asyncio.run(
+        app({**scope, "extensions": {"websocket.http.response": {}}}, receive, send)
+    )
+    assert sent[0]["status"] == 404
+    sent.clear()
+    asyncio.run(app(scope, receive, send))
+    assert sent == [{"type": "websocket.close", "code": 1008}]
+
+
+def test_asgi_app_passthrough():
+    def handle_request(path: str, body: dict, request_identity: dict):
+        result = {
+            "strategy": "ThompsonSampling",
+            "endpoint_variant": "e1v1",
+            "target_variant": None,
+            "content_type": "image/png",
+            "raw_predictions": b"\x89PNG",
+        }
+        return result, 200
+
+    app = create_app(handle_request, max_workers=1)
+
+    # The raw predictions are returned with the content type and metadata headers
+    sent = call_app(app, "POST", "/invocation", b'{"passthrough": true}')
+    assert sent[0]["status"] == 200
+    assert dict(sent[0]["headers"]) == {
+        b"content-type": b"image/png",
+        b"x-ab-strategy": b"ThompsonSampling",
+        b"x-ab-endpoint-variant": b"e1v1",
+    }
+    assert sent[1]["body"] == b"\x89PNG"
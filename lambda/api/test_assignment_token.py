@@ -0,0 +1,38 @@
+from time import time
+
+from assignment_token import AssignmentToken
+
+
+def test_verify_token():
+    signer = AssignmentToken("secret", ttl_seconds=60)
+    token = signer.create_token("user-1", "e1", "e1v1", ["e1v1", "e1v2"])
+
+    # Token is valid for the same user, endpoint and variants in any order
+    assert signer.verify_token(token, "user-1", "e1", ["e1v2", "e1v1"]) == "e1v1"
+
+    # Token is not valid for another user or endpoint, or once the variants change
+    assert signer.verify_token(token, "user-2", "e1", ["e1v1", "e1v2"]) is None
+    assert signer.verify_token(token, "user-1", "e2", ["e1v1", "e1v2"]) is None
+    assert signer.verify_token(token, "user-1", "e1", ["e1v1", "e1v3"]) is None
+
+    # Token is not valid when signed with another secret
+    other = AssignmentToken("other-secret")
+    assert other.verify_token(token, "user-1", "e1", ["e1v1", "e1v2"]) is None
+
+
+def test_verify_token_invalid():
+    signer = AssignmentToken("secret")
+
+    # Expired tokens are not valid
+    token = signer.create_token(
+        "user-1", "e1", "e1v1", ["e1v1"], expires_at=int(time()) - 1
+    )
+    assert signer.verify_token(token, "user-1", "e1", ["e1v1"]) is None
+
+    # Tampered and malformed tokens are not valid
+    payload, signature = signer.create_token("user-1", "e1", "e1v1", ["e1v1"]).split(
+        "."
+    )
+    other_payload, _ = signer.create_token("user-1", "e1", "e1v2", ["e1v1"]).split(".")
+    for token in [f"{other_payload}.{signature}", payload, "a.b.c", "!.!", None]:
+        assert signer.verify_token(token, "user-1", "e1", ["e1v1"]) is None
@@ -0,0 +1,112 @@
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+import io
+import json
+
+from async_inference import AsyncInference
+
+
+def test_put_and_get_request():
+    async_inference = AsyncInference("test-bucket")
+
+    result = {
+        "strategy": "ThompsonSampling",
+        "endpoint_name": "e1",
+        "target_variant": "e1v1",
+        "inference_id": "i1",
+        "user_id": "user-1",
+    }
+    request_identity = {"source_ip": "127.0.0.1", "user_agent": "test"}
+    request = json.dumps({"result": result, "request_identity": request_identity})
+
+    # See the s3 put_object and get_object
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.put_object
+    with Stubber(async_inference.s3) as stubber:
+        stubber.add_response(
+            "put_object",
+            {},
+            {
+                "Bucket": "test-bucket",
+                "Key": "async/input/e1/i1",
+                "Body": "{}",
+                "ContentType": "application/json",
+            },
+        )
+        stubber.add_response(
+            "put_object",
+            {},
+            {
+                "Bucket": "test-bucket",
+                "Key": "async/requests/e1/i1.json",
+                "Body": request,
+                "ContentType": "application/json",
+            },
+        )
+        stubber.add_response(
+            "get_object",
+            {"Body": StreamingBody(io.BytesIO(request.encode()), len(request))},
+            {"Bucket": "test-bucket", "Key": "async/requests/e1/i1.json"},
+        )
+        stubber.add_client_error(
+            "get_object",
+            "NoSuchKey",
+            expected_params={
+                "Bucket": "test-bucket",
+                "Key": "async/requests/e1/i2.json",
+            },
+        )
+        stubber.add_response(
+            "delete_object",
+            {},
+            {"Bucket": "test-bucket", "Key": "async/requests/e1/i1.json"},
+        )
+
+        input_location = async_inference.put_input("e1", "i1", "application/json", "{}")
+        assert input_location == "s3://test-bucket/async/input/e1/i1"
+        async_inference.put_request(result, request_identity)
+
+        # Validate the stored request is returned, and None when not found
+        assert async_inference.get_request("e1", "i1") == {
+            "result": result,
+            "request_identity": request_identity,
+        }
+        assert async_inference.get_request("e1", "i2") is None
+
+        # Validate the request is deleted once logged
+        async_inference.delete_request("e1", "i1")
+
+
+def test_get_notifications():
+    # See: https://docs.aws.amazon.com/sagemaker/latest/dg/async-inference-check-predictions.html
+    message = {
+        "awsRegion": "us-east-1",
+        "eventTime": "2022-01-01T00:00:00.000Z",
+        "receivedTime": "2022-01-01T00:00:00.000Z",
+        "invocationStatus": "Completed",
+        "requestParameters": {
+            "contentType": "application/json",
+            "endpointName": "e1",
+            "inputLocation": "s3://test-bucket/async/input/e1/i1",
+        },
+        "responseParameters": {
+            "contentType": "application/json",
+            "outputLocation": "s3://test-bucket/async/output/i1.out",
+        },
+        "inferenceId": "i1",
+        "eventVersion": "1.0",
+        "eventSource": "aws:sagemaker",
+        "eventName": "InferenceResult",
+    }
+    event = {
+        "Records": [
+            {"EventSource": "aws:sns", "Sns": {"Message": json.dumps(message)}},
+            {
+                "EventSource": "aws:sns",
+                "Sns": {"Message": json.dumps({"eventName": "TestEvent"})},
+            },
+            {"eventSource": "aws:s3", "s3": {}},
+        ]
+    }
+
+    # Validate only the inference result notifications are returned
+    assert AsyncInference.get_notifications(event) == [message]
@@ -0,0 +1,60 @@
+import pytest
+
+from event_archive import SCHEMA, get_columns, get_partition
+
+metrics = [
+    {
+        "timestamp": 3600,
+        "type": "invocation",
+        "endpoint_name": "e1",
+        "endpoint_variant": "e1v1",
+        "inference_id": "i1",
+        "user_id": "a",
+        "features": [1, 0],
+        "predictions": [{"label": ["__label__NotHelpful"], "prob": [0.7]}],
+    },
+    {
+        "timestamp": 3601,
+        "type": "conversion",
+        "endpoint_name": "e1",
+        "endpoint_variant": "e1v1",
+        "inference_id": "i1",
+        "user_id": "a",
+        "reward": 1,
+    },
+]
+
+
+def test_get_partition():
+    assert get_partition(metrics[0]) == ("e1", "1970-01-01", "01")
+
+
+def test_get_columns():
+    columns = get_columns(metrics)
+    assert list(columns) == [name for name, _ in SCHEMA]
+    assert columns["timestamp"] == [3600, 3601]
+    assert columns["reward"] == [None, 1.0]
+    assert columns["features"] == [[1.0, 0.0], None]
+    assert columns["predictions"] == [
+        '[{"label": ["__label__NotHelpful"], "prob": [0.7]}]',
+        None,
+    ]
+
+
+def test_write_events():
+    pytest.importorskip("pyarrow")
+    from event_archive import EventArchive
+
+    class Bucket:
+        objects = {}
+
+        def put_object(self, Key, Body):
+            self.objects[Key] = Body
+
+    bucket = Bucket()
+    archive = EventArchive(bucket, "archive/", "dev")
+    keys = archive.write_events(metrics, "events-1")
+    assert keys == [
+        "archive/stage=dev/endpoint=e1/date=1970-01-01/hour=01/events-1.parquet"
+    ]
+    assert len(bucket.objects[keys[0]]) > 0
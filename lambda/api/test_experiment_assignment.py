@@ -1,6 +1,7 @@
-from botocore.stub import Stubber
+from botocore.stub import Stubber, ANY
+from time import time
 
-from experiment_assignment import ExperimentAssignment
+from experiment_assignment import ExperimentAssignment, AssignmentCache, get_ttl
 
 
 def test_get_assignment():
@@ -9,15 +10,16 @@ def test_get_assignment():
 
     # See the dynamodb get_item
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.get_item
-    with Stubber(exp_assignment.dynamodb.meta.client) as stubber:
+    with Stubber(exp_assignment.storage.dynamodb.meta.client) as stubber:
         expected_response = {
             "Item": {
                 "variant_name": {"S": "e1v1"},
             }
         }
         expected_params = {
-            "AttributesToGet": ["variant_name"],
+            "ExpressionAttributeNames": {"#ttl": "ttl"},
             "Key": {"endpoint_name": "test-endpoint", "user_id": "user-1"},
+            "ProjectionExpression": "variant_name, #ttl",
             "TableName": "test-ass",
         }
         stubber.add_response("get_item", expected_response, expected_params)
@@ -28,13 +30,87 @@ def test_get_assignment():
         assert response == "e1v1"
 
 
+def test_get_assignment_near_expiry():
+    # Create new assignment object
+    exp_assignment = ExperimentAssignment("test-ass")
+
+    with Stubber(exp_assignment.storage.dynamodb.meta.client) as stubber:
+        # Return an assignment that expires within the refresh days
+        expected_response = {
+            "Item": {
+                "variant_name": {"S": "e1v1"},
+                "ttl": {"N": str(get_ttl(1))},
+            }
+        }
+        expected_params = {
+            "ExpressionAttributeNames": {"#ttl": "ttl"},
+            "Key": {"endpoint_name": "test-endpoint", "user_id": "user-1"},
+            "ProjectionExpression": "variant_name, #ttl",
+            "TableName": "test-ass",
+        }
+        stubber.add_response("get_item", expected_response, expected_params)
+
+        # Extend the ttl only if the variant is unchanged and not already refreshed
+        expected_params = {
+            "ConditionExpression": "variant_name = :variant_name AND #ttl < :refresh",
+            "ExpressionAttributeNames": {"#ttl": "ttl"},
+            "ExpressionAttributeValues": {
+                ":ttl": ANY,
+                ":variant_name": "e1v1",
+                ":refresh": ANY,
+            },
+            "Key": {"endpoint_name": "test-endpoint", "user_id": "user-1"},
+            "TableName": "test-ass",
+            "UpdateExpression": "SET #ttl = :ttl",
+        }
+        stubber.add_response("update_item", {}, expected_params)
+
+        response = exp_assignment.get_assignment(
+            user_id="user-1", endpoint_name="test-endpoint"
+        )
+        assert response == "e1v1"
+        stubber.assert_no_pending_responses()
+
+
+def test_get_assignment_expired():
+    # Create new assignment object
+    exp_assignment = ExperimentAssignment("test-ass")
+
+    with Stubber(exp_assignment.storage.dynamodb.meta.client) as stubber:
+        # Return an assignment that has expired, but not yet been deleted
+        expected_response = {
+            "Item": {
+                "variant_name": {"S": "e1v1"},
+                "ttl": {"N": str(int(time()) - 60)},
+            }
+        }
+        expected_params = {
+            "ExpressionAttributeNames": {"#ttl": "ttl"},
+            "Key": {"endpoint_name": "test-endpoint", "user_id": "user-1"},
+            "ProjectionExpression": "variant_name, #ttl",
+            "TableName": "test-ass",
+        }
+        stubber.add_response("get_item", expected_response, expected_params)
+        stubber.add_response("put_item", {}, None)
+
+        # Validate the expired assignment is not refreshed, so the user is reassigned
+        response = exp_assignment.get_assignment(
+            user_id="user-1", endpoint_name="test-endpoint"
+        )
+        assert response is None
+        exp_assignment.put_assignment(
+            user_id="user-1", endpoint_name="test-endpoint", variant_name="e1v2"
+        )
+        stubber.assert_no_pending_responses()
+
+
 def test_put_assignment():
     # Create new metrics object and
     exp_assignment = ExperimentAssignment("test-ass")
 
     # See the dyanmodb put_item
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.put_item
-    with Stubber(exp_assignment.dynamodb.meta.client) as stubber:
+    with Stubber(exp_assignment.storage.dynamodb.meta.client) as stubber:
         expected_response = {
             "ConsumedCapacity": {
                 "CapacityUnits": 1,
@@ -56,3 +132,71 @@ def test_put_assignment():
             user_id="user-1", endpoint_name="test-endpoint", variant_name="e1v1", ttl=0
         )
         assert response == expected_response
+
+
+def test_get_assignment_cached():
+    # Create new assignment object with a cache
+    exp_assignment = ExperimentAssignment(
+        "test-ass", cache=AssignmentCache(max_size=2, ttl_seconds=60)
+    )
+
+    with Stubber(exp_assignment.storage.dynamodb.meta.client) as stubber:
+        expected_params = {
+            "ExpressionAttributeNames": {"#ttl": "ttl"},
+            "Key": {"endpoint_name": "test-endpoint", "user_id": "user-1"},
+            "ProjectionExpression": "variant_name, #ttl",
+            "TableName": "test-ass",
+        }
+        stubber.add_response(
+            "get_item", {"Item": {"variant_name": {"S": "e1v1"}}}, expected_params
+        )
+        stubber.add_response(
+            "get_item", {"Item": {"variant_name": {"S": "e1v3"}}}, expected_params
+        )
+        stubber.add_response("put_item", {}, None)
+
+        # Only the first read for the same variants goes to the table
+        for _ in range(2):
+            response = exp_assignment.get_assignment(
+                "user-1", "test-endpoint", ["e1v1", "e1v2"]
+            )
+            assert response == "e1v1"
+
+        # Changing the endpoint variants invalidates the cached assignment
+        response = exp_assignment.get_assignment(
+            "user-1", "test-endpoint", ["e1v1", "e1v3"]
+        )
+        assert response == "e1v3"
+
+        # Put assignment populates the cache for new users
+        exp_assignment.put_assignment(
+            "user-2", "test-endpoint", "e1v1", variant_names=["e1v1", "e1v3"]
+        )
+        assert exp_assignment.get_assignment(
+            "user-2", "test-endpoint", ["e1v1", "e1v3"]
+        )
+        stubber.assert_no_pending_responses()
+
+    assert exp_assignment.cache.get_stats(reset=True) == {
+        "hits": 2,
+        "misses": 2,
+        "hit_rate": 0.5,
+        "size": 2,
+    }
+    assert exp_assignment.cache.get_stats()["hits"] == 0
+
+
+def test_assignment_cache_eviction():
+    cache = AssignmentCache(max_size=2, ttl_seconds=60)
+    cache.put("user-1", "e1", "e1v1")
+    cache.put("user-2", "e1", "e1v1")
+    # Reading user-1 makes user-2 the least recently used
+    assert cache.get("user-1", "e1") == "e1v1"
+    cache.put("user-3", "e1", "e1v2")
+    assert cache.get("user-2", "e1") is None
+    assert cache.get("user-1", "e1") == "e1v1"
+
+    # Expired assignments are not returned
+    cache = AssignmentCache(max_size=2, ttl_seconds=0)
+    cache.put("user-1", "e1", "e1v1")
+    assert cache.get("user-1", "e1") is None
@@ -0,0 +1,119 @@
+from botocore.stub import Stubber, ANY
+import json
+
+from experiment_attribution import ExperimentAttribution
+
+
+def get_metric(type: str, inference_id: str, variant: str, timestamp: int):
+    metric = {
+        "timestamp": timestamp,
+        "type": type,
+        "endpoint_name": "e1",
+        "endpoint_variant": variant,
+        "inference_id": inference_id,
+        "user_id": "a",
+    }
+    if type == "conversion":
+        metric["reward"] = 1.0
+        metric["attribution"] = "inference_id"
+    return metric
+
+
+def test_join_metrics():
+    # Create new attribution object with a 1 hour window
+    exp_attribution = ExperimentAttribution("test-invocations", 3600)
+
+    invocation = get_metric("invocation", "i1", "e1v1", 0)
+    # Conversion for i1 that arrived in an earlier file while assigned to another variant
+    pending_conversion = get_metric("conversion", "i1", "e1v2", 10)
+    # Conversion for i2 that was invoked in an earlier file, but is outside the window
+    late_conversion = get_metric("conversion", "i2", "e1v2", 7200)
+    # Conversion for i3 that has not been invoked yet
+    early_conversion = get_metric("conversion", "i3", "e1v2", 20)
+
+    with Stubber(exp_attribution.dynamodb.meta.client) as stubber:
+        expected_params = {
+            "Key": {"inference_id": "i1"},
+            "TableName": "test-invocations",
+            "UpdateExpression": ANY,
+            "ExpressionAttributeNames": {"#timestamp": "timestamp", "#ttl": "ttl"},
+            "ExpressionAttributeValues": {
+                ":e": "e1",
+                ":v": "e1v1",
+                ":t": 0,
+                ":ttl": 90000,
+            },
+            "ReturnValues": "ALL_OLD",
+        }
+        expected_response = {
+            "Attributes": {
+                "inference_id": {"S": "i1"},
+                "pending_conversions": {
+                    "L": [{"S": json.dumps(pending_conversion)}],
+                },
+            }
+        }
+        stubber.add_response("update_item", expected_response, expected_params)
+
+        # The late conversion fails the pending condition, so get the invocation
+        stubber.add_client_error(
+            "update_item",
+            "ConditionalCheckFailedException",
+            expected_params={
+                "Key": {"inference_id": "i2"},
+                "TableName": "test-invocations",
+                "UpdateExpression": ANY,
+                "ConditionExpression": "attribute_not_exists(endpoint_variant)",
+                "ExpressionAttributeNames": {"#ttl": "ttl"},
+                "ExpressionAttributeValues": ANY,
+            },
+        )
+        expected_response = {
+            "Item": {
+                "inference_id": {"S": "i2"},
+                "endpoint_name": {"S": "e1"},
+                "endpoint_variant": {"S": "e1v1"},
+                "timestamp": {"N": "0"},
+            }
+        }
+        expected_params = {
+            "Key": {"inference_id": "i2"},
+            "TableName": "test-invocations",
+        }
+        stubber.add_response("get_item", expected_response, expected_params)
+
+        # The early conversion is added as pending
+        expected_params = {
+            "Key": {"inference_id": "i3"},
+            "TableName": "test-invocations",
+            "UpdateExpression": ANY,
+            "ConditionExpression": "attribute_not_exists(endpoint_variant)",
+            "ExpressionAttributeNames": {"#ttl": "ttl"},
+            "ExpressionAttributeValues": {
+                ":empty": [],
+                ":c": [json.dumps(early_conversion)],
+                ":ttl": 90020,
+            },
+        }
+        stubber.add_response("update_item", {}, expected_params)
+
+        joined_metrics, pending_ids = exp_attribution.join_metrics(
+            [late_conversion, early_conversion, invocation]
+        )
+
+        # The pending conversions are removed once the counts are applied
+        expected_params = {
+            "Key": {"inference_id": "i1"},
+            "TableName": "test-invocations",
+            "UpdateExpression": "REMOVE pending_conversions",
+        }
+        stubber.add_response("update_item", {}, expected_params)
+        exp_attribution.remove_pending(pending_ids)
+        stubber.assert_no_pending_responses()
+
+    # Validate the pending conversion is credited to the invoked variant
+    assert joined_metrics == [
+        invocation,
+        {**pending_conversion, "endpoint_variant": "e1v1", "assigned_variant": "e1v2"},
+    ]
+    assert pending_ids == ["i1"]
@@ -0,0 +1,136 @@
+from botocore.stub import Stubber
+
+from experiment_dedup import ExperimentDedup
+
+
+def test_mark_processed():
+    # Create new dedup object
+    exp_dedup = ExperimentDedup("test-dedup")
+
+    # See the dynamodb put_item
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.put_item
+    with Stubber(exp_dedup.dynamodb.meta.client) as stubber:
+        expected_params = {
+            "ConditionExpression": "attribute_not_exists(dedup_key)",
+            "Item": {"dedup_key": "s3://test-bucket/test-key", "ttl": 1},
+            "TableName": "test-dedup",
+        }
+        stubber.add_response("put_item", {}, expected_params)
+        stubber.add_client_error(
+            "put_item",
+            "ConditionalCheckFailedException",
+            expected_params=expected_params,
+        )
+
+        # Validate the second time the object is marked it has already been processed
+        object_key = exp_dedup.get_object_key("test-bucket", "test-key")
+        assert exp_dedup.mark_processed(object_key, ttl=1)
+        assert not exp_dedup.mark_processed(object_key, ttl=1)
+
+
+def test_filter_conversions():
+    # Create new dedup object
+    exp_dedup = ExperimentDedup("test-dedup")
+
+    metrics = [
+        {"type": "invocation", "endpoint_name": "e1", "inference_id": "i1"},
+        {"type": "conversion", "endpoint_name": "e1", "inference_id": "i1"},
+        {"type": "conversion", "endpoint_name": "e1", "inference_id": "i1"},
+        {"type": "conversion", "endpoint_name": "e1", "inference_id": "i2"},
+    ]
+
+    with Stubber(exp_dedup.dynamodb.meta.client) as stubber:
+        # The first conversion is new, and the second was processed in a previous batch
+        expected_params = {
+            "ConditionExpression": "attribute_not_exists(dedup_key)",
+            "Item": {"dedup_key": "conversion#e1#i1", "ttl": 1},
+            "TableName": "test-dedup",
+        }
+        stubber.add_response("put_item", {}, expected_params)
+        expected_params = {
+            "ConditionExpression": "attribute_not_exists(dedup_key)",
+            "Item": {"dedup_key": "conversion#e1#i2", "ttl": 1},
+            "TableName": "test-dedup",
+        }
+        stubber.add_client_error(
+            "put_item",
+            "ConditionalCheckFailedException",
+            expected_params=expected_params,
+        )
+
+        # Validate the duplicate conversions are removed
+        filtered_metrics = exp_dedup.filter_conversions(metrics, ttl=1)
+        assert filtered_metrics == metrics[:2]
+
+
+def test_filter_conversions_source():
+    # Create new dedup object
+    exp_dedup = ExperimentDedup("test-dedup")
+
+    metrics = [{"type": "conversion", "endpoint_name": "e1", "inference_id": "i1"}]
+
+    with Stubber(exp_dedup.dynamodb.meta.client) as stubber:
+        # The conversion is recorded for the source, so a retry of the same source keeps it
+        expected_params = {
+            "ConditionExpression": "attribute_not_exists(dedup_key) OR #source = :source",
+            "ExpressionAttributeNames": {"#source": "source"},
+            "ExpressionAttributeValues": {":source": "s3://test-bucket/test-key"},
+            "Item": {
+                "dedup_key": "conversion#e1#i1",
+                "source": "s3://test-bucket/test-key",
+                "ttl": 1,
+            },
+            "TableName": "test-dedup",
+        }
+        stubber.add_response("put_item", {}, expected_params)
+        stubber.add_response("put_item", {}, expected_params)
+
+        source = "s3://test-bucket/test-key"
+        assert exp_dedup.filter_conversions(metrics, ttl=1, source=source) == metrics
+        assert exp_dedup.filter_conversions(metrics, ttl=1, source=source) == metrics
+
+
+def test_update_item_once():
+    # Create new dedup object
+    exp_dedup = ExperimentDedup("test-dedup")
+
+    update = {
+        "TableName": "test-metrics",
+        "Key": {"endpoint_name": "e1"},
+        "UpdateExpression": "ADD #c :c",
+        "ExpressionAttributeNames": {"#c": "count"},
+        "ExpressionAttributeValues": {":c": 1},
+    }
+
+    # See the dynamodb transact_write_items
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.transact_write_items
+    with Stubber(exp_dedup.dynamodb.meta.client) as stubber:
+        expected_params = {
+            "TransactItems": [
+                {
+                    "Put": {
+                        "TableName": "test-dedup",
+                        "Item": {"dedup_key": "s3://test-bucket/test-key#e1", "ttl": 1},
+                        "ConditionExpression": "attribute_not_exists(dedup_key)",
+                    }
+                },
+                {"Update": update},
+            ]
+        }
+        stubber.add_response("transact_write_items", {}, expected_params)
+        stubber.add_client_error(
+            "transact_write_items",
+            "TransactionCanceledException",
+            expected_params=expected_params,
+            modeled_fields={
+                "CancellationReasons": [
+                    {"Code": "ConditionalCheckFailed"},
+                    {"Code": "None"},
+                ]
+            },
+        )
+
+        # Validate the second time the write is applied it is skipped
+        write_key = "s3://test-bucket/test-key#e1"
+        assert exp_dedup.update_item_once(write_key, update, ttl=1)
+        assert not exp_dedup.update_item_once(write_key, update, ttl=1)
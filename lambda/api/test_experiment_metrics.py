@@ -1,8 +1,9 @@
-from botocore.stub import Stubber
+from botocore.stub import ANY, Stubber
 from decimal import Decimal
 from datetime import datetime
 
 
+from experiment_dedup import ExperimentDedup
 from experiment_metrics import ExperimentMetrics
 
 # 1 invocations for e1v1, 2 invocations for e1v2, and 1 count for e1v2
@@ -78,6 +79,16 @@ def test_create_variant_metrics():
     # See the dynamodb put_item
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.put_item
     with Stubber(exp_metrics.dynamodb.meta.client) as stubber:
+        # The endpoint is not already registered
+        stubber.add_response(
+            "get_item",
+            {},
+            {
+                "Key": {"endpoint_name": "test-endpoint"},
+                "ReturnConsumedCapacity": "TOTAL",
+                "TableName": "test-metrics",
+            },
+        )
         expected_response = {
             "ConsumedCapacity": {
                 "CapacityUnits": 1,
@@ -92,6 +103,8 @@ def test_create_variant_metrics():
                 "strategy": "EpsilonGreedy",
                 "epsilon": Decimal("0.1"),
                 "warmup": Decimal("0"),
+                "auto_stop": False,
+                "reward_range": Decimal("10"),
                 "variant_names": ["ev1", "ev2"],
                 "variant_metrics": {
                     "ev1": {"initial_variant_weight": Decimal("1")},
@@ -111,10 +124,106 @@ def test_create_variant_metrics():
             warmup=0,
             endpoint_variants=endpoint_variants,
             timestamp=0,
+            reward_range=10,
         )
         assert response == expected_response
 
 
+def test_merge_variant_metrics():
+    # Create new metrics object and
+    exp_metrics = ExperimentMetrics("test-metrics", "test-delivery-stream")
+    endpoint_variants = [
+        {
+            "variant_name": "ev1",
+            "initial_variant_weight": 1,
+        },
+        {
+            "variant_name": "ev3",
+            "initial_variant_weight": 0.5,
+        },
+    ]
+
+    with Stubber(exp_metrics.dynamodb.meta.client) as stubber:
+        # The endpoint is registered with a winner, and counts for ev1 and ev2
+        expected_response = {
+            "Item": {
+                "endpoint_name": {"S": "test-endpoint"},
+                "strategy": {"S": "ThompsonSampling"},
+                "epsilon": {"N": "0.1"},
+                "warmup": {"N": "0"},
+                "winner": {"S": "ev2"},
+                "variant_names": {"L": [{"S": "ev1"}, {"S": "ev2"}]},
+                "variant_metrics": {
+                    "M": {
+                        "ev1": {
+                            "M": {
+                                "initial_variant_weight": {"N": "1"},
+                                "invocation_count": {"N": "10"},
+                            }
+                        },
+                        "ev2": {
+                            "M": {
+                                "initial_variant_weight": {"N": "1"},
+                                "invocation_count": {"N": "20"},
+                            }
+                        },
+                    }
+                },
+            }
+        }
+        expected_params = {
+            "Key": {"endpoint_name": "test-endpoint"},
+            "ReturnConsumedCapacity": "TOTAL",
+            "TableName": "test-metrics",
+        }
+        stubber.add_response("get_item", expected_response, expected_params)
+
+        # Keep ev1 counts, add ev3, archive ev2 and restart the experiment
+        expected_response = {"Attributes": {"strategy": {"S": "ThompsonSampling"}}}
+        expected_params = {
+            "ConditionExpression": "variant_names = :previous_names",
+            "ExpressionAttributeNames": {"#v0": "ev1", "#v1": "ev3", "#r0": "ev2"},
+            "ExpressionAttributeValues": {
+                ":variant_names": ["ev1", "ev3"],
+                ":strategy": "ThompsonSampling",
+                ":epsilon": Decimal("0.1"),
+                ":warmup": 0,
+                ":auto_stop": False,
+                ":reward_range": Decimal("1.0"),
+                ":previous_names": ["ev1", "ev2"],
+                ":w0": Decimal("1"),
+                ":v1": {"initial_variant_weight": Decimal("0.5")},
+                ":archived_variants": {
+                    "ev2": {
+                        "initial_variant_weight": Decimal("1"),
+                        "invocation_count": Decimal("20"),
+                        "archived_at": 0,
+                    }
+                },
+            },
+            "Key": {"endpoint_name": "test-endpoint"},
+            "ReturnValues": "UPDATED_NEW",
+            "TableName": "test-metrics",
+            "UpdateExpression": "SET variant_names = :variant_names, strategy = :strategy, "
+            "epsilon = :epsilon, warmup = :warmup, auto_stop = :auto_stop, "
+            "reward_range = :reward_range, "
+            "variant_metrics.#v0.initial_variant_weight = :w0, variant_metrics.#v1 = :v1, "
+            "archived_variants = :archived_variants "
+            "REMOVE variant_metrics.#r0, winner, stopped_at",
+        }
+        stubber.add_response("update_item", expected_response, expected_params)
+
+        response = exp_metrics.create_variant_metrics(
+            endpoint_name="test-endpoint",
+            strategy="ThompsonSampling",
+            epsilon=0.1,
+            warmup=0,
+            endpoint_variants=endpoint_variants,
+            timestamp=0,
+        )
+        assert "Attributes" in response
+
+
 def test_get_empty_variant_metrics():
     # Create new metrics object and
     exp_metrics = ExperimentMetrics("test-metrics", "test-delivery-stream")
@@ -138,6 +247,7 @@ def test_get_empty_variant_metrics():
                                 "invocation_count": {"N": "10"},
                                 "conversion_count": {"N": "1"},
                                 "reward_sum": {"N": "0.5"},
+                                "reward_sum_squares": {"N": "0.25"},
                             }
                         },
                     }
@@ -160,6 +270,7 @@ def test_get_empty_variant_metrics():
                 "invocation_count": 0,
                 "conversion_count": 0,
                 "reward_sum": 0,
+                "reward_sum_squares": 0,
             },
             {
                 "endpoint_name": "test-endpoint",
@@ -168,6 +279,7 @@ def test_get_empty_variant_metrics():
                 "invocation_count": 10,
                 "conversion_count": 1,
                 "reward_sum": 0.5,
+                "reward_sum_squares": 0.25,
             },
         ]
         strategy, epsilon, warmup, variants = exp_metrics.get_variant_metrics(
@@ -212,13 +324,15 @@ def test_update_variant_metrics():
             ":i": 1,
             ":now": 0,
             ":r": Decimal("0.0"),
+            ":s": Decimal("0.0"),
         },
         "Key": {"endpoint_name": "e1"},
-        "ReturnValues": "UPDATED_NEW",
+        "ReturnValues": "ALL_NEW",
         "TableName": "test-metrics",
         "UpdateExpression": "ADD variant_metrics.#variant.invocation_count :i, "
         "variant_metrics.#variant.conversion_count :c, "
-        "variant_metrics.#variant.reward_sum :r SET #created_at = "
+        "variant_metrics.#variant.reward_sum :r, "
+        "variant_metrics.#variant.reward_sum_squares :s SET #created_at = "
         "if_not_exists(#created_at, :now), #updated_at = :now ",
     }
     ddb_stubber.add_response("update_item", expected_response, expected_params)
@@ -255,6 +369,7 @@ def test_update_variant_metrics():
                             "invocation_count": {"N": "2"},
                             "conversion_count": {"N": "1"},
                             "reward_sum": {"N": "1"},
+                            "reward_sum_squares": {"N": "1"},
                         }
                     },
                 }
@@ -267,13 +382,14 @@ def test_update_variant_metrics():
             "#updated_at": "updated_at",
             "#variant": "e1v2",
         },
-        "ExpressionAttributeValues": {":i": 2, ":c": 1, ":r": 1, ":now": 0},
+        "ExpressionAttributeValues": {":i": 2, ":c": 1, ":r": 1, ":s": 1, ":now": 0},
         "Key": {"endpoint_name": "e1"},
-        "ReturnValues": "UPDATED_NEW",
+        "ReturnValues": "ALL_NEW",
         "TableName": "test-metrics",
         "UpdateExpression": "ADD variant_metrics.#variant.invocation_count :i, "
         "variant_metrics.#variant.conversion_count :c, "
-        "variant_metrics.#variant.reward_sum :r SET #created_at = "
+        "variant_metrics.#variant.reward_sum :r, "
+        "variant_metrics.#variant.reward_sum_squares :s SET #created_at = "
         "if_not_exists(#created_at, :now), #updated_at = :now ",
     }
     ddb_stubber.add_response("update_item", expected_response, expected_params)
@@ -342,6 +458,7 @@ def test_update_variant_metrics():
         "invocation_count": 1,
         "conversion_count": 0,
         "reward_sum": 0,
+        "reward_sum_squares": 0,
     }
     assert responses[1] == {
         "endpoint_name": "e1",
@@ -349,6 +466,7 @@ def test_update_variant_metrics():
         "invocation_count": 2,
         "conversion_count": 1,
         "reward_sum": 1,
+        "reward_sum_squares": 1,
     }
 
 
@@ -382,3 +500,345 @@ def test_delete_endpoint():
         response = exp_metrics.delete_endpoint("e1", timestamp=0)
         assert response is not None
         assert response["Attributes"]["deleted_at"] == 0
+
+
+def test_get_registered_items():
+    # Create new metrics object
+    exp_metrics = ExperimentMetrics("test-metrics", "test-delivery-stream")
+
+    with Stubber(exp_metrics.dynamodb.meta.client) as ddb_stubber:
+        expected_params = {
+            "ExpressionAttributeNames": {"#a0": "endpoint_name", "#a1": "strategy"},
+            "FilterExpression": "attribute_not_exists(deleted_at) AND attribute_exists(variant_names)",
+            "ProjectionExpression": "#a0, #a1",
+            "TableName": "test-metrics",
+        }
+        # Return the items over two pages
+        expected_response = {
+            "Items": [{"endpoint_name": {"S": "e1"}, "strategy": {"S": "s1"}}],
+            "LastEvaluatedKey": {"endpoint_name": {"S": "e1"}},
+        }
+        ddb_stubber.add_response("scan", expected_response, expected_params)
+        expected_response = {
+            "Items": [{"endpoint_name": {"S": "e2"}, "strategy": {"S": "s2"}}],
+        }
+        ddb_stubber.add_response(
+            "scan",
+            expected_response,
+            {**expected_params, "ExclusiveStartKey": {"endpoint_name": "e1"}},
+        )
+
+        items = exp_metrics.get_registered_items(["endpoint_name", "strategy"])
+        assert items == [
+            {"endpoint_name": "e1", "strategy": "s1"},
+            {"endpoint_name": "e2", "strategy": "s2"},
+        ]
+
+
+def test_context_deltas():
+    metrics = [
+        {"type": "invocation", "features": [1, 2]},
+        {"type": "invocation", "features": [1, 0]},
+        {"type": "invocation"},
+        {"type": "conversion", "reward": 0.5, "features": [1, 2]},
+    ]
+    deltas = ExperimentMetrics.get_context_deltas(metrics)
+    assert deltas == {
+        "a_0_0": 2.0,
+        "a_0_1": 2.0,
+        "a_1_1": 4.0,
+        "b_0": 0.5,
+        "b_1": 1.0,
+    }
+
+    # Validate we can read back the symmetric matrix
+    context_a, context_b = ExperimentMetrics.get_context_matrix(deltas)
+    assert context_a == [[2.0, 2.0], [2.0, 4.0]]
+    assert context_b == [0.5, 1.0]
+
+
+def test_update_weights_updated_at():
+    # Create new metrics object and
+    exp_metrics = ExperimentMetrics("test-metrics", "test-delivery-stream")
+
+    with Stubber(exp_metrics.dynamodb.meta.client) as ddb_stubber:
+        expected_params = {
+            "ConditionExpression": "attribute_not_exists(weights_updated_at) OR weights_updated_at < :min",
+            "ExpressionAttributeValues": {":now": 3600, ":min": 0},
+            "Key": {"endpoint_name": "e1"},
+            "TableName": "test-metrics",
+            "UpdateExpression": "SET weights_updated_at = :now ",
+        }
+        ddb_stubber.add_response("update_item", {}, expected_params)
+        ddb_stubber.add_client_error(
+            "update_item",
+            "ConditionalCheckFailedException",
+            expected_params=expected_params,
+        )
+
+        # Validate the second update within the interval is rate limited
+        assert exp_metrics.update_weights_updated_at("e1", 3600, timestamp=3600)
+        assert not exp_metrics.update_weights_updated_at("e1", 3600, timestamp=3600)
+
+        # Validate the time is only removed if not set by another update
+        expected_params = {
+            "ConditionExpression": "weights_updated_at = :now",
+            "ExpressionAttributeValues": {":now": 3600},
+            "Key": {"endpoint_name": "e1"},
+            "TableName": "test-metrics",
+            "UpdateExpression": "REMOVE weights_updated_at",
+        }
+        ddb_stubber.add_response("update_item", {}, expected_params)
+        ddb_stubber.add_client_error(
+            "update_item",
+            "ConditionalCheckFailedException",
+            expected_params=expected_params,
+        )
+        exp_metrics.clear_weights_updated_at("e1", 3600)
+        exp_metrics.clear_weights_updated_at("e1", 3600)
+
+
+def test_get_sharded_variant_metrics():
+    # Create new metrics object with the counts sharded across two items
+    exp_metrics = ExperimentMetrics(
+        "test-metrics", "test-delivery-stream", metrics_shards=2
+    )
+
+    # See the dynamodb batch_get_item
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.batch_get_item
+    with Stubber(exp_metrics.dynamodb.meta.client) as stubber:
+        keys = [
+            {"endpoint_name": "test-endpoint"},
+            {"endpoint_name": "test-endpoint#shard0"},
+            {"endpoint_name": "test-endpoint#shard1"},
+        ]
+        # Return the second shard as unprocessed
+        expected_response = {
+            "Responses": {
+                "test-metrics": [
+                    {
+                        "endpoint_name": {"S": "test-endpoint"},
+                        "strategy": {"S": "ThompsonSampling"},
+                        "epsilon": {"N": "0.1"},
+                        "warmup": {"N": "0"},
+                        "variant_names": {"L": [{"S": "ev1"}, {"S": "ev2"}]},
+                        "variant_metrics": {
+                            "M": {
+                                "ev1": {"M": {"initial_variant_weight": {"N": "0.5"}}},
+                                "ev2": {"M": {"initial_variant_weight": {"N": "0.5"}}},
+                            }
+                        },
+                    },
+                    {
+                        "endpoint_name": {"S": "test-endpoint#shard0"},
+                        "ev1#invocation_count": {"N": "2"},
+                        "ev2#invocation_count": {"N": "3"},
+                        "ev2#conversion_count": {"N": "1"},
+                        "ev2#reward_sum": {"N": "1"},
+                        "ev2#reward_sum_squares": {"N": "1"},
+                        "updated_at": {"N": "0"},
+                    },
+                ]
+            },
+            "UnprocessedKeys": {
+                "test-metrics": {
+                    "Keys": [{"endpoint_name": {"S": "test-endpoint#shard1"}}]
+                }
+            },
+        }
+        expected_params = {"RequestItems": {"test-metrics": {"Keys": keys}}}
+        stubber.add_response("batch_get_item", expected_response, expected_params)
+        expected_response = {
+            "Responses": {
+                "test-metrics": [
+                    {
+                        "endpoint_name": {"S": "test-endpoint#shard1"},
+                        "ev2#invocation_count": {"N": "4"},
+                        "ev2#conversion_count": {"N": "2"},
+                        "ev2#reward_sum": {"N": "2"},
+                        "ev2#reward_sum_squares": {"N": "2"},
+                    },
+                ]
+            },
+        }
+        expected_params = {"RequestItems": {"test-metrics": {"Keys": keys[2:]}}}
+        stubber.add_response("batch_get_item", expected_response, expected_params)
+
+        # Validate the counts are merged across shards
+        _, _, _, variants = exp_metrics.get_variant_metrics("test-endpoint")
+        assert [v["invocation_count"] for v in variants] == [2, 7]
+        assert [v["conversion_count"] for v in variants] == [0, 3]
+        assert [v["reward_sum"] for v in variants] == [0, 3]
+        assert [v["reward_sum_squares"] for v in variants] == [0, 3]
+
+
+def test_update_sharded_variant_metrics():
+    # Create new metrics object with the counts sharded across two items
+    exp_metrics = ExperimentMetrics(
+        "test-metrics", "test-delivery-stream", metrics_shards=2
+    )
+    metrics = [
+        {
+            "timestamp": 1,
+            "type": "invocation",
+            "endpoint_name": "e1",
+            "endpoint_variant": "e1v1",
+            "features": [2],
+        }
+    ]
+
+    with Stubber(exp_metrics.dynamodb.meta.client) as ddb_stubber, Stubber(
+        exp_metrics.cloudwatch
+    ) as cw_stubber:
+        # The counts and contextual statistics are added to a random shard
+        expected_params = {
+            "ExpressionAttributeNames": {
+                "#i": "e1v1#invocation_count",
+                "#c": "e1v1#conversion_count",
+                "#r": "e1v1#reward_sum",
+                "#s": "e1v1#reward_sum_squares",
+                "#updated_at": "updated_at",
+                "#x0": "e1v1#context_a_0_0",
+            },
+            "ExpressionAttributeValues": {
+                ":i": 1,
+                ":c": 0,
+                ":r": Decimal("0.0"),
+                ":s": Decimal("0.0"),
+                ":now": 0,
+                ":x0": Decimal("4.0"),
+            },
+            "Key": ANY,
+            "ReturnValues": "NONE",
+            "TableName": "test-metrics",
+            "UpdateExpression": "ADD #i :i, #c :c, #r :r, #s :s, #x0 :x0 SET #updated_at = :now ",
+        }
+        ddb_stubber.add_response("update_item", {}, expected_params)
+        cw_stubber.add_response("put_metric_data", {}, None)
+
+        # The auto stop setting is read once within the check interval, and the totals aren't read without it
+        ddb_stubber.add_response(
+            "get_item",
+            {"Item": {"auto_stop": {"BOOL": False}}},
+            {
+                "ExpressionAttributeNames": {"#a": "auto_stop", "#w": "winner"},
+                "Key": {"endpoint_name": "e1"},
+                "ProjectionExpression": "#a, #w",
+                "TableName": "test-metrics",
+            },
+        )
+        ddb_stubber.add_response("update_item", {}, expected_params)
+        cw_stubber.add_response("put_metric_data", {}, None)
+
+        for _ in range(2):
+            responses = exp_metrics.update_variant_metrics(metrics, timestamp=0)
+            # Validate the counts added are returned as the totals are not read
+            assert responses[0]["invocation_count"] == 1
+        ddb_stubber.assert_no_pending_responses()
+
+
+def test_update_variant_metrics_write_key():
+    # Create new metrics object that applies each write once for the source
+    exp_dedup = ExperimentDedup("test-dedup")
+    exp_metrics = ExperimentMetrics(
+        "test-metrics", "test-delivery-stream", dedup=exp_dedup
+    )
+    metrics = [
+        {
+            "timestamp": 1,
+            "type": "invocation",
+            "endpoint_name": "e1",
+            "endpoint_variant": "e1v1",
+        }
+    ]
+
+    with Stubber(exp_dedup.dynamodb.meta.client) as dedup_stubber, Stubber(
+        exp_metrics.dynamodb.meta.client
+    ) as ddb_stubber, Stubber(exp_metrics.cloudwatch) as cw_stubber:
+        # The counts are added in a transaction with the write key for the source and variant
+        expected_params = {
+            "TransactItems": [
+                {
+                    "Put": {
+                        "TableName": "test-dedup",
+                        "Item": {
+                            "dedup_key": "s3://test-bucket/k1#e1#e1v1",
+                            "ttl": ANY,
+                        },
+                        "ConditionExpression": "attribute_not_exists(dedup_key)",
+                    }
+                },
+                {
+                    "Update": {
+                        "TableName": "test-metrics",
+                        "Key": {"endpoint_name": "e1"},
+                        "UpdateExpression": ANY,
+                        "ExpressionAttributeNames": ANY,
+                        "ExpressionAttributeValues": {
+                            ":i": 1,
+                            ":c": 0,
+                            ":r": Decimal("0.0"),
+                            ":s": Decimal("0.0"),
+                            ":now": 0,
+                        },
+                    }
+                },
+            ]
+        }
+        dedup_stubber.add_response("transact_write_items", {}, expected_params)
+        cw_stubber.add_response("put_metric_data", {}, None)
+        ddb_stubber.add_response(
+            "get_item",
+            {"Item": {"auto_stop": {"BOOL": False}}},
+            {
+                "ExpressionAttributeNames": {"#a": "auto_stop", "#w": "winner"},
+                "Key": {"endpoint_name": "e1"},
+                "ProjectionExpression": "#a, #w",
+                "TableName": "test-metrics",
+            },
+        )
+
+        # The retry of the same source is cancelled by the write key, without putting cloudwatch metrics
+        dedup_stubber.add_client_error(
+            "transact_write_items",
+            "TransactionCanceledException",
+            expected_params=expected_params,
+            modeled_fields={
+                "CancellationReasons": [
+                    {"Code": "ConditionalCheckFailed"},
+                    {"Code": "None"},
+                ]
+            },
+        )
+
+        source = "s3://test-bucket/k1"
+        responses = exp_metrics.update_variant_metrics(metrics, 0, source)
+        assert responses[0]["invocation_count"] == 1
+        assert exp_metrics.update_variant_metrics(metrics, 0, source) == []
+        dedup_stubber.assert_no_pending_responses()
+        ddb_stubber.assert_no_pending_responses()
+        cw_stubber.assert_no_pending_responses()
+
+
+def test_merge_shard_context():
+    item = {
+        "variant_metrics": {
+            "e1v1": {"initial_variant_weight": 1, "context": {"a_0_0": 1}},
+            "e1v2": {"initial_variant_weight": 1},
+        }
+    }
+    shard_items = [
+        {"e1v1#context_a_0_0": 2, "e1v1#invocation_count": 1},
+        {"e1v2#context_a_0_0": 2, "e1v3#invocation_count": 1},
+    ]
+
+    # Validate the context is only merged for contextual variants, and removed variants are ignored
+    item = ExperimentMetrics.merge_shard_items(item, shard_items)
+    assert item["variant_metrics"] == {
+        "e1v1": {
+            "initial_variant_weight": 1,
+            "context": {"a_0_0": 3},
+            "invocation_count": 1,
+        },
+        "e1v2": {"initial_variant_weight": 1},
+    }
@@ -0,0 +1,102 @@
+from botocore.stub import Stubber
+from decimal import Decimal
+
+from experiment_rollups import ExperimentRollups
+
+
+def test_update_rollups():
+    # Create new rollups object
+    exp_rollups = ExperimentRollups("test-rollups", retention_days=30)
+
+    # Two events in the same minute, and one in the next minute of the same hour
+    metrics = [
+        {"type": "invocation", "timestamp": 1620000000},
+        {"type": "conversion", "timestamp": 1620000010, "reward": 1.0},
+        {"type": "invocation", "timestamp": 1620000060},
+    ]
+
+    # See the dynamodb update_item
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.update_item
+    with Stubber(exp_rollups.dynamodb.meta.client) as stubber:
+        for rollup_key, counts, ttl in [
+            ("minute#1620000000#v1", (1, 1, "1.0", "1.0"), 1620172860),
+            ("minute#1620000060#v1", (1, 0, "0.0", "0.0"), 1620172920),
+            ("hour#1620000000#v1", (2, 1, "1.0", "1.0"), 1622595600),
+        ]:
+            expected_params = {
+                "ExpressionAttributeNames": {"#ttl": "ttl"},
+                "ExpressionAttributeValues": {
+                    ":i": counts[0],
+                    ":c": counts[1],
+                    ":r": Decimal(counts[2]),
+                    ":s": Decimal(counts[3]),
+                    ":ttl": ttl,
+                },
+                "Key": {"endpoint_name": "e1", "rollup_key": rollup_key},
+                "TableName": "test-rollups",
+                "UpdateExpression": "ADD invocation_count :i, conversion_count :c, "
+                "reward_sum :r, reward_sum_squares :s "
+                "SET #ttl = if_not_exists(#ttl, :ttl)",
+            }
+            stubber.add_response("update_item", {}, expected_params)
+
+        assert exp_rollups.update_rollups("e1", "v1", metrics, 1620000000) == 3
+
+
+def test_get_rollups():
+    # Create new rollups object
+    exp_rollups = ExperimentRollups("test-rollups")
+
+    with Stubber(exp_rollups.dynamodb.meta.client) as stubber:
+        expected_params = {
+            "ExpressionAttributeValues": {
+                ":e": "e1",
+                ":start": "hour#1619996400#",
+                ":end": "hour#1620079200#~",
+            },
+            "KeyConditionExpression": "endpoint_name = :e AND rollup_key BETWEEN :start AND :end",
+            "TableName": "test-rollups",
+        }
+        response = {
+            "Items": [
+                {
+                    "endpoint_name": {"S": "e1"},
+                    "rollup_key": {"S": "hour#1619996400#v1"},
+                    "invocation_count": {"N": "2"},
+                    "conversion_count": {"N": "1"},
+                    "reward_sum": {"N": "1.0"},
+                    "reward_sum_squares": {"N": "1.0"},
+                },
+                {
+                    "endpoint_name": {"S": "e1"},
+                    "rollup_key": {"S": "hour#1620000000#v2"},
+                    "invocation_count": {"N": "1"},
+                },
+            ]
+        }
+        stubber.add_response("query", response, expected_params)
+
+        # Validate the default start is the last 24 hours, and buckets are grouped by variant
+        rollups = exp_rollups.get_rollups("e1", "hour", end=1620080000)
+        assert rollups["start"] == 1619996400
+        assert rollups["end"] == 1620079200
+        assert rollups["variant_rollups"] == {
+            "v1": [
+                {
+                    "timestamp": 1619996400,
+                    "invocation_count": 2,
+                    "conversion_count": 1,
+                    "reward_sum": 1.0,
+                    "reward_sum_squares": 1.0,
+                }
+            ],
+            "v2": [
+                {
+                    "timestamp": 1620000000,
+                    "invocation_count": 1,
+                    "conversion_count": 0,
+                    "reward_sum": 0.0,
+                    "reward_sum_squares": 0.0,
+                }
+            ],
+        }
@@ -0,0 +1,141 @@
+import pytest
+from botocore.stub import Stubber
+from time import time
+
+from experiment_metrics import ExperimentMetrics
+from experiment_storage import MemoryStorage, SQLiteStorage, get_storage
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_storage_assignment(backend):
+    storage = get_storage(backend)
+    now = int(time())
+
+    assert storage.get_assignment("user-1", "e1") is None
+    storage.put_assignment("user-1", "e1", "e1v1", now + 60)
+    assert storage.get_assignment("user-1", "e1") == {
+        "variant_name": "e1v1",
+        "ttl": now + 60,
+    }
+
+    # Refresh only if the variant is unchanged and the ttl is before refresh
+    assert not storage.refresh_assignment("user-1", "e1", "e1v2", now + 120, now + 90)
+    assert not storage.refresh_assignment("user-1", "e1", "e1v1", now + 120, now + 30)
+    assert storage.refresh_assignment("user-1", "e1", "e1v1", now + 120, now + 90)
+    assert storage.get_assignment("user-1", "e1")["ttl"] == now + 120
+
+    # Expired assignments are not returned
+    storage.put_assignment("user-2", "e1", "e1v1", now - 1)
+    assert storage.get_assignment("user-2", "e1") is None
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_storage_counts(backend):
+    storage = get_storage(backend)
+
+    storage.increment_counts("e1", "e1v1", {"invocation_count": 2})
+    storage.increment_counts(
+        "e1", "e1v1", {"invocation_count": 1, "conversion_count": 1, "reward_sum": 0.5}
+    )
+    storage.increment_counts("e1", "e1v2", {"invocation_count": 1})
+    storage.increment_counts("e2", "e2v1", {"invocation_count": 1})
+    assert storage.get_counts("e1") == {
+        "e1v1#invocation_count": 3,
+        "e1v1#conversion_count": 1,
+        "e1v1#reward_sum": 0.5,
+        "e1v2#invocation_count": 1,
+    }
+
+    # Delete the counts for removed variants, or all variants
+    storage.delete_counts("e1", ["e1v1"])
+    assert storage.get_counts("e1") == {"e1v2#invocation_count": 1}
+    storage.delete_counts("e1")
+    assert storage.get_counts("e1") == {}
+    assert storage.get_counts("e2") == {"e2v1#invocation_count": 1}
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_storage_counts_write_key(backend):
+    storage = get_storage(backend)
+
+    # Validate the counts are only incremented once for the write key until it expires
+    ttl = int(time()) + 60
+    assert storage.increment_counts("e1", "e1v1", {"invocation_count": 2}, "k1", ttl)
+    assert not storage.increment_counts(
+        "e1", "e1v1", {"invocation_count": 2}, "k1", ttl
+    )
+    assert storage.increment_counts("e1", "e1v1", {"invocation_count": 1}, "k2", ttl)
+    assert storage.get_counts("e1") == {"e1v1#invocation_count": 3}
+    assert storage.increment_counts(
+        "e1", "e1v1", {"invocation_count": 1}, "k3", int(time()) - 1
+    )
+    assert storage.increment_counts("e1", "e1v1", {"invocation_count": 1}, "k3", ttl)
+    assert storage.get_counts("e1") == {"e1v1#invocation_count": 5}
+
+    # Validate a write key without a ttl is kept
+    assert storage.increment_counts("e1", "e1v1", {"invocation_count": 1}, "k4")
+    assert not storage.increment_counts("e1", "e1v1", {"invocation_count": 1}, "k4")
+    assert storage.get_counts("e1") == {"e1v1#invocation_count": 6}
+
+
+def test_sqlite_storage_file(tmp_path):
+    # Assignments and counts are persisted across connections to the same database file
+    database = str(tmp_path / "experiment.db")
+    SQLiteStorage(database).increment_counts("e1", "e1v1", {"invocation_count": 1})
+    assert SQLiteStorage(database).get_counts("e1") == {"e1v1#invocation_count": 1}
+
+
+def test_get_storage_variant_metrics():
+    # Create new metrics object with the counts in memory
+    storage = MemoryStorage()
+    storage.increment_counts(
+        "test-endpoint",
+        "ev2",
+        {
+            "invocation_count": 3,
+            "conversion_count": 1,
+            "reward_sum": 1.0,
+            "reward_sum_squares": 1.0,
+        },
+    )
+    exp_metrics = ExperimentMetrics(
+        "test-metrics", "test-delivery-stream", storage=storage
+    )
+
+    # The endpoint configuration is read from the metrics table
+    with Stubber(exp_metrics.dynamodb.meta.client) as stubber:
+        expected_response = {
+            "Item": {
+                "endpoint_name": {"S": "test-endpoint"},
+                "strategy": {"S": "ThompsonSampling"},
+                "epsilon": {"N": "0.1"},
+                "warmup": {"N": "0"},
+                "variant_names": {"L": [{"S": "ev1"}, {"S": "ev2"}]},
+                "variant_metrics": {
+                    "M": {
+                        "ev1": {"M": {"initial_variant_weight": {"N": "0.5"}}},
+                        "ev2": {"M": {"initial_variant_weight": {"N": "0.5"}}},
+                    }
+                },
+            }
+        }
+        expected_params = {
+            "Key": {"endpoint_name": "test-endpoint"},
+            "ReturnConsumedCapacity": "TOTAL",
+            "TableName": "test-metrics",
+        }
+        stubber.add_response("get_item", expected_response, expected_params)
+
+        variant_metrics = exp_metrics.get_endpoint_metrics("test-endpoint")[
+            "variant_metrics"
+        ]
+        assert [
+            (v["variant_name"], v["invocation_count"], v["reward_sum"])
+            for v in variant_metrics
+        ] == [("ev1", 0, 0.0), ("ev2", 3, 1.0)]
+
+    # Shards are not supported with a storage backend
+    with pytest.raises(Exception):
+        ExperimentMetrics(
+            "test-metrics", "test-delivery-stream", metrics_shards=2, storage=storage
+        )
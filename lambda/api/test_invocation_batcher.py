@@ -0,0 +1,118 @@
+import boto3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import pytest
+from time import sleep
+
+from invocation_batcher import InvocationBatcher
+
+
+def get_response(predictions):
+    body = json.dumps(predictions).encode()
+    return {
+        "Body": StreamingBody(io.BytesIO(body), len(body)),
+        "ContentType": "application/json",
+        "InvokedProductionVariant": "e1v1",
+    }
+
+
+def get_args(content_type: str, target_variant: str, data, **kwargs):
+    args = {"EndpointName": "e1", "ContentType": content_type, "Body": data, **kwargs}
+    if target_variant is not None:
+        args["TargetVariant"] = target_variant
+    return args
+
+
+def test_get_instances():
+    batcher = InvocationBatcher(None, max_batch_size=2)
+    data = json.dumps({"instances": ["a", "b"]})
+    assert batcher.get_instances(get_args("application/json", "e1v1", data)) == [
+        "a",
+        "b",
+    ]
+
+    # Requests without a target variant, instances or within the max size are not batched
+    assert batcher.get_instances(get_args("application/json", None, data)) is None
+    assert batcher.get_instances(get_args("text/csv", "e1v1", data)) is None
+    assert batcher.get_instances(get_args("application/json", "e1v1", "1,2")) is None
+    for body in [{"instances": []}, {"instances": [1, 2, 3]}, {"inputs": [1]}]:
+        args = get_args("application/json", "e1v1", json.dumps(body))
+        assert batcher.get_instances(args) is None
+
+    # Requests with arguments that can't be shared by the batch are not batched
+    for kwargs in [{"Accept": "text/csv"}, {"InferenceId": "i1"}, {"TargetModel": "m"}]:
+        args = get_args("application/json", "e1v1", data, **kwargs)
+        assert batcher.get_instances(args) is None
+
+
+def test_split_predictions():
+    assert InvocationBatcher.split_predictions([1, 2, 3], [2, 1]) == [[1, 2], [3]]
+    assert InvocationBatcher.split_predictions(
+        {"predictions": [1, 2, 3], "model": "m"}, [1, 2]
+    ) == [{"predictions": [1], "model": "m"}, {"predictions": [2, 3], "model": "m"}]
+    with pytest.raises(Exception):
+        InvocationBatcher.split_predictions([1, 2], [2, 1])
+
+
+def test_invoke_batch():
+    sm_runtime = boto3.client("sagemaker-runtime")
+    # Wait long enough for all requests to arrive, and invoke once the batch is full
+    batcher = InvocationBatcher(sm_runtime, max_batch_size=4, max_wait_ms=10000)
+    requests = [["a"], ["b", "c"], ["d"]]
+
+    with Stubber(sm_runtime) as stubber:
+        expected_params = {
+            "EndpointName": "e1",
+            "ContentType": "application/json",
+            "Body": json.dumps({"instances": ["a", "b", "c", "d"]}),
+            "TargetVariant": "e1v1",
+        }
+        stubber.add_response(
+            "invoke_endpoint",
+            get_response([["A"], ["B"], ["C"], ["D"]]),
+            expected_params,
+        )
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = []
+            for r in requests:
+                futures.append(
+                    executor.submit(batcher.invoke, "e1", "e1v1", "application/json", r)
+                )
+                # Submit in order, so the instances are batched in order
+                sleep(0.05)
+            results = [f.result(timeout=5) for f in futures]
+        stubber.assert_no_pending_responses()
+
+    # Each request receives the predictions for its instances
+    assert results == [
+        ("e1v1", [["A"]]),
+        ("e1v1", [["B"], ["C"]]),
+        ("e1v1", [["D"]]),
+    ]
+
+
+def test_invoke_batch_fallback():
+    sm_runtime = boto3.client("sagemaker-runtime")
+    # Invoke once the batch is full with both requests
+    batcher = InvocationBatcher(sm_runtime, max_batch_size=3, max_wait_ms=10000)
+    requests = [["a"], ["b", "c"]]
+
+    with Stubber(sm_runtime) as stubber:
+        # The model returns one prediction for the batch, so each request is invoked on its own
+        stubber.add_response("invoke_endpoint", get_response([["A"]]), None)
+        stubber.add_response("invoke_endpoint", get_response([["A"]]), None)
+        stubber.add_client_error("invoke_endpoint", "ModelError", http_status_code=424)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = []
+            for r in requests:
+                futures.append(
+                    executor.submit(batcher.invoke, "e1", "e1v1", "application/json", r)
+                )
+                sleep(0.05)
+            assert futures[0].result(timeout=5) == ("e1v1", [["A"]])
+            with pytest.raises(Exception):
+                futures[1].result(timeout=5)
+        stubber.assert_no_pending_responses()
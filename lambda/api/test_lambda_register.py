@@ -0,0 +1,159 @@
+import os
+import pytest
+
+# Set the environment read by the lambda on import, and skip if the xray sdk is not installed
+os.environ.setdefault("METRICS_TABLE", "test-metrics")
+os.environ.setdefault("DELIVERY_STREAM_NAME", "test-stream")
+os.environ.setdefault("STAGE_NAME", "test")
+os.environ.setdefault("AWS_XRAY_CONTEXT_MISSING", "LOG_ERROR")
+lambda_register = pytest.importorskip("lambda_register")
+
+
+class MockPaginator:
+    def __init__(self, get_pages):
+        self.get_pages = get_pages
+
+    def paginate(self, **kwargs):
+        return self.get_pages(**kwargs)
+
+
+class MockSageMaker:
+    def __init__(self, endpoints: dict):
+        # The endpoint tags by name, or None if describe endpoint fails
+        self.endpoints = endpoints
+
+    def describe_endpoint(self, EndpointName: str):
+        if self.endpoints[EndpointName] is None:
+            raise Exception(f"Unable to describe: {EndpointName}")
+        return {
+            "EndpointArn": EndpointName,
+            "EndpointStatus": "InService",
+            "ProductionVariants": [
+                {"VariantName": "v1", "CurrentWeight": 1.0},
+                {"VariantName": "v2", "CurrentWeight": 1.0},
+            ],
+        }
+
+    def get_paginator(self, operation_name: str):
+        if operation_name == "list_endpoints":
+            return MockPaginator(
+                lambda: [{"Endpoints": [{"EndpointName": e} for e in self.endpoints]}]
+            )
+        return MockPaginator(
+            lambda ResourceArn: [
+                {
+                    "Tags": [
+                        {"Key": k, "Value": v}
+                        for k, v in self.endpoints[ResourceArn].items()
+                    ]
+                }
+            ]
+        )
+
+
+def get_tags(**tags):
+    return {
+        "ab-testing:enabled": "true",
+        "sagemaker:deployment-stage": "test",
+        **dict([(f"ab-testing:{k}", v) for k, v in tags.items()]),
+    }
+
+
+def get_registered(epsilon: float = 0.1):
+    return {
+        "deleted_at": None,
+        "variant_names": ["v1", "v2"],
+        "strategy": "ThompsonSampling",
+        "epsilon": epsilon,
+        "warmup": 0,
+        "auto_stop": False,
+        "reward_range": 1.0,
+    }
+
+
+def test_is_same_registration():
+    endpoint_variants = [{"variant_name": "v1"}, {"variant_name": "v2"}]
+    registration = {
+        "strategy": "ThompsonSampling",
+        "epsilon": 0.1,
+        "warmup": 0,
+        "auto_stop": False,
+    }
+    assert lambda_register.is_same_registration(
+        get_registered(), endpoint_variants, **registration
+    )
+
+    # Validate a change to the variants, configuration or deletion is not the same
+    assert not lambda_register.is_same_registration(
+        get_registered(), endpoint_variants[:1], **registration
+    )
+    assert not lambda_register.is_same_registration(
+        get_registered(epsilon=0.2), endpoint_variants, **registration
+    )
+    assert not lambda_register.is_same_registration(
+        get_registered(), endpoint_variants, **registration, reward_range=2.0
+    )
+    assert not lambda_register.is_same_registration(
+        {**get_registered(), "deleted_at": 1}, endpoint_variants, **registration
+    )
+    assert not lambda_register.is_same_registration(
+        None, endpoint_variants, **registration
+    )
+
+
+def test_get_registration_invalid_tag():
+    # Validate a malformed tag returns bad request rather than raising
+    registration, status_code, error_message = lambda_register.get_registration(
+        "e1", get_tags(epsilon="high")
+    )
+    assert registration is None
+    assert status_code == 400
+    assert "invalid tag" in error_message
+
+
+def test_handle_reconcile(monkeypatch):
+    endpoints = {
+        "e-same": get_tags(),
+        "e-changed": get_tags(epsilon="0.2"),
+        "e-new": get_tags(),
+        "e-disabled": {**get_tags(), "ab-testing:enabled": "false"},
+        "e-invalid": get_tags(warmup="none"),
+        "e-failed": None,
+    }
+    registered = ["e-same", "e-changed", "e-disabled", "e-invalid", "e-failed"]
+    reconciled = []
+
+    def handle_register(endpoint_name: str, **kwargs):
+        reconciled.append(("register", endpoint_name, kwargs["epsilon"]))
+        return {}, 200
+
+    def handle_delete(endpoint_name: str):
+        reconciled.append(("delete", endpoint_name))
+        return {}, 200
+
+    sm_client = MockSageMaker(endpoints)
+    monkeypatch.setattr(lambda_register, "sm_client", sm_client)
+    monkeypatch.setattr(
+        lambda_register,
+        "get_registered",
+        lambda: dict([(e, get_registered()) for e in registered]),
+    )
+    monkeypatch.setattr(
+        lambda_register, "map_concurrent", lambda fn, items: [fn(i) for i in items]
+    )
+    monkeypatch.setattr(lambda_register, "handle_register", handle_register)
+    monkeypatch.setattr(lambda_register, "handle_delete", handle_delete)
+
+    result, status_code = lambda_register.handle_reconcile()
+    assert status_code == 200
+
+    # Validate unchanged, failed and invalid endpoints are kept, and the invalid tag is reported
+    assert result["endpoint_count"] == 6
+    assert result["registered"] == ["e-changed", "e-new"]
+    assert result["deleted"] == ["e-disabled"]
+    assert list(result["errors"]) == ["e-invalid"]
+    assert reconciled == [
+        ("register", "e-changed", 0.2),
+        ("register", "e-new", 0.1),
+        ("delete", "e-disabled"),
+    ]
@@ -0,0 +1,117 @@
+import os
+import pytest
+
+# Set the environment read by the lambda on import, and skip if the xray sdk is not installed
+os.environ.setdefault("METRICS_TABLE", "test-metrics")
+os.environ.setdefault("DELIVERY_STREAM_NAME", "test-stream")
+os.environ.setdefault("AWS_XRAY_CONTEXT_MISSING", "LOG_ERROR")
+lambda_weights = pytest.importorskip("lambda_weights")
+
+
+class MockMetrics:
+    def __init__(self, endpoint_metrics: dict):
+        self.endpoint_metrics = endpoint_metrics
+
+    def get_endpoint_metrics(self, endpoint_name: str):
+        return self.endpoint_metrics
+
+    def update_weights_updated_at(self, endpoint_name: str, interval: int, timestamp):
+        return True
+
+
+class MockSageMaker:
+    def __init__(self, current_weights: dict):
+        self.current_weights = current_weights
+        self.updates = []
+
+    def describe_endpoint(self, EndpointName: str):
+        return {
+            "EndpointStatus": "InService",
+            "ProductionVariants": [
+                {"VariantName": k, "CurrentWeight": w}
+                for k, w in self.current_weights.items()
+            ],
+        }
+
+    def update_endpoint_weights_and_capacities(self, **kwargs):
+        self.updates.append(kwargs)
+
+
+def get_endpoint_metrics(winner: str = "v1"):
+    return {
+        "winner": winner,
+        "warmup": 0,
+        "variant_metrics": [
+            {"variant_name": "v1", "invocation_count": 10},
+            {"variant_name": "v2", "invocation_count": 10},
+        ],
+    }
+
+
+def test_get_desired_weights_min_weight(monkeypatch):
+    monkeypatch.setattr(lambda_weights, "WEIGHTS_MIN_WEIGHT", 0.1)
+
+    # Validate the losing variant keeps the minimum weight before normalizing
+    weights = lambda_weights.get_desired_weights(get_endpoint_metrics())
+    assert weights == {"v1": 0.909, "v2": 0.091}
+
+
+def test_get_desired_instances():
+    bounds = {"a": (1, 5), "b": (1, 5), "c": (1, 5)}
+
+    # Validate the remaining instance goes to the variant furthest below its share
+    instances = lambda_weights.get_desired_instances(
+        5, {"a": 0.46, "b": 0.34, "c": 0.2}, bounds
+    )
+    assert instances == {"a": 2, "b": 2, "c": 1}
+
+
+def test_get_desired_instances_bounds():
+    # Validate the instances are raised to the min capacity, keeping the total
+    instances = lambda_weights.get_desired_instances(
+        4, {"a": 0.9, "b": 0.1}, {"a": (1, 4), "b": (2, 4)}
+    )
+    assert instances == {"a": 2, "b": 2}
+
+    # Validate the instances are lowered to the max capacity, keeping the total
+    instances = lambda_weights.get_desired_instances(
+        6, {"a": 0.8, "b": 0.2}, {"a": (1, 3), "b": (1, 6)}
+    )
+    assert instances == {"a": 3, "b": 3}
+
+    # Validate the min capacity is kept when the total can't be
+    instances = lambda_weights.get_desired_instances(
+        2, {"a": 0.5, "b": 0.5}, {"a": (2, 4), "b": (2, 4)}
+    )
+    assert instances == {"a": 2, "b": 2}
+
+
+def test_handle_update_weights_threshold(monkeypatch):
+    monkeypatch.setattr(lambda_weights, "WEIGHTS_MIN_WEIGHT", 0.05)
+    monkeypatch.setattr(lambda_weights, "WEIGHTS_THRESHOLD", 0.1)
+    monkeypatch.setattr(
+        lambda_weights, "exp_metrics", MockMetrics(get_endpoint_metrics())
+    )
+
+    # Validate the weights are not updated when the allocation moves less than the threshold
+    sm_client = MockSageMaker({"v1": 0.9, "v2": 0.1})
+    monkeypatch.setattr(lambda_weights, "sm_client", sm_client)
+    result = lambda_weights.handle_update_weights("e1")
+    assert result["updated"] is False
+    assert result["message"].startswith("Weight change")
+    assert sm_client.updates == []
+
+    # Validate the weights are updated when the allocation moves more than the threshold
+    sm_client = MockSageMaker({"v1": 0.5, "v2": 0.5})
+    monkeypatch.setattr(lambda_weights, "sm_client", sm_client)
+    result = lambda_weights.handle_update_weights("e1")
+    assert result["updated"] is True
+    assert sm_client.updates == [
+        {
+            "EndpointName": "e1",
+            "DesiredWeightsAndCapacities": [
+                {"VariantName": "v1", "DesiredWeight": 0.952},
+                {"VariantName": "v2", "DesiredWeight": 0.048},
+            ],
+        }
+    ]
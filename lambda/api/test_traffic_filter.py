@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from traffic_filter import CountMinSketch, SpaceSaving, TrafficFilter
+
+TRAFFIC_RULES = os.path.join(os.path.dirname(__file__), "traffic_rules.json")
+
+
+def get_metric(source_ip: str, user_agent: str = "Mozilla/5.0"):
+    return {
+        "type": "invocation",
+        "endpoint_name": "e1",
+        "endpoint_variant": "e1v1",
+        "source_ip": source_ip,
+        "user_agent": user_agent,
+    }
+
+
+def test_count_min_sketch():
+    sketch = CountMinSketch(width=64, depth=4)
+    for i in range(100):
+        sketch.add(f"10.0.0.{i % 10}")
+    assert sketch.add("10.0.0.1", 5) >= 15
+    # Estimates are never less than the true count
+    for i in range(10):
+        assert sketch.estimate(f"10.0.0.{i}") >= 10
+
+
+def test_space_saving():
+    heavy_hitters = SpaceSaving(k=3)
+    for key in ["a"] * 10 + ["b"] * 5 + ["c", "d", "e"]:
+        heavy_hitters.add(key)
+    top = heavy_hitters.top(2)
+    assert top[0] == ("a", 10)
+    assert top[1][0] == "b"
+    assert len(heavy_hitters.counts) == 3
+
+
+def test_filter_rules():
+    traffic_filter = TrafficFilter.from_file(TRAFFIC_RULES)
+    metrics = [
+        get_metric("10.0.0.1"),
+        get_metric("10.0.0.2", "Mozilla/5.0 (compatible; Googlebot/2.1)"),
+        get_metric("10.0.0.3", "Boto3/1.17.5 Python/3.8 Botocore/1.20"),
+    ]
+    filtered_metrics = list(traffic_filter.filter(metrics))
+    assert filtered_metrics == [metrics[0], metrics[2]]
+    assert traffic_filter.get_summary()["excluded"] == {
+        "user_agent": 1,
+        "source_ip": 0,
+        "frequency": 0,
+    }
+
+
+def test_filter_sources():
+    traffic_filter = TrafficFilter(
+        blocked_source_ips=["192.168.0.0/16"],
+        max_events_per_source=5,
+        max_source_fraction=0.5,
+        min_events_for_fraction=10,
+    )
+    metrics = (
+        [get_metric("10.0.0.1")] * 4
+        + [get_metric("10.0.0.2")] * 6
+        + [get_metric("192.168.1.1")] * 2
+    )
+    filtered_metrics = list(traffic_filter.filter(metrics))
+    # Validate the blocked network and the events from a source over the limit of 5 events are excluded
+    assert (
+        filtered_metrics == [get_metric("10.0.0.1")] * 4 + [get_metric("10.0.0.2")] * 5
+    )
+    summary = traffic_filter.get_summary()
+    assert summary["excluded"] == {"user_agent": 0, "source_ip": 2, "frequency": 1}
+    assert summary["source_limit"] == 5
+    assert summary["heavy_hitters"][0] == ("10.0.0.2", 6)
+
+    # Validate the counts are shared across calls until reset
+    assert list(traffic_filter.filter([get_metric("10.0.0.1")] * 2)) == [
+        get_metric("10.0.0.1")
+    ]
+    traffic_filter.reset()
+    assert list(traffic_filter.filter([get_metric("10.0.0.2")])) == [
+        get_metric("10.0.0.2")
+    ]
+    assert traffic_filter.get_summary()["excluded"]["frequency"] == 0
+
+
+def test_filter_low_count_fraction():
+    traffic_filter = TrafficFilter(max_source_fraction=0.05, min_events_for_fraction=2)
+
+    # Validate a fraction of a small total still allows the first event from each source
+    metrics = [get_metric(f"10.0.0.{i}") for i in range(4)]
+    assert list(traffic_filter.filter(metrics)) == metrics
+    assert traffic_filter.get_summary()["source_limit"] == 1
+
+
+def test_filter_threads():
+    traffic_filter = TrafficFilter(max_events_per_source=100)
+    metrics = [get_metric(f"10.0.0.{i % 2}") for i in range(1000)]
+
+    # Validate the events are counted once when filtered from concurrent threads
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        filtered = executor.map(lambda m: list(traffic_filter.filter([m])), metrics)
+        assert sum(len(f) for f in filtered) == 200
+    assert traffic_filter.total == 1000
+    assert traffic_filter.get_summary()["excluded"]["frequency"] == 800
+
+    # Validate the filter is only reset once the window has passed
+    assert not traffic_filter.reset_after(60)
+    assert traffic_filter.reset_after(0)
+    assert traffic_filter.total == 0
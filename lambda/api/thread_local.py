@@ -0,0 +1,40 @@
+import boto3
+import threading
+
+# Contains a descriptor for boto3 resources, which are not thread safe so can't be shared by the concurrent requests
+# of the service. Each thread creates its own resources from a session for the thread, while clients are shared.
+# see: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/resources.html
+
+sessions = threading.local()
+
+
+def get_session():
+    """
+    Return the boto3 session for the calling thread
+    """
+    session = getattr(sessions, "session", None)
+    if session is None:
+        session = sessions.session = boto3.session.Session()
+    return session
+
+
+class ThreadLocalResource:
+    """
+    Class for a boto3 resource attribute that returns a resource for the calling thread
+    """
+
+    def __init__(self, service_name: str):
+        self.service_name = service_name
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        # Keep the thread local on the object, so each object has its own resource per thread
+        local = obj.__dict__.setdefault(f"_{self.name}_local", threading.local())
+        resource = getattr(local, "resource", None)
+        if resource is None:
+            resource = local.resource = get_session().resource(self.service_name)
+        return resource
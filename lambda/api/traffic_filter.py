@@ -0,0 +1,226 @@
+import hashlib
+import ipaddress
+import json
+import logging
+import re
+import threading
+from time import time
+
+# Contains pure python streaming filters for excluding bot and high frequency traffic from the metrics.
+# The count-min sketch estimates the events per source in fixed memory regardless of the number of sources, with
+# estimates that are never under the true count, and the space-saving algorithm tracks the top sources to report
+# the heavy hitters.
+# For count-min sketch see: http://dimacs.rutgers.edu/~graham/pubs/papers/cm-full.pdf
+# For space-saving see: https://www.cs.ucsb.edu/sites/default/files/documents/2005-23.pdf
+
+
+class CountMinSketch:
+    """
+    Class for estimating the count of keys in a fixed width and depth of counters
+    """
+
+    def __init__(self, width: int = 2048, depth: int = 4):
+        if width < 1 or depth < 1 or depth > 16:
+            raise Exception("Require width >= 1 and depth between 1 and 16")
+        self.width = width
+        self.depth = depth
+        self.counts = [[0] * width for _ in range(depth)]
+
+    def get_indexes(self, key: str):
+        # Split a single hash into 4 bytes for each row of counters
+        digest = hashlib.blake2b(
+            key.encode("utf-8"), digest_size=4 * self.depth
+        ).digest()
+        return [
+            int.from_bytes(digest[4 * i : 4 * i + 4], "little") % self.width
+            for i in range(self.depth)
+        ]
+
+    def add(self, key: str, count: int = 1):
+        """
+        Add the count for the key, and return the new estimate
+        """
+        estimate = None
+        for row, i in enumerate(self.get_indexes(key)):
+            self.counts[row][i] += count
+            estimate = (
+                self.counts[row][i]
+                if estimate is None
+                else min(estimate, self.counts[row][i])
+            )
+        return estimate
+
+    def estimate(self, key: str):
+        return min(self.counts[row][i] for row, i in enumerate(self.get_indexes(key)))
+
+
+class SpaceSaving:
+    """
+    Class for tracking the top k most frequent keys in a stream
+    """
+
+    def __init__(self, k: int = 100):
+        if k < 1:
+            raise Exception("Require k >= 1")
+        self.k = k
+        self.counts = {}
+
+    def add(self, key: str):
+        if key in self.counts or len(self.counts) < self.k:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            return
+        # Replace the minimum key, which over estimates the new key by at most the minimum count
+        min_key = min(self.counts, key=self.counts.get)
+        self.counts[key] = self.counts.pop(min_key) + 1
+
+    def top(self, n: int = None):
+        """
+        Return the list of (key, count) tuples sorted by most frequent
+        """
+        return sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)[:n]
+
+
+class TrafficFilter:
+    """
+    Class for excluding metrics from blocked user agents and sources, or sources with too many events.
+    The events per source are counted across calls to filter until reset, and can be shared between threads.
+    """
+
+    def __init__(
+        self,
+        blocked_user_agents: list = None,
+        blocked_source_ips: list = None,
+        max_events_per_source: int = 0,
+        max_source_fraction: float = 0.0,
+        min_events_for_fraction: int = 1000,
+        source_key: str = "source_ip",
+        sketch_width: int = 2048,
+        sketch_depth: int = 4,
+        top_k: int = 100,
+    ):
+        self.blocked_user_agents = [re.compile(p) for p in blocked_user_agents or []]
+        self.blocked_networks = [
+            ipaddress.ip_network(n, strict=False) for n in blocked_source_ips or []
+        ]
+        # Zero disables the limit on events and the fraction of events for any one source
+        self.max_events_per_source = max_events_per_source
+        self.max_source_fraction = max_source_fraction
+        self.min_events_for_fraction = min_events_for_fraction
+        self.source_key = source_key
+        self.sketch_width = sketch_width
+        self.sketch_depth = sketch_depth
+        self.top_k = top_k
+        # Lock for sharing the counts between request threads in the service
+        self.lock = threading.RLock()
+        self.reset()
+
+    @classmethod
+    def from_file(cls, path: str):
+        """
+        Return the filter for the json rules file
+        """
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def reset(self):
+        """
+        Reset the events counted per source, and the excluded counts
+        """
+        with self.lock:
+            self.sketch = CountMinSketch(self.sketch_width, self.sketch_depth)
+            self.heavy_hitters = SpaceSaving(self.top_k)
+            self.total = 0
+            self.excluded = {"user_agent": 0, "source_ip": 0, "frequency": 0}
+            self.reset_at = time()
+
+    def reset_after(self, window: int):
+        """
+        Log the summary and reset if the window in seconds has passed since the reset, returning True if reset
+        """
+        with self.lock:
+            if time() - self.reset_at < window:
+                return False
+            self.log_summary()
+            self.reset()
+            return True
+
+    def is_blocked_user_agent(self, user_agent: str):
+        return user_agent is not None and any(
+            p.search(user_agent) for p in self.blocked_user_agents
+        )
+
+    def is_blocked_source_ip(self, source_ip: str):
+        if source_ip is None or len(self.blocked_networks) == 0:
+            return False
+        try:
+            ip = ipaddress.ip_address(source_ip)
+        except ValueError:
+            return False
+        return any(ip in n for n in self.blocked_networks)
+
+    def get_source_limit(self, total: int):
+        """
+        Return the maximum number of events for a source, or None if there is no limit
+        """
+        limits = []
+        if self.max_events_per_source > 0:
+            limits.append(self.max_events_per_source)
+        if self.max_source_fraction > 0 and total >= self.min_events_for_fraction:
+            # Allow at least one event, so small totals don't exclude every event from a source
+            limits.append(max(1, int(self.max_source_fraction * total)))
+        return min(limits) if len(limits) > 0 else None
+
+    def get_excluded_reason(self, metric: dict):
+        """
+        Count the metric for its source, and return the reason it is excluded or None if allowed
+        """
+        if self.is_blocked_user_agent(metric.get("user_agent")):
+            return "user_agent"
+        if self.is_blocked_source_ip(metric.get("source_ip")):
+            return "source_ip"
+        self.total += 1
+        source = metric.get(self.source_key)
+        if source is None:
+            return None
+        estimate = self.sketch.add(str(source))
+        self.heavy_hitters.add(str(source))
+        limit = self.get_source_limit(self.total)
+        if limit is not None and estimate > limit:
+            return "frequency"
+        return None
+
+    def filter(self, metrics):
+        """
+        Yield the metrics that are not excluded in a single pass, so the metrics can be streamed.
+        Events from a source are excluded once its estimated count since the reset is over the limit.
+        """
+        for m in metrics:
+            # Count each metric under the lock, without holding it while the caller consumes the metric
+            with self.lock:
+                reason = self.get_excluded_reason(m)
+                if reason is not None:
+                    self.excluded[reason] += 1
+            if reason is None:
+                yield m
+
+    def get_summary(self):
+        """
+        Return a summary of the excluded counts and heavy hitters since the reset
+        """
+        with self.lock:
+            return {
+                "excluded": dict(self.excluded),
+                "source_limit": self.get_source_limit(self.total),
+                "heavy_hitters": self.heavy_hitters.top(10),
+            }
+
+    def log_summary(self):
+        """
+        Log the summary if any metrics have been excluded since the reset
+        """
+        summary = self.get_summary()
+        if sum(summary["excluded"].values()) > 0:
+            logging.info(f"Excluded metrics: {summary}")
+        else:
+            logging.debug(summary)
+        return summary
@@ -22,11 +22,16 @@ setuptools.setup(
         "aws_cdk.aws_codepipeline==1.94.1",
         "aws_cdk.aws_codepipeline_actions==1.94.1",
         "aws_cdk.aws_dynamodb==1.94.1",
+        "aws-cdk.aws-ec2==1.94.1",
+        "aws-cdk.aws-glue==1.94.1",
         "aws-cdk.aws-events==1.94.1",
         "aws-cdk.aws-events-targets==1.94.1",
         "aws-cdk.aws-iam==1.94.1",
         "aws-cdk.aws-lambda==1.94.1",
         "aws-cdk.aws-s3-notifications==1.94.1",
+        "aws-cdk.aws-secretsmanager==1.94.1",
+        "aws-cdk.aws-sns==1.94.1",
+        "aws-cdk.aws-sns-subscriptions==1.94.1",
     ],
     python_requires=">=3.6",
     classifiers=[